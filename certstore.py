@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of generated host certificates shared across archives and runs.
+
+Host certificates are signed by the root CA, so a certificate is only valid
+with the CA that signed it. The on-disk cache is therefore partitioned by the
+CA fingerprint. The common name comes from the real server certificate when
+there is one, so certificates are also keyed by the source of the name:
+
+  <cache_dir>/<root CA sha256 fingerprint>/<host>.<name source>.pem
+
+where the name source is a digest of the server certificate or 'dummy'.
+
+Files are written to a temporary file and renamed into place, so concurrent
+replay processes never read a partial certificate.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+
+import certutils
+
+UNSAFE_FILENAME_CHARS_RE = re.compile(r'[^A-Za-z0-9.*_-]')
+
+
+class CertificateStore(object):
+  """Thread-safe store of host certificates with memory and disk caches."""
+
+  def __init__(self, cache_dir=None, max_cached_certs=1024):
+    """Initialize CertificateStore.
+
+    Args:
+      cache_dir: a directory for certificates that persist across runs,
+          or None to keep certificates in memory only.
+      max_cached_certs: the maximum number of certificates kept in memory.
+          The least recently used ones are evicted first.
+    """
+    self.cache_dir = cache_dir
+    self.max_cached_certs = max_cached_certs
+    self._lock = threading.Lock()
+    # {(fingerprint, host, name source): cert_str}
+    self._certs = collections.OrderedDict()
+    # {(fingerprint, host, name source): threading.Event}
+    self._generating = {}
+    self._fingerprints = {}  # {root_ca_cert_str: fingerprint}
+
+  def _get_fingerprint(self, root_ca_cert_str):
+    with self._lock:
+      fingerprint = self._fingerprints.get(root_ca_cert_str)
+    if fingerprint is None:
+      root_ca_cert = certutils.load_cert(root_ca_cert_str)
+      fingerprint = root_ca_cert.digest('sha256').replace(':', '').lower()
+      with self._lock:
+        self._fingerprints[root_ca_cert_str] = fingerprint
+    return fingerprint
+
+  def _get_key(self, root_ca_cert_str, host, server_cert_str):
+    """Return the cache key of a certificate.
+
+    Args:
+      root_ca_cert_str: PEM formatted string of the root CA.
+      host: the host name of the certificate.
+      server_cert_str: PEM formatted string of the real server certificate
+          the common name is copied from, or '' for a dummy common name.
+    Returns:
+      a (fingerprint, host, name source) tuple
+    """
+    if server_cert_str:
+      name_source = hashlib.sha256(server_cert_str).hexdigest()[:16]
+    else:
+      name_source = 'dummy'
+    return (self._get_fingerprint(root_ca_cert_str), host, name_source)
+
+  def _get_cert_path(self, fingerprint, host, name_source):
+    return os.path.join(
+        self.cache_dir, fingerprint,
+        '%s.%s.pem' % (UNSAFE_FILENAME_CHARS_RE.sub('_', host), name_source))
+
+  def _cache(self, key, cert_str):
+    """Add a certificate to the memory cache. Must hold the lock."""
+    self._certs[key] = cert_str
+    while len(self._certs) > self.max_cached_certs:
+      self._certs.popitem(last=False)
+
+  def _read_cert(self, cert_path):
+    """Return the certificate in |cert_path| or None if missing or expired."""
+    try:
+      with open(cert_path, 'r') as cert_file:
+        cert_str = cert_file.read()
+      if not certutils.load_cert(cert_str).has_expired():
+        return cert_str
+    except (IOError, certutils.crypto.Error), e:
+      logging.debug('Unable to read cached certificate %s: %s', cert_path, e)
+    return None
+
+  def _write_cert(self, cert_path, cert_str):
+    cert_dir = os.path.dirname(cert_path)
+    try:
+      if not os.path.exists(cert_dir):
+        os.makedirs(cert_dir)
+    except OSError:
+      if not os.path.isdir(cert_dir):  # Another process may have created it.
+        raise
+    temp_file = tempfile.NamedTemporaryFile(
+        dir=cert_dir, suffix='.tmp', delete=False)
+    try:
+      with temp_file:
+        temp_file.write(cert_str)
+      os.rename(temp_file.name, cert_path)
+    except OSError, e:
+      # On Windows, rename fails if another process wrote the file first.
+      logging.debug('Unable to cache certificate %s: %s', cert_path, e)
+      os.remove(temp_file.name)
+
+  def get_cached_certificate(self, root_ca_cert_str, host, server_cert_str):
+    """Return the cached certificate for |host| or None (never generates)."""
+    key = self._get_key(root_ca_cert_str, host, server_cert_str)
+    with self._lock:
+      cert_str = self._certs.get(key)
+    if cert_str is None and self.cache_dir:
+      cert_str = self._read_cert(self._get_cert_path(*key))
+      if cert_str is not None:
+        with self._lock:
+          self._cache(key, cert_str)
+    return cert_str
+
+  def add_certificate(self, root_ca_cert_str, host, server_cert_str,
+                      cert_str):
+    """Add a certificate that was generated elsewhere."""
+    key = self._get_key(root_ca_cert_str, host, server_cert_str)
+    if self.cache_dir:
+      self._write_cert(self._get_cert_path(*key), cert_str)
+    with self._lock:
+      self._cache(key, cert_str)
+
+  def get_certificate(self, root_ca_cert_str, host, server_cert_str,
+                      generate_cert):
+    """Return the certificate for |host| signed by the root CA.
+
+    Concurrent requests for the same certificate wait for a single
+    generation.
+
+    Args:
+      root_ca_cert_str: PEM formatted string of the root CA.
+      host: the host name of the certificate.
+      server_cert_str: PEM formatted string of the real server certificate
+          the common name is copied from, or '' for a dummy common name.
+      generate_cert: a function that returns a new PEM formatted certificate
+          string for |host| signed by the root CA.
+    Returns:
+      a PEM formatted certificate string
+    """
+    key = self._get_key(root_ca_cert_str, host, server_cert_str)
+    while True:
+      with self._lock:
+        cert_str = self._certs.pop(key, None)
+        if cert_str is not None:
+          self._certs[key] = cert_str  # Mark as most recently used.
+          return cert_str
+        generation_done = self._generating.get(key)
+        if generation_done is None:
+          generation_done = threading.Event()
+          self._generating[key] = generation_done
+          break
+      generation_done.wait()
+      # Check the cache again (the generation may have failed).
+
+    try:
+      cert_path = None
+      cert_str = None
+      if self.cache_dir:
+        cert_path = self._get_cert_path(*key)
+        cert_str = self._read_cert(cert_path)
+      if cert_str is None:
+        cert_str = generate_cert()
+        if cert_path:
+          self._write_cert(cert_path, cert_str)
+      with self._lock:
+        self._cache(key, cert_str)
+    finally:
+      with self._lock:
+        del self._generating[key]
+      generation_done.set()
+    return cert_str
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import certstore
+import certutils
+import httparchive
+
+
+class CertGenerator(object):
+  """Generate host certificates and count the calls."""
+
+  def __init__(self, root_ca_cert_str):
+    self.root_ca_cert_str = root_ca_cert_str
+    self.hosts = []
+    self.lock = threading.Lock()
+    self.release = threading.Event()
+    self.release.set()
+
+  def __call__(self, host, server_cert_str=''):
+    def generate():
+      self.release.wait()
+      with self.lock:
+        self.hosts.append(host)
+      return certutils.generate_cert(
+          self.root_ca_cert_str, server_cert_str, host)
+    return generate
+
+
+class CertificateStoreTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.root_ca_cert_str = ''.join(certutils.generate_dummy_ca_cert())
+    cls.other_root_ca_cert_str = ''.join(certutils.generate_dummy_ca_cert())
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp(prefix='certstore_')
+    self.generate = CertGenerator(self.root_ca_cert_str)
+    self.server_certs = {}
+    self.get_host_cert = certutils.get_host_cert
+    certutils.get_host_cert = lambda host: self.server_certs.get(host, '')
+
+  def tearDown(self):
+    certutils.get_host_cert = self.get_host_cert
+    shutil.rmtree(self.cache_dir)
+
+  def get_certificate(self, store, host, root_ca_cert_str=None,
+                      server_cert_str=''):
+    return store.get_certificate(root_ca_cert_str or self.root_ca_cert_str,
+                                 host, server_cert_str,
+                                 self.generate(host, server_cert_str))
+
+  def create_archive(self, store):
+    archive = httparchive.HttpArchive()
+    archive[httparchive.ArchivedHttpRequest('ROOT_CERT', '', '', None, {})] = (
+        httparchive.create_response(200, body=self.root_ca_cert_str))
+    archive.cert_store = store
+    return archive
+
+  def test_memory_cache(self):
+    store = certstore.CertificateStore()
+    cert_str = self.get_certificate(store, 'a.com')
+    self.assertEqual(cert_str, self.get_certificate(store, 'a.com'))
+    self.assertEqual(
+        'a.com', certutils.load_cert(cert_str).get_subject().commonName)
+    self.assertEqual(['a.com'], self.generate.hosts)
+
+  def test_lru_eviction(self):
+    store = certstore.CertificateStore(max_cached_certs=2)
+    self.get_certificate(store, 'a.com')
+    self.get_certificate(store, 'b.com')
+    self.get_certificate(store, 'a.com')
+    self.get_certificate(store, 'c.com')  # Evicts b.com.
+    self.get_certificate(store, 'a.com')
+    self.get_certificate(store, 'b.com')
+    self.assertEqual(['a.com', 'b.com', 'c.com', 'b.com'],
+                     self.generate.hosts)
+
+  def test_disk_cache_is_shared(self):
+    store = certstore.CertificateStore(self.cache_dir)
+    cert_str = self.get_certificate(store, 'a.com')
+    other_store = certstore.CertificateStore(self.cache_dir)
+    self.assertEqual(cert_str, self.get_certificate(other_store, 'a.com'))
+    self.assertEqual(['a.com'], self.generate.hosts)
+    self.assertEqual([], [f for d, _, files in os.walk(self.cache_dir)
+                          for f in files if f.endswith('.tmp')])
+
+  def test_disk_cache_is_keyed_by_root_ca(self):
+    store = certstore.CertificateStore(self.cache_dir)
+    self.get_certificate(store, 'a.com')
+    self.get_certificate(store, 'a.com', self.other_root_ca_cert_str)
+    self.assertEqual(['a.com', 'a.com'], self.generate.hosts)
+    self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
+  def test_cache_is_keyed_by_common_name_source(self):
+    store = certstore.CertificateStore(self.cache_dir)
+    server_cert_str = certutils.generate_cert(
+        self.other_root_ca_cert_str, '', 'www.a.com')
+    dummy_cert_str = self.get_certificate(store, 'a.com')
+    cert_str = self.get_certificate(
+        store, 'a.com', server_cert_str=server_cert_str)
+    self.assertEqual(['a.com', 'a.com'], self.generate.hosts)
+    self.assertEqual(
+        'www.a.com', certutils.load_cert(cert_str).get_subject().commonName)
+    self.assertEqual(dummy_cert_str, store.get_cached_certificate(
+        self.root_ca_cert_str, 'a.com', ''))
+    self.assertEqual(cert_str, store.get_cached_certificate(
+        self.root_ca_cert_str, 'a.com', server_cert_str))
+
+  def test_concurrent_requests_generate_once(self):
+    store = certstore.CertificateStore(self.cache_dir)
+    self.generate.release.clear()
+    certs = []
+    threads = [threading.Thread(target=lambda: certs.append(
+        self.get_certificate(store, 'a.com'))) for _ in range(5)]
+    for thread in threads:
+      thread.start()
+    self.generate.release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(['a.com'], self.generate.hosts)
+    self.assertEqual(1, len(set(certs)))
+
+  def test_archive_uses_store(self):
+    store = certstore.CertificateStore(self.cache_dir)
+    cert_str = self.get_certificate(store, 'a.com')
+    archive = self.create_archive(store)
+    self.assertEqual(cert_str, archive.get_certificate('a.com'))
+    self.assertFalse('cert_store' in archive.__getstate__())
+
+  def test_archive_records_server_cert_on_store_hit(self):
+    server_cert_str = certutils.generate_cert(
+        self.other_root_ca_cert_str, '', 'www.a.com')
+    self.server_certs['a.com'] = server_cert_str
+    store = certstore.CertificateStore(self.cache_dir)
+    cert_str = self.get_certificate(
+        store, 'a.com', server_cert_str=server_cert_str)
+    archive = self.create_archive(store)
+    self.assertEqual(cert_str, archive.get_certificate('a.com'))
+    self.assertEqual(['a.com'], self.generate.hosts)
+    server_cert_request = httparchive.ArchivedHttpRequest(
+        'SERVER_CERT', 'a.com', '', None, {})
+    self.assertEqual(server_cert_str,
+                     archive[server_cert_request].response_data[0])
+
+    # The archive is replayed without the store or the live server.
+    del self.server_certs['a.com']
+    replay_archive = self.create_archive(None)
+    replay_archive[server_cert_request] = archive[server_cert_request]
+    replay_cert_str = replay_archive.get_certificate('a.com')
+    self.assertEqual('www.a.com', certutils.load_cert(
+        replay_cert_str).get_subject().commonName)
+
+  def test_archive_pregenerates_certificates(self):
+    store = certstore.CertificateStore(self.cache_dir)
+    cached_cert_str = self.get_certificate(store, 'cached.com')
+    archive = self.create_archive(store)
+    for host in ('a.com', 'b.com:8443', 'cached.com', 'plain.com'):
+      request = httparchive.ArchivedHttpRequest(
+          'GET', host, '/', None, {}, is_ssl=host != 'plain.com')
+      archive[request] = httparchive.create_response(200)
+    archive.pregenerate_certificates(num_processes=2)
+    dummy_cert_hosts = sorted(
+        r.host for r in archive if r.command == 'DUMMY_CERT')
+    self.assertEqual(['a.com', 'b.com', 'cached.com'], dummy_cert_hosts)
+    self.assertEqual(cached_cert_str, archive.get_certificate('cached.com'))
+    b_cert = certutils.load_cert(archive.get_certificate('b.com'))
+    self.assertEqual('b.com', b_cert.get_subject().commonName)
+    # The generated certificates were added to the store as well.
+    self.assertEqual(archive.get_certificate('a.com'),
+                     store.get_cached_certificate(self.root_ca_cert_str,
+                                                  'a.com', ''))
+    self.assertEqual(['cached.com'], self.generate.hosts)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -17,6 +17,8 @@ openssl_import_error = None
 
 SSL_METHOD = None
 VERIFY_PEER = None
+SESS_CACHE_SERVER = None
+NO_OVERLAPPING_PROTOCOLS = ''
 SysCallError = None
 Error = None
 ZeroReturnError = None
@@ -26,12 +28,42 @@ try:
 
   SSL_METHOD = SSL.SSLv23_METHOD
   VERIFY_PEER = SSL.VERIFY_PEER
+  SESS_CACHE_SERVER = SSL.SESS_CACHE_SERVER
+  # Older versions of pyOpenSSL take an empty protocol instead.
+  NO_OVERLAPPING_PROTOCOLS = getattr(SSL, 'NO_OVERLAPPING_PROTOCOLS', '')
   SysCallError = SSL.SysCallError
   Error = SSL.Error
   ZeroReturnError = SSL.ZeroReturnError
 except ImportError, e:
   openssl_import_error = e
 
+# pyOpenSSL does not wrap SSL_session_reused, so it is called through the
+# private OpenSSL bindings when they are available.
+_openssl_lib = None
+try:
+  from OpenSSL._util import lib as _openssl_lib
+except ImportError:
+  pass
+
+# ECDSA keys are generated with the cryptography package, which newer
+# versions of pyOpenSSL depend on.
+ec = None
+default_backend = None
+serialization = None
+try:
+  from cryptography.hazmat.backends import default_backend
+  from cryptography.hazmat.primitives import serialization
+  from cryptography.hazmat.primitives.asymmetric import ec
+except ImportError:
+  pass
+
+# The key type is chosen when the root CA is generated. replay.py loads an
+# existing root CA (--https_root_ca_cert_path), so its host certificates use
+# whatever key that CA has.
+KEY_TYPES = ('rsa2048', 'ecdsa-p256', 'rsa1024')
+DEFAULT_KEY_TYPE = 'rsa2048'
+DEFAULT_DIGEST = 'sha256'
+
 
 def get_ssl_context(method=SSL_METHOD):
   # One of: One of SSLv2_METHOD, SSLv3_METHOD, SSLv23_METHOD, or TLSv1_METHOD
@@ -63,6 +95,18 @@ def get_ssl_connection(context, connection):
   return WrappedConnection(SSL.Connection(context, connection))
 
 
+def is_session_reused(connection):
+  """Returns True iff the handshake of connection resumed a session.
+
+  Returns False if this version of pyOpenSSL does not expose the call.
+  """
+  session_reused = getattr(_openssl_lib, 'SSL_session_reused', None)
+  ssl = getattr(connection, '_ssl', None)
+  if session_reused is None or ssl is None:
+    return False
+  return bool(session_reused(ssl))
+
+
 def load_privatekey(key, filetype=crypto.FILETYPE_PEM):
   """Loads obj private key object from string."""
   return crypto.load_privatekey(filetype, key)
@@ -83,11 +127,43 @@ def _dump_cert(cert, filetype=crypto.FILETYPE_PEM):
   return crypto.dump_certificate(filetype, cert)
 
 
-def generate_dummy_ca_cert(subject='_WebPageReplayCert'):
+def _generate_key(key_type):
+  """Generates a private key.
+
+  Args:
+    key_type: one of KEY_TYPES
+  Returns:
+    a crypto.PKey
+  """
+  if key_type == 'ecdsa-p256':
+    if ec is None:
+      raise ValueError('ecdsa-p256 keys require the cryptography package')
+    # PKey.from_cryptography_key() only accepts RSA and DSA keys, so load the
+    # EC key through PEM.
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    return crypto.load_privatekey(crypto.FILETYPE_PEM, key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption()))
+  if key_type not in ('rsa2048', 'rsa1024'):
+    raise ValueError('Unknown key type: %s (expected one of %s)' %
+                     (key_type, ', '.join(KEY_TYPES)))
+  key = crypto.PKey()
+  key.generate_key(crypto.TYPE_RSA, int(key_type[3:]))
+  return key
+
+
+def generate_dummy_ca_cert(subject='_WebPageReplayCert',
+                           key_type=DEFAULT_KEY_TYPE, digest=DEFAULT_DIGEST):
   """Generates dummy certificate authority.
 
+  Host certificates generated by generate_cert reuse the key of the
+  certificate authority, so key_type also determines their key.
+
   Args:
     subject: a string representing the desired root cert issuer
+    key_type: one of KEY_TYPES
+    digest: the signature digest (e.g. 'sha256')
   Returns:
     A tuple of the public key and the private key strings for the root
     certificate
@@ -95,8 +171,7 @@ def generate_dummy_ca_cert(subject='_WebPageReplayCert'):
   if openssl_import_error:
     raise openssl_import_error
 
-  key = crypto.PKey()
-  key.generate_key(crypto.TYPE_RSA, 1024)
+  key = _generate_key(key_type)
 
   ca_cert = crypto.X509()
   ca_cert.set_serial_number(int(time.time()*10000))
@@ -118,7 +193,7 @@ def generate_dummy_ca_cert(subject='_WebPageReplayCert'):
       crypto.X509Extension('subjectKeyIdentifier', False, 'hash',
                            subject=ca_cert),
       ])
-  ca_cert.sign(key, 'sha1')
+  ca_cert.sign(key, digest)
   key_str = _dump_privatekey(key)
   ca_cert_str = _dump_cert(ca_cert)
   return ca_cert_str, key_str
@@ -197,7 +272,8 @@ def write_dummy_ca_cert(ca_cert_str, key_str, cert_path):
     f.write(p12.export())
 
 
-def generate_cert(root_ca_cert_str, server_cert_str, server_host):
+def generate_cert(root_ca_cert_str, server_cert_str, server_host,
+                  digest=DEFAULT_DIGEST):
   """Generates a cert_str with the sni field in server_cert_str signed by the
   root_ca_cert_str.
 
@@ -205,6 +281,7 @@ def generate_cert(root_ca_cert_str, server_cert_str, server_host):
     root_ca_cert_str: PEM formatted string representing the root cert
     server_cert_str: PEM formatted string representing cert
     server_host: host name to use if there is no server_cert_str
+    digest: the signature digest (e.g. 'sha256')
   Returns:
     a PEM formatted certificate string
   """
@@ -223,7 +300,7 @@ def generate_cert(root_ca_cert_str, server_cert_str, server_host):
   subj = req.get_subject()
   subj.CN = common_name
   req.set_pubkey(ca_cert.get_pubkey())
-  req.sign(key, 'sha1')
+  req.sign(key, digest)
 
   cert = crypto.X509()
   cert.gmtime_adj_notBefore(-60 * 60)
@@ -232,6 +309,6 @@ def generate_cert(root_ca_cert_str, server_cert_str, server_host):
   cert.set_subject(req.get_subject())
   cert.set_serial_number(int(time.time()*10000))
   cert.set_pubkey(req.get_pubkey())
-  cert.sign(key, 'sha1')
+  cert.sign(key, digest)
 
   return _dump_cert(cert)
@@ -111,6 +111,21 @@ class CertutilsTest(unittest.TestCase):
     self.assertEqual(issuer, cert.get_issuer().commonName)
     self.assertEqual(subject, cert.get_subject().commonName)
 
+  def test_key_types(self):
+    for key_type in certutils.KEY_TYPES:
+      ca_cert_str, key_str = certutils.generate_dummy_ca_cert(
+          'testIssuer', key_type=key_type)
+      cert = certutils.load_cert(
+          certutils.generate_cert(key_str + ca_cert_str, '', 'host'))
+      self.assertEqual('host', cert.get_subject().commonName)
+      self.assertEqual('sha256WithRSAEncryption' if key_type.startswith('rsa')
+                       else 'ecdsa-with-SHA256',
+                       cert.get_signature_algorithm())
+
+  def test_unknown_key_type(self):
+    self.assertRaises(ValueError, certutils.generate_dummy_ca_cert,
+                      key_type='rsa512')
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -15,34 +15,59 @@
 
 import daemonserver
 import errno
+import heapq
+import httparchive
 import logging
+import Queue
+import random
+import select
 import socket
-import SocketServer
+import struct
 import threading
 import time
 
 import third_party
-import dns.flags
-import dns.message
-import dns.rcode
 import dns.resolver
 import dns.rdatatype
 import ipaddr
 
 
+MAX_UDP_PACKET_SIZE = 65535
+TCP_LISTEN_BACKLOG = 128
+NUM_LOOKUP_THREADS = 8
+STANDARD_QUERY_OPERATION_CODE = 0
+
+
 class DnsProxyException(Exception):
   pass
 
 
 class RealDnsLookup(object):
-  def __init__(self, name_servers):
+  """Resolve hosts with real name servers and cache the answers.
+
+  Answers are cached until their TTL expires (but at least min_ttl_seconds).
+  Failed lookups (NXDOMAIN, no answer, timeouts) are cached for
+  negative_ttl_seconds. Concurrent lookups of the same uncached host share a
+  single query. The duration of the most recent query for each host is kept
+  so that it can be saved in the archive (see GetLookupTimes).
+  """
+
+  def __init__(self, name_servers, min_ttl_seconds=60,
+               negative_ttl_seconds=30, clock=time.time):
     if '127.0.0.1' in name_servers:
       raise DnsProxyException(
           'Invalid nameserver: 127.0.0.1 (causes an infinte loop)')
     self.resolver = dns.resolver.get_default_resolver()
     self.resolver.nameservers = name_servers
+    self.min_ttl_seconds = min_ttl_seconds
+    self.negative_ttl_seconds = negative_ttl_seconds
+    self._clock = clock  # returns the current time in seconds
     self.dns_cache_lock = threading.Lock()
-    self.dns_cache = {}
+    self.dns_cache = {}  # {(hostname, rdtype): (ip, expiration)}
+    self.lookups_in_flight = {}  # {(hostname, rdtype): threading.Event}
+    self.lookup_times = {}  # {hostname: lookup_ms}
+    self.stats = dict.fromkeys(
+        ('hits', 'negative_hits', 'misses', 'coalesced'), 0)
 
   def _IsIPAddress(self, hostname):
     try:
@@ -62,35 +87,131 @@ class RealDnsLookup(object):
     """
     if self._IsIPAddress(hostname):
       return hostname
-    self.dns_cache_lock.acquire()
-    ip = self.dns_cache.get(hostname)
-    self.dns_cache_lock.release()
-    if ip:
-      return ip
+    # The DNS server asks for "host.", the HTTP client for "host".
+    key = (hostname.rstrip('.'), rdtype)
+    while True:
+      with self.dns_cache_lock:
+        entry = self.dns_cache.get(key)
+        if entry and entry[1] > self._clock():
+          ip = entry[0]
+          self.stats['hits' if ip else 'negative_hits'] += 1
+          return ip
+        lookup_done = self.lookups_in_flight.get(key)
+        is_querying = lookup_done is None
+        if is_querying:
+          lookup_done = threading.Event()
+          self.lookups_in_flight[key] = lookup_done
+          self.stats['misses'] += 1
+        else:
+          self.stats['coalesced'] += 1
+      if is_querying:
+        break
+      lookup_done.wait()
+      with self.dns_cache_lock:
+        entry = self.dns_cache.get(key)
+      if entry:
+        return entry[0]
+      # The query failed unexpectedly or the cache was cleared; try again.
+
+    ip, expiration = None, None
+    start_time = self._clock()
+    try:
+      ip, expiration = self._Query(hostname, rdtype)
+    finally:
+      with self.dns_cache_lock:
+        if expiration:
+          self.dns_cache[key] = (ip, expiration)
+          if rdtype == dns.rdatatype.A:
+            self.lookup_times[key[0]] = (self._clock() - start_time) * 1000.0
+        del self.lookups_in_flight[key]
+      lookup_done.set()
+    return ip
+
+  def IsCached(self, hostname, rdtype=dns.rdatatype.A):
+    """Return True if |hostname| resolves without querying the name servers."""
+    if self._IsIPAddress(hostname):
+      return True
+    key = (hostname.rstrip('.'), rdtype)
+    with self.dns_cache_lock:
+      entry = self.dns_cache.get(key)
+    return bool(entry) and entry[1] > self._clock()
+
+  def _Query(self, hostname, rdtype):
+    """Query the name servers.
+
+    Returns:
+      (ip, expiration)
+        ip: the IP address as a string or None (if the lookup failed).
+        expiration: the time (seconds since the epoch) when the result expires.
+    """
+    negative_expiration = self._clock() + self.negative_ttl_seconds
     try:
       answers = self.resolver.query(hostname, rdtype)
     except dns.resolver.NXDOMAIN:
-      return None
+      return None, negative_expiration
     except dns.resolver.NoNameservers:
       logging.debug('_real_dns_lookup(%s) -> No nameserver.',
                     hostname)
-      return None
+      return None, negative_expiration
     except (dns.resolver.NoAnswer, dns.resolver.Timeout) as ex:
       logging.debug('_real_dns_lookup(%s) -> None (%s)',
                     hostname, ex.__class__.__name__)
-      return None
-    if answers:
-      ip = str(answers[0])
-    self.dns_cache_lock.acquire()
-    self.dns_cache[hostname] = ip
-    self.dns_cache_lock.release()
-    return ip
+      return None, negative_expiration
+    if not answers:
+      return None, negative_expiration
+    expiration = max(answers.expiration, self._clock() + self.min_ttl_seconds)
+    return str(answers[0]), expiration
+
+  def Prefetch(self, hostnames, num_threads=8):
+    """Resolve |hostnames| concurrently to fill the cache.
+
+    Args:
+      hostnames: an iterable of hostnames.
+      num_threads: the number of concurrent lookups.
+    """
+    queue = Queue.Queue()
+    for hostname in set(hostnames):
+      queue.put(hostname)
+    num_hostnames = queue.qsize()
+    start_time = self._clock()
+
+    def Resolve():
+      while True:
+        try:
+          hostname = queue.get_nowait()
+        except Queue.Empty:
+          return
+        self(hostname)
+
+    threads = [threading.Thread(target=Resolve) for _ in xrange(num_threads)]
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for thread in threads:
+      thread.join()
+    logging.info('Prefetched DNS for %d hosts in %dms', num_hostnames,
+                 (self._clock() - start_time) * 1000.0)
+
+  def GetStats(self):
+    """Return a dict of cache counters.
+
+    hits: answered from the cache.
+    negative_hits: failed lookups answered from the cache.
+    misses: lookups that queried the name servers.
+    coalesced: lookups that waited for a concurrent query of the same host.
+    """
+    with self.dns_cache_lock:
+      return dict(self.stats)
+
+  def GetLookupTimes(self):
+    """Return a dict of {hostname: lookup_ms} of the real A queries."""
+    with self.dns_cache_lock:
+      return dict(self.lookup_times)
 
   def ClearCache(self):
     """Clear the dns cache."""
-    self.dns_cache_lock.acquire()
-    self.dns_cache.clear()
-    self.dns_cache_lock.release()
+    with self.dns_cache_lock:
+      self.dns_cache.clear()
 
 
 class ReplayDnsLookup(object):
@@ -105,6 +226,16 @@ class ReplayDnsLookup(object):
       ip = f(hostname, default_ip=ip)
     return ip
 
+  def IsAnswerReady(self, hostname):
+    """Return True if resolving |hostname| does not block on the network."""
+    return all(f.IsAnswerReady(hostname) for f in self.filters
+               if hasattr(f, 'IsAnswerReady'))
+
+  def GetDelayMs(self, hostname):
+    """Return how long the answer for |hostname| should be delayed."""
+    return sum(f.GetDelayMs(hostname) for f in self.filters
+               if hasattr(f, 'GetDelayMs'))
+
 
 class PrivateIpFilter(object):
   """Resolve private hosts to their real IPs and others to the Web proxy IP.
@@ -144,24 +275,36 @@ class PrivateIpFilter(object):
         ip = None
     return ip
 
+  def IsAnswerReady(self, host):
+    """Return True if |host| is in the archive or its real IP is cached."""
+    is_cached = getattr(self.real_dns_lookup, 'IsCached', None)
+    return host in self.archive_hosts or bool(is_cached and is_cached(host))
+
   def InitializeArchiveHosts(self):
     """Recompute the archive_hosts from the http_archive."""
-    self.archive_hosts = set('%s.' % req.host.split(':')[0]
+    self.archive_hosts = set('%s.' % httparchive.split_host_port(req.host)[0]
                              for req in self.http_archive)
 
 
 class DelayFilter(object):
-  """Add a delay to replayed lookups."""
+  """Add a delay to replayed lookups.
+
+  The filter does not block; DnsProxyServer asks for the delay with
+  GetDelayMs and defers sending the answer.
+  """
 
   def __init__(self, is_record_mode, delay_ms):
     self.is_record_mode = is_record_mode
     self.delay_ms = int(delay_ms)
 
   def __call__(self, host, default_ip):
-    if not self.is_record_mode:
-      time.sleep(self.delay_ms * 1000.0)
     return default_ip
 
+  def GetDelayMs(self, host):
+    if self.is_record_mode:
+      return 0
+    return self.delay_ms
+
   def SetRecordMode(self):
     self.is_record_mode = True
 
@@ -169,120 +312,506 @@ class DelayFilter(object):
     self.is_record_mode = False
 
 
-class UdpDnsHandler(SocketServer.DatagramRequestHandler):
-  """Resolve DNS queries to localhost.
+class RecordedDelayFilter(object):
+  """Delay replayed lookups by the lookup times saved in the archive.
 
-  Possible alternative implementation:
-  http://howl.play-bow.org/pipermail/dnspython-users/2010-February/000119.html
+  Hosts without a recorded time get a time drawn from the recorded ones.
+  The draw is seeded by the hostname, so a host gets the same delay in
+  every run.
   """
 
-  STANDARD_QUERY_OPERATION_CODE = 0
-
-  def handle(self):
-    """Handle a DNS query.
+  def __init__(self, is_record_mode, http_archive, scale=1.0):
+    """Initialize RecordedDelayFilter.
 
-    IPv6 requests (with rdtype AAAA) receive mismatched IPv4 responses
-    (with rdtype A). To properly support IPv6, the http proxy would
-    need both types of addresses. By default, Windows XP does not
-    support IPv6.
+    Args:
+      is_record_mode: True iff lookups should not be delayed.
+      http_archive: an instance of a HttpArchive with dns_timings.
+      scale: a factor applied to every delay.
     """
-    self.data = self.rfile.read()
-    self.transaction_id = self.data[0]
-    self.flags = self.data[1]
-    self.qa_counts = self.data[4:6]
-    self.domain = ''
-    operation_code = (ord(self.data[2]) >> 3) & 15
-    if operation_code == self.STANDARD_QUERY_OPERATION_CODE:
-      self.wire_domain = self.data[12:]
-      self.domain = self._domain(self.wire_domain)
-    else:
-      logging.debug("DNS request with non-zero operation code: %s",
-                    operation_code)
-    ip = self.server.dns_lookup(self.domain)
-    if ip is None:
-      logging.debug('dnsproxy: %s -> NXDOMAIN', self.domain)
-      response = self.get_dns_no_such_name_response()
-    else:
-      if ip == self.server.server_address[0]:
-        logging.debug('dnsproxy: %s -> %s (replay web proxy)', self.domain, ip)
-      else:
-        logging.debug('dnsproxy: %s -> %s', self.domain, ip)
-      response = self.get_dns_response(ip)
-    self.wfile.write(response)
+    self.is_record_mode = is_record_mode
+    self.http_archive = http_archive
+    self.scale = scale
+    self.InitializeTimings()
+
+  def __call__(self, host, default_ip):
+    return default_ip
+
+  def GetDelayMs(self, host):
+    if self.is_record_mode or not self.recorded_times_ms:
+      return 0
+    hostname = host.rstrip('.')
+    lookup_ms = self.http_archive.dns_timings.get(hostname)
+    if lookup_ms is None:
+      lookup_ms = random.Random(hostname).choice(self.recorded_times_ms)
+    return lookup_ms * self.scale
 
-  @classmethod
-  def _domain(cls, wire_domain):
-    domain = ''
+  def InitializeTimings(self):
+    """Recompute the distribution of lookup times from the http_archive."""
+    self.recorded_times_ms = sorted(self.http_archive.dns_timings.values())
+
+  def SetRecordMode(self):
+    self.is_record_mode = True
+
+  def SetReplayMode(self):
+    self.is_record_mode = False
+    self.InitializeTimings()
+
+
+def ParseQuery(data):
+  """Parse the question of a DNS query packet.
+
+  Args:
+    data: the query packet as a string.
+  Returns:
+    (opcode, domain, rdtype, question)
+      opcode: the operation code (0 for a standard query).
+      domain: the queried hostname ending with a period (e.g. "a.com.").
+      rdtype: the query type (1 for 'A', 28 for 'AAAA').
+      question: the question section as it appears on the wire.
+    domain, rdtype and question are None if the packet is not a standard
+    query.
+  Raises:
+    IndexError: if the packet is truncated.
+  """
+  opcode = (ord(data[2]) >> 3) & 15
+  if opcode != STANDARD_QUERY_OPERATION_CODE:
+    return opcode, None, None, None
+  labels = []
+  index = 12
+  length = ord(data[index])
+  while length:
+    labels.append(data[index + 1:index + length + 1])
+    index += length + 1
+    length = ord(data[index])
+  question_end = index + 5  # Null label, qtype and qclass.
+  if question_end > len(data):
+    raise IndexError('truncated question')
+  labels.append('')
+  rdtype = (ord(data[index + 1]) << 8) | ord(data[index + 2])
+  return opcode, '.'.join(labels), rdtype, data[12:question_end]
+
+
+class _TcpDnsConnection(object):
+  """A DNS-over-TCP client connection with pending input and output.
+
+  Clients may shut down their side of the connection after sending their
+  queries. The connection is then kept open until the answers that are
+  still being looked up or delayed (pending_answers) have been written.
+  """
+
+  def __init__(self, sock, address):
+    self.socket = sock
+    self.address = address
+    self.read_buffer = ''
+    self.write_buffer = ''
+    self.pending_answers = 0
+    self.is_read_closed = False
+
+  def IsDone(self):
+    """Return True if the client has closed and all answers are written."""
+    return (self.is_read_closed and not self.pending_answers and
+            not self.write_buffer)
+
+  def PopQueries(self):
+    """Return the complete length-prefixed queries received so far."""
+    queries = []
     index = 0
-    length = ord(wire_domain[index])
-    while length:
-      domain += wire_domain[index + 1:index + length + 1] + '.'
-      index += length + 1
-      length = ord(wire_domain[index])
-    return domain
-
-  def get_dns_response(self, ip):
-    packet = ''
-    if self.domain:
-      packet = (
-          self.transaction_id +
-          self.flags +
-          '\x81\x80' +        # standard query response, no error
-          self.qa_counts * 2 + '\x00\x00\x00\x00' +  # Q&A counts
-          self.wire_domain +
-          '\xc0\x0c'          # pointer to domain name
-          '\x00\x01'          # resource record type ("A" host address)
-          '\x00\x01'          # class of the data
-          '\x00\x00\x00\x3c'  # ttl (seconds)
-          '\x00\x04' +        # resource data length (4 bytes for ip)
-          socket.inet_aton(ip)
-          )
-    return packet
-
-  def get_dns_no_such_name_response(self):
-    query_message = dns.message.from_wire(self.data)
-    response_message = dns.message.make_response(query_message)
-    response_message.flags |= dns.flags.AA | dns.flags.RA
-    response_message.set_rcode(dns.rcode.NXDOMAIN)
-    return response_message.to_wire()
-
-
-class DnsProxyServer(SocketServer.ThreadingUDPServer,
-                     daemonserver.DaemonServer):
-  # Increase the request queue size. The default value, 5, is set in
-  # SocketServer.TCPServer (the parent of BaseHTTPServer.HTTPServer).
-  # Since we're intercepting many domains through this single server,
-  # it is quite possible to get more than 5 concurrent requests.
-  request_queue_size = 128
-
-  # Don't prevent python from exiting when there is thread activity.
-  daemon_threads = True
-
-  def __init__(self, host='', port=53, dns_lookup=None):
+    while len(self.read_buffer) - index >= 2:
+      length = struct.unpack('!H', self.read_buffer[index:index + 2])[0]
+      if len(self.read_buffer) - index - 2 < length:
+        break
+      queries.append(self.read_buffer[index + 2:index + 2 + length])
+      index += 2 + length
+    self.read_buffer = self.read_buffer[index:]
+    return queries
+
+
+class DnsProxyServer(daemonserver.DaemonServer):
+  """Answer DNS queries over UDP and TCP from a single thread.
+
+  One thread reads, resolves and answers all queries from non-blocking
+  sockets, so bursts of lookups do not spawn a thread per query. Only
+  lookups that are answered from memory run on that thread (see
+  IsAnswerReady of ReplayDnsLookup); the others may wait for real name
+  servers, so they run on a small pool of lookup threads, which hand the
+  answers back to the socket thread. The TCP
+  listener shares the port and the dns_lookup chain with the UDP socket and
+  accepts pipelined queries on each connection. Answer records are compiled
+  once per (type, IP) and cached. Simulated lookup delays (see GetDelayMs
+  of ReplayDnsLookup) are kept on a timer heap, so delayed answers do not
+  hold up other queries.
+
+  A queries are answered with the IPv4 address from dns_lookup. AAAA queries
+  for hosts that resolve to the replay web proxy are answered with its IPv6
+  address (if one is given). All other queries for existing hosts get an
+  empty answer (NODATA) so that clients do not wait for a timeout or fall
+  back to mismatched records.
+  """
+
+  def __init__(self, host='', port=53, dns_lookup=None, ipv6_host=None,
+               num_lookup_threads=NUM_LOOKUP_THREADS):
     """Initialize DnsProxyServer.
 
     Args:
       host: a host string (name or IP) to bind the dns proxy and to which
         DNS requests will be resolved.
       port: an integer port on which to bind the proxy.
-      dns_lookup: a list of filters to apply to lookup.
+      dns_lookup: a function that resolves a hostname to an IPv4 address
+        (or None). Unless its IsAnswerReady(hostname) returns True, it is
+        called on a lookup thread.
+      ipv6_host: the IPv6 address of the replay web proxy (or None).
+        AAAA queries for hosts that resolve to |host| get this address.
+      num_lookup_threads: the number of threads for lookups that may block.
     """
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-      SocketServer.ThreadingUDPServer.__init__(
-          self, (host, port), UdpDnsHandler)
+      self.socket.bind((host, port))
     except socket.error, (error_number, msg):
+      self.socket.close()
       if error_number == errno.EACCES:
         raise DnsProxyException(
             'Unable to bind DNS server on (%s:%s)' % (host, port))
       raise
-    self.dns_lookup = dns_lookup or (lambda host: self.server_address[0])
+    self.socket.setblocking(False)
+    self.server_address = self.socket.getsockname()
     self.server_port = self.server_address[1]
+    self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+      self.tcp_socket.bind((host, self.server_port))
+    except socket.error, (error_number, msg):
+      self.socket.close()
+      self.tcp_socket.close()
+      raise DnsProxyException(
+          'Unable to bind DNS server on TCP (%s:%s): %s' % (
+              host, self.server_port, msg))
+    self.tcp_socket.listen(TCP_LISTEN_BACKLOG)
+    self.tcp_socket.setblocking(False)
+    self.tcp_connections = {}  # {socket: _TcpDnsConnection}
+    # [(send_time, sequence_number, connection, response, client_address)]
+    self._delayed_responses = []
+    self._delayed_response_count = 0
+    self.dns_lookup = dns_lookup or ReplayDnsLookup(self.server_address[0])
+    # Lookup threads take (connection, query, client_address) from
+    # _lookup_queue and put (connection, response, client_address, delay_ms)
+    # in _lookup_results. A datagram to _wakeup_socket wakes up select().
+    self._lookup_queue = Queue.Queue()
+    self._lookup_results = Queue.Queue()
+    self._wakeup_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._wakeup_socket.bind(('127.0.0.1', 0))
+    self._wakeup_socket.setblocking(False)
+    self._lookup_threads = []
+    for _ in xrange(num_lookup_threads):
+      thread = threading.Thread(target=self._LookUpQueries)
+      thread.daemon = True
+      thread.start()
+      self._lookup_threads.append(thread)
+    self.ipv6_addresses = {}  # {IPv4 address: IPv6 address}
+    if ipv6_host:
+      self.ipv6_addresses[self.server_address[0]] = ipv6_host
+      if host:
+        self.ipv6_addresses[host] = ipv6_host
+    self.answer_records = {}  # {(rdtype, ip): answer record}
+    self._shutdown_request = False
+    self._is_shut_down = threading.Event()
+    self._is_shut_down.set()
     logging.warning('DNS server started on %s:%d', self.server_address[0],
                                                    self.server_address[1])
 
+  def serve_forever(self, poll_interval=0.5):
+    """Handle queries until shutdown() is called."""
+    self._is_shut_down.clear()
+    try:
+      while not self._shutdown_request:
+        timeout = poll_interval
+        if self._delayed_responses:
+          timeout = max(0, min(
+              timeout, self._delayed_responses[0][0] - time.time()))
+        connections = self.tcp_connections.values()
+        readable, writable, _ = select.select(
+            [self.socket, self.tcp_socket, self._wakeup_socket] +
+            [c.socket for c in connections if not c.is_read_closed],
+            [c.socket for c in connections if c.write_buffer],
+            [], timeout)
+        self._SendDueResponses()
+        self._SendLookupResults()
+        for sock in readable:
+          if sock is self.socket:
+            self._HandleUdpQueries()
+          elif sock is self._wakeup_socket:
+            self._ClearWakeups()
+          elif sock is self.tcp_socket:
+            self._AcceptTcpConnections()
+          elif sock in self.tcp_connections:
+            self._ReadTcpQueries(self.tcp_connections[sock])
+        for sock in writable:
+          if sock in self.tcp_connections:
+            self._WriteTcpResponses(self.tcp_connections[sock])
+    finally:
+      self._shutdown_request = False
+      self._is_shut_down.set()
+
+  def _HandleUdpQueries(self):
+    """Answer every query that is waiting on the UDP socket."""
+    while True:
+      try:
+        data, client_address = self.socket.recvfrom(MAX_UDP_PACKET_SIZE)
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          return
+        if e.args[0] == errno.ECONNREFUSED:
+          continue  # A client closed its socket before a previous answer.
+        raise
+      self._AnswerQuery(None, data, client_address)
+
+  def _IsAnswerReady(self, data):
+    """Return True if the query in |data| can be answered without blocking."""
+    is_answer_ready = getattr(self.dns_lookup, 'IsAnswerReady', None)
+    if not is_answer_ready:
+      return False
+    try:
+      domain = ParseQuery(data)[1]
+    except IndexError:
+      return True  # Malformed queries are dropped without a lookup.
+    return domain is None or is_answer_ready(domain)
+
+  def _AnswerQuery(self, connection, data, client_address):
+    """Answer a query now, or on a lookup thread if the lookup may block.
+
+    Args:
+      connection: a _TcpDnsConnection, or None to answer over UDP.
+      data: the query packet.
+      client_address: the address of the client.
+    """
+    if self._IsAnswerReady(data):
+      response, delay_ms = self._HandleQuerySafely(data, client_address)
+      if response:
+        self._SendResponse(connection, response, client_address, delay_ms)
+    else:
+      if connection:
+        connection.pending_answers += 1
+      self._lookup_queue.put((connection, data, client_address))
+
+  def _LookUpQueries(self):
+    """Answer queries from the lookup queue until None is received."""
+    while True:
+      item = self._lookup_queue.get()
+      if item is None:
+        return
+      connection, data, client_address = item
+      response, delay_ms = self._HandleQuerySafely(data, client_address)
+      self._lookup_results.put((connection, response, client_address,
+                                delay_ms))
+      try:
+        self._wakeup_socket.sendto('\0', self._wakeup_socket.getsockname())
+      except socket.error:
+        pass  # The socket thread still sends the result within poll_interval.
+
+  def _ClearWakeups(self):
+    while True:
+      try:
+        self._wakeup_socket.recv(MAX_UDP_PACKET_SIZE)
+      except socket.error:
+        return
+
+  def _SendLookupResults(self):
+    """Send the answers that the lookup threads have resolved."""
+    while True:
+      try:
+        connection, response, client_address, delay_ms = (
+            self._lookup_results.get_nowait())
+      except Queue.Empty:
+        return
+      if connection:
+        connection.pending_answers -= 1
+      if response:
+        self._SendResponse(connection, response, client_address, delay_ms)
+      elif connection:
+        self._CloseTcpConnectionIfDone(connection)
+
+  def _HandleQuerySafely(self, data, client_address):
+    try:
+      return self.HandleQuery(data)
+    except Exception:
+      logging.exception('dnsproxy: unable to handle query from %s',
+                        client_address)
+      return None, 0
+
+  def _SendResponse(self, connection, response, client_address, delay_ms=0):
+    """Send a response now or schedule it to be sent after |delay_ms|.
+
+    Args:
+      connection: a _TcpDnsConnection, or None to answer over UDP.
+      response: the response packet.
+      client_address: the address of the client.
+      delay_ms: the simulated lookup delay in milliseconds.
+    """
+    if delay_ms > 0:
+      if connection:
+        connection.pending_answers += 1
+      self._delayed_response_count += 1
+      heapq.heappush(self._delayed_responses, (
+          time.time() + delay_ms / 1000.0, self._delayed_response_count,
+          connection, response, client_address))
+    elif connection is None:
+      try:
+        self.socket.sendto(response, client_address)
+      except socket.error, e:
+        logging.debug('dnsproxy: unable to answer %s: %s', client_address, e)
+    elif connection.socket in self.tcp_connections:
+      connection.write_buffer += struct.pack('!H', len(response)) + response
+      self._WriteTcpResponses(connection)
+
+  def _SendDueResponses(self):
+    """Send the delayed responses whose time has come."""
+    now = time.time()
+    while self._delayed_responses and self._delayed_responses[0][0] <= now:
+      _, _, connection, response, client_address = heapq.heappop(
+          self._delayed_responses)
+      if connection:
+        connection.pending_answers -= 1
+      self._SendResponse(connection, response, client_address)
+
+  def _AcceptTcpConnections(self):
+    while True:
+      try:
+        sock, address = self.tcp_socket.accept()
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR,
+                         errno.ECONNABORTED):
+          return
+        raise
+      sock.setblocking(False)
+      self.tcp_connections[sock] = _TcpDnsConnection(sock, address)
+
+  def _CloseTcpConnection(self, connection):
+    del self.tcp_connections[connection.socket]
+    connection.socket.close()
+
+  def _CloseTcpConnectionIfDone(self, connection):
+    if connection.IsDone() and connection.socket in self.tcp_connections:
+      self._CloseTcpConnection(connection)
+
+  def _ReadTcpQueries(self, connection):
+    """Read from a TCP connection and answer all complete queries."""
+    try:
+      data = connection.socket.recv(MAX_UDP_PACKET_SIZE)
+    except socket.error, e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        return
+      self._CloseTcpConnection(connection)
+      return
+    if not data:
+      # The client is done sending; answer the queries it already sent.
+      connection.is_read_closed = True
+      self._CloseTcpConnectionIfDone(connection)
+      return
+    connection.read_buffer += data
+    for query in connection.PopQueries():
+      self._AnswerQuery(connection, query, connection.address)
+
+  def _WriteTcpResponses(self, connection):
+    try:
+      sent = connection.socket.send(connection.write_buffer)
+    except socket.error, e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        return
+      logging.debug('dnsproxy: unable to answer %s: %s',
+                    connection.address, e)
+      self._CloseTcpConnection(connection)
+      return
+    connection.write_buffer = connection.write_buffer[sent:]
+    self._CloseTcpConnectionIfDone(connection)
+
+  def HandleQuery(self, data):
+    """Resolve a query packet.
+
+    Args:
+      data: the query packet as a string.
+    Returns:
+      (response, delay_ms)
+        response: the response packet (or None to drop the query).
+        delay_ms: how long to wait before sending the response.
+    """
+    try:
+      opcode, domain, rdtype, question = ParseQuery(data)
+    except IndexError:
+      logging.debug('dnsproxy: dropping malformed query')
+      return None, 0
+    transaction_id = data[:2]
+    if domain is None:
+      logging.debug('DNS request with non-zero operation code: %s', opcode)
+      return (transaction_id + chr(0x80 | opcode << 3) + '\x04' +
+              '\x00' * 8), 0  # NOTIMP
+    ip = self.dns_lookup(domain)
+    delay_ms = 0
+    if hasattr(self.dns_lookup, 'GetDelayMs'):
+      delay_ms = self.dns_lookup.GetDelayMs(domain)
+    if ip is None:
+      logging.debug('dnsproxy: %s -> NXDOMAIN', domain)
+      return (transaction_id +
+              '\x85\x83'  # response, authoritative, NXDOMAIN
+              '\x00\x01\x00\x00\x00\x00\x00\x00' +  # 1 question
+              question), delay_ms
+    if rdtype == dns.rdatatype.AAAA:
+      ip = self.ipv6_addresses.get(ip)
+    elif rdtype != dns.rdatatype.A:
+      ip = None
+    if ip is None:
+      logging.debug('dnsproxy: %s (type %d) -> NODATA', domain, rdtype)
+      return (transaction_id +
+              '\x85\x80'  # response, authoritative, no error
+              '\x00\x01\x00\x00\x00\x00\x00\x00' +  # 1 question
+              question), delay_ms
+    if ip == self.server_address[0] or ip in self.ipv6_addresses.values():
+      logging.debug('dnsproxy: %s -> %s (replay web proxy)', domain, ip)
+    else:
+      logging.debug('dnsproxy: %s -> %s', domain, ip)
+    return (transaction_id +
+            '\x81\x80'  # standard query response, no error
+            '\x00\x01\x00\x01\x00\x00\x00\x00' +  # 1 question, 1 answer
+            question +
+            self._GetAnswerRecord(rdtype, ip)), delay_ms
+
+  def _GetAnswerRecord(self, rdtype, ip):
+    """Return the answer resource record for |ip| as packed on the wire."""
+    record = self.answer_records.get((rdtype, ip))
+    if record is None:
+      if rdtype == dns.rdatatype.AAAA:
+        address = socket.inet_pton(socket.AF_INET6, ip)
+      else:
+        address = socket.inet_aton(ip)
+      record = (
+          '\xc0\x0c' +        # pointer to domain name
+          struct.pack('!HHIH',
+                      rdtype,  # resource record type
+                      1,       # class of the data (IN)
+                      60,      # ttl (seconds)
+                      len(address)) +
+          address)
+      self.answer_records[(rdtype, ip)] = record
+    return record
+
+  def shutdown(self):
+    """Stop serve_forever and wait for it to return."""
+    self._shutdown_request = True
+    self._is_shut_down.wait()
+
   def cleanup(self):
     try:
       self.shutdown()
     except KeyboardInterrupt, e:
       pass
+    for _ in self._lookup_threads:
+      self._lookup_queue.put(None)
+    # Lookups that wait for a name server are not waited for; the threads
+    # are daemons.
+    deadline = time.time() + 1
+    for thread in self._lookup_threads:
+      thread.join(max(0, deadline - time.time()))
+    for connection in self.tcp_connections.values():
+      self._CloseTcpConnection(connection)
+    self.tcp_socket.close()
+    self.socket.close()
+    self._wakeup_socket.close()
     logging.info('Stopped DNS server')
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the throughput and latency of the DNS proxy.
+
+Starts a DnsProxyServer on localhost (unless --server is given) and sends
+bursts of queries from several client sockets. Every client keeps --window
+queries in flight, similar to a browser resolving the hosts of a page.
+
+Usage:
+  ./dnsproxy_benchmark.py --clients 8 --queries 20000
+"""
+
+import logging
+import optparse
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+import dnsproxy
+import third_party
+import dns.message
+
+
+def _Percentile(sorted_values, percent):
+  if not sorted_values:
+    return 0
+  index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+  return sorted_values[index]
+
+
+def _RunClient(server_address, domains, num_queries, window, latencies):
+  """Send |num_queries| queries keeping |window| of them in flight."""
+  client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  queries = [dns.message.make_query(d, 'A').to_wire() for d in domains]
+  send_times = {}
+  sent = 0
+  client_latencies = []
+  while len(client_latencies) < num_queries:
+    while sent < num_queries and len(send_times) < window:
+      query_id = sent % 65536
+      query = queries[sent % len(queries)]
+      send_times[query_id] = time.time()
+      client.sendto(struct.pack('!H', query_id) + query[2:], server_address)
+      sent += 1
+    readable, _, _ = select.select([client], [], [], 1.0)
+    if not readable:
+      logging.warning('Lost %d queries', len(send_times))
+      num_queries -= len(send_times)
+      send_times.clear()
+      continue
+    response = client.recv(dnsproxy.MAX_UDP_PACKET_SIZE)
+    query_id = struct.unpack('!H', response[:2])[0]
+    send_time = send_times.pop(query_id, None)
+    if send_time is not None:
+      client_latencies.append((time.time() - send_time) * 1000.0)
+  client.close()
+  latencies.extend(client_latencies)
+
+
+def RunBenchmark(server_address, num_clients, num_queries, window, domains):
+  """Return (queries per second, [latency_ms, ...])."""
+  latencies = []
+  threads = [threading.Thread(
+      target=_RunClient,
+      args=(server_address, domains, num_queries // num_clients, window,
+            latencies)) for _ in xrange(num_clients)]
+  start_time = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.time() - start_time
+  return len(latencies) / elapsed, sorted(latencies)
+
+
+def main():
+  option_parser = optparse.OptionParser(
+      usage='%prog [options]', description=__doc__)
+  option_parser.add_option('--server', default=None,
+      action='store',
+      type='string',
+      help='Benchmark a running DNS server at HOST:PORT instead of starting '
+           'one.')
+  option_parser.add_option('--clients', default=8,
+      action='store',
+      type='int',
+      help='Number of concurrent client sockets.')
+  option_parser.add_option('--queries', default=20000,
+      action='store',
+      type='int',
+      help='Total number of queries.')
+  option_parser.add_option('--window', default=16,
+      action='store',
+      type='int',
+      help='Queries in flight per client.')
+  option_parser.add_option('--hosts', default=100,
+      action='store',
+      type='int',
+      help='Number of distinct hostnames to query.')
+  options, args = option_parser.parse_args()
+  if args:
+    option_parser.error('Unexpected arguments: %s' % args)
+  logging.basicConfig(level=logging.ERROR)
+
+  domains = ['host%d.example.com.' % i for i in xrange(options.hosts)]
+  server = None
+  if options.server:
+    host, port = options.server.rsplit(':', 1)
+    server_address = (host, int(port))
+  else:
+    server = dnsproxy.DnsProxyServer('127.0.0.1', 0)
+    server.__enter__()
+    server_address = server.server_address
+  try:
+    qps, latencies = RunBenchmark(server_address, options.clients,
+                                  options.queries, options.window, domains)
+  finally:
+    if server:
+      server.__exit__(None, None, None)
+  print 'queries: %d' % len(latencies)
+  print 'queries/sec: %.0f' % qps
+  for percent in (50, 90, 99):
+    print 'p%d: %.2fms' % (percent, _Percentile(latencies, percent))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
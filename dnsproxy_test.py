@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import dnsproxy
+import httparchive
+import third_party
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.resolver
+
+
+class FakeAnswer(list):
+
+  def __init__(self, ip, ttl, now):
+    list.__init__(self, [ip])
+    self.expiration = now + ttl
+
+
+class FakeResolver(object):
+  """Answer queries from a dict of {hostname: (ip, ttl)}."""
+
+  def __init__(self, answers, clock=time.time):
+    self.answers = answers
+    self.clock = clock
+    self.queries = []
+    self.lock = threading.Lock()
+    self.release = threading.Event()
+    self.release.set()
+
+  def query(self, hostname, rdtype):
+    with self.lock:
+      self.queries.append(hostname)
+    self.release.wait()
+    if hostname not in self.answers:
+      raise dns.resolver.NXDOMAIN()
+    ip, ttl = self.answers[hostname]
+    return FakeAnswer(ip, ttl, self.clock())
+
+
+class RealDnsLookupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.time = 1000.0
+    clock = lambda: self.time
+    self.resolver = FakeResolver({
+        'a.com.': ('1.1.1.1', 300),
+        'short.com.': ('2.2.2.2', 0),
+        }, clock)
+    self.dns_lookup = dnsproxy.RealDnsLookup(
+        name_servers=['8.8.8.8'], min_ttl_seconds=60, negative_ttl_seconds=60,
+        clock=clock)
+    self.dns_lookup.resolver = self.resolver
+
+  def test_answer_is_cached_until_ttl_expires(self):
+    self.assertEqual('1.1.1.1', self.dns_lookup('a.com.'))
+    self.time += 299
+    self.assertEqual('1.1.1.1', self.dns_lookup('a.com.'))
+    self.assertEqual(['a.com.'], self.resolver.queries)
+    self.time += 2
+    self.assertEqual('1.1.1.1', self.dns_lookup('a.com.'))
+    self.assertEqual(['a.com.', 'a.com.'], self.resolver.queries)
+
+  def test_short_ttl_is_raised_to_min_ttl(self):
+    self.dns_lookup('short.com.')
+    self.time += 59
+    self.dns_lookup('short.com.')
+    self.assertEqual(1, len(self.resolver.queries))
+    self.time += 2
+    self.dns_lookup('short.com.')
+    self.assertEqual(2, len(self.resolver.queries))
+
+  def test_trailing_dot_shares_cache_entry(self):
+    self.dns_lookup('a.com.')
+    self.dns_lookup('a.com')
+    self.assertEqual(1, len(self.resolver.queries))
+
+  def test_failed_lookup_is_cached(self):
+    self.assertEqual(None, self.dns_lookup('missing.com.'))
+    self.assertEqual(None, self.dns_lookup('missing.com.'))
+    self.assertEqual(1, len(self.resolver.queries))
+    self.time += 61
+    self.assertEqual(None, self.dns_lookup('missing.com.'))
+    self.assertEqual(2, len(self.resolver.queries))
+    self.assertEqual(1, self.dns_lookup.GetStats()['negative_hits'])
+
+  def test_concurrent_lookups_share_query(self):
+    self.resolver.release.clear()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        self.dns_lookup('a.com.'))) for _ in range(5)]
+    for thread in threads:
+      thread.start()
+    while not self.resolver.queries:
+      time.sleep(0.001)
+    self.resolver.release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(['1.1.1.1'] * 5, results)
+    self.assertEqual(['a.com.'], self.resolver.queries)
+    stats = self.dns_lookup.GetStats()
+    self.assertEqual(1, stats['misses'])
+    self.assertEqual(4, stats['coalesced'] + stats['hits'])
+
+  def test_prefetch_fills_cache(self):
+    self.dns_lookup.Prefetch(['a.com.', 'short.com.', 'a.com.'])
+    self.assertEqual(['a.com.', 'short.com.'], sorted(self.resolver.queries))
+    self.dns_lookup('a.com.')
+    self.assertEqual(1, self.dns_lookup.GetStats()['hits'])
+
+  def test_clear_cache(self):
+    self.dns_lookup('a.com.')
+    self.dns_lookup.ClearCache()
+    self.dns_lookup('a.com.')
+    self.assertEqual(2, len(self.resolver.queries))
+
+  def test_lookup_times_are_recorded(self):
+    def SlowQuery(hostname, rdtype):
+      self.time += 0.025
+      return FakeAnswer('1.1.1.1', 300, self.time)
+    self.resolver.query = SlowQuery
+    self.dns_lookup('a.com.')
+    self.dns_lookup('a.com.')
+    self.assertEqual(['a.com'], self.dns_lookup.GetLookupTimes().keys())
+    self.assertAlmostEqual(
+        25, self.dns_lookup.GetLookupTimes()['a.com'], places=3)
+
+  def test_ip_address_is_not_looked_up(self):
+    self.assertEqual('10.0.0.1', self.dns_lookup('10.0.0.1'))
+    self.assertEqual([], self.resolver.queries)
+
+
+class DnsProxyServerTest(unittest.TestCase):
+
+  def setUp(self):
+    hosts = {'a.com.': '1.2.3.4', 'b.com.': '5.6.7.8',
+             'replay.com.': '127.0.0.1'}
+    self.server = dnsproxy.DnsProxyServer(
+        '127.0.0.1', 0, dns_lookup=hosts.get, ipv6_host='::1')
+    self.server.__enter__()
+    self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.client.settimeout(2)
+
+  def tearDown(self):
+    self.client.close()
+    self.server.__exit__(None, None, None)
+
+  def query(self, domain, rdtype='A'):
+    query = dns.message.make_query(domain, rdtype)
+    self.client.sendto(query.to_wire(), self.server.server_address)
+    response = dns.message.from_wire(self.client.recv(512))
+    self.assertEqual(query.id, response.id)
+    return response
+
+  def test_answers_query(self):
+    response = self.query('a.com.')
+    self.assertEqual(dns.rcode.NOERROR, response.rcode())
+    self.assertEqual(['1.2.3.4'], [str(r) for r in response.answer[0]])
+    self.assertEqual('a.com.', str(response.answer[0].name))
+
+  def test_unknown_host_gets_nxdomain(self):
+    response = self.query('missing.com.')
+    self.assertEqual(dns.rcode.NXDOMAIN, response.rcode())
+    self.assertEqual([], response.answer)
+    self.assertEqual('missing.com.', str(response.question[0].name))
+
+  def test_replay_host_gets_ipv6_address(self):
+    response = self.query('replay.com.', 'AAAA')
+    self.assertEqual(dns.rdatatype.AAAA, response.answer[0].rdtype)
+    self.assertEqual(['::1'], [str(r) for r in response.answer[0]])
+
+  def test_aaaa_without_ipv6_address_gets_nodata(self):
+    response = self.query('a.com.', 'AAAA')
+    self.assertEqual(dns.rcode.NOERROR, response.rcode())
+    self.assertEqual([], response.answer)
+
+  def test_other_types_get_nodata(self):
+    response = self.query('a.com.', 'MX')
+    self.assertEqual(dns.rcode.NOERROR, response.rcode())
+    self.assertEqual([], response.answer)
+    response = self.query('missing.com.', 'MX')
+    self.assertEqual(dns.rcode.NXDOMAIN, response.rcode())
+
+  def test_burst_of_queries(self):
+    domains = ['a.com.', 'b.com.'] * 50
+    for index, domain in enumerate(domains):
+      query = dns.message.make_query(domain, 'A')
+      query.id = index
+      self.client.sendto(query.to_wire(), self.server.server_address)
+    answers = {}
+    for _ in domains:
+      response = dns.message.from_wire(self.client.recv(512))
+      answers[response.id] = str(response.answer[0][0])
+    self.assertEqual(
+        [{'a.com.': '1.2.3.4', 'b.com.': '5.6.7.8'}[d] for d in domains],
+        [answers[i] for i in range(len(domains))])
+
+  def test_pipelined_tcp_queries(self):
+    tcp_client = socket.create_connection(self.server.server_address, 2)
+    try:
+      data = ''
+      for index, domain in enumerate(['a.com.', 'missing.com.', 'b.com.']):
+        query = dns.message.make_query(domain, 'A')
+        query.id = index
+        wire = query.to_wire()
+        data += struct.pack('!H', len(wire)) + wire
+      # Split the queries at an arbitrary point to exercise buffering.
+      tcp_client.sendall(data[:5])
+      time.sleep(0.01)
+      tcp_client.sendall(data[5:])
+      responses = []
+      buf = ''
+      while len(responses) < 3:
+        buf += tcp_client.recv(4096)
+        while len(buf) >= 2:
+          length = struct.unpack('!H', buf[:2])[0]
+          if len(buf) < 2 + length:
+            break
+          responses.append(dns.message.from_wire(buf[2:2 + length]))
+          buf = buf[2 + length:]
+    finally:
+      tcp_client.close()
+    self.assertEqual([0, 1, 2], [r.id for r in responses])
+    self.assertEqual('1.2.3.4', str(responses[0].answer[0][0]))
+    self.assertEqual(dns.rcode.NXDOMAIN, responses[1].rcode())
+    self.assertEqual('5.6.7.8', str(responses[2].answer[0][0]))
+
+  def test_slow_lookup_does_not_delay_other_queries(self):
+    resolver = FakeResolver({'slow.com.': ('10.0.0.1', 300)})
+    resolver.release.clear()  # Block real lookups until released.
+    real_dns_lookup = dnsproxy.RealDnsLookup(name_servers=['8.8.8.8'])
+    real_dns_lookup.resolver = resolver
+    archive = httparchive.HttpArchive()
+    archive[httparchive.ArchivedHttpRequest(
+        'GET', 'archived.com:443', '/', None, {})] = (
+            httparchive.create_response(200))
+    dns_lookup = dnsproxy.ReplayDnsLookup(
+        '127.0.0.1', [dnsproxy.PrivateIpFilter(real_dns_lookup, archive)])
+    server = dnsproxy.DnsProxyServer('127.0.0.1', 0, dns_lookup=dns_lookup)
+    server.__enter__()
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(2)
+    try:
+      for index, domain in enumerate(['slow.com.', 'archived.com.']):
+        query = dns.message.make_query(domain, 'A')
+        query.id = index
+        client.sendto(query.to_wire(), server.server_address)
+      first_response = dns.message.from_wire(client.recv(512))
+      resolver.release.set()
+      second_response = dns.message.from_wire(client.recv(512))
+    finally:
+      resolver.release.set()
+      client.close()
+      server.__exit__(None, None, None)
+    self.assertEqual((1, '127.0.0.1'),
+                     (first_response.id, str(first_response.answer[0][0])))
+    self.assertEqual((0, '10.0.0.1'),
+                     (second_response.id, str(second_response.answer[0][0])))
+
+  def test_malformed_query_is_dropped(self):
+    self.client.sendto('\x00\x01\x00\x00\x00\x01\x00\x00\x00\x00'
+                       '\x00\x00\x05ab', self.server.server_address)
+    self.assertEqual(['1.2.3.4'],
+                     [str(r) for r in self.query('a.com.').answer[0]])
+
+
+class PrivateIpFilterTest(unittest.TestCase):
+
+  def test_archive_hosts_without_ports(self):
+    archive = httparchive.HttpArchive()
+    for host in ('a.com', 'b.com:8080', '[2001:db8::1]:443'):
+      archive[httparchive.ArchivedHttpRequest('GET', host, '/', None, {})] = (
+          httparchive.create_response(200))
+    private_ip_filter = dnsproxy.PrivateIpFilter(None, archive)
+    self.assertEqual(set(['a.com.', 'b.com.', '2001:db8::1.']),
+                     private_ip_filter.archive_hosts)
+
+
+class DelayFilterTest(unittest.TestCase):
+
+  def test_delay_only_in_replay_mode(self):
+    delay_filter = dnsproxy.DelayFilter(is_record_mode=False, delay_ms='50')
+    self.assertEqual('1.2.3.4', delay_filter('a.com.', default_ip='1.2.3.4'))
+    self.assertEqual(50, delay_filter.GetDelayMs('a.com.'))
+    delay_filter.SetRecordMode()
+    self.assertEqual(0, delay_filter.GetDelayMs('a.com.'))
+
+  def test_recorded_delays(self):
+    archive = httparchive.HttpArchive()
+    archive.dns_timings = {'a.com': 10.0, 'b.com': 30.0}
+    delay_filter = dnsproxy.RecordedDelayFilter(False, archive, scale=2)
+    self.assertEqual(20, delay_filter.GetDelayMs('a.com.'))
+    self.assertEqual(60, delay_filter.GetDelayMs('b.com.'))
+    # Unrecorded hosts get a recorded time, the same one on every call.
+    delay_ms = delay_filter.GetDelayMs('other.com.')
+    self.assertTrue(delay_ms in (20, 60))
+    self.assertEqual(delay_ms, delay_filter.GetDelayMs('other.com.'))
+    delay_filter.SetRecordMode()
+    self.assertEqual(0, delay_filter.GetDelayMs('a.com.'))
+
+  def test_recorded_delays_without_timings(self):
+    delay_filter = dnsproxy.RecordedDelayFilter(
+        False, httparchive.HttpArchive())
+    self.assertEqual(0, delay_filter.GetDelayMs('a.com.'))
+
+  def test_half_closed_tcp_connection_gets_delayed_answers(self):
+    dns_lookup = dnsproxy.ReplayDnsLookup(
+        '127.0.0.1', [dnsproxy.DelayFilter(False, 100)])
+    server = dnsproxy.DnsProxyServer('127.0.0.1', 0, dns_lookup=dns_lookup)
+    server.__enter__()
+    tcp_client = socket.create_connection(server.server_address, 2)
+    try:
+      data = ''
+      for index in range(2):
+        query = dns.message.make_query('host%d.com.' % index, 'A')
+        query.id = index
+        wire = query.to_wire()
+        data += struct.pack('!H', len(wire)) + wire
+      tcp_client.sendall(data)
+      tcp_client.shutdown(socket.SHUT_WR)
+      buf = ''
+      while True:
+        received = tcp_client.recv(4096)
+        if not received:
+          break  # Closed by the server after the answers.
+        buf += received
+    finally:
+      tcp_client.close()
+      server.__exit__(None, None, None)
+    responses = []
+    while buf:
+      length = struct.unpack('!H', buf[:2])[0]
+      responses.append(dns.message.from_wire(buf[2:2 + length]))
+      buf = buf[2 + length:]
+    self.assertEqual([0, 1], sorted(r.id for r in responses))
+    self.assertEqual(['127.0.0.1', '127.0.0.1'],
+                     [str(r.answer[0][0]) for r in responses])
+
+  def test_concurrent_queries_are_delayed_concurrently(self):
+    delay_ms = 100
+    dns_lookup = dnsproxy.ReplayDnsLookup(
+        '127.0.0.1', [dnsproxy.DelayFilter(False, delay_ms)])
+    server = dnsproxy.DnsProxyServer('127.0.0.1', 0, dns_lookup=dns_lookup)
+    server.__enter__()
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(2)
+    try:
+      num_queries = 50
+      send_times = {}
+      for index in range(num_queries):
+        query = dns.message.make_query('host%d.com.' % index, 'A')
+        query.id = index
+        send_times[index] = time.time()
+        client.sendto(query.to_wire(), server.server_address)
+      delays_ms = []
+      for _ in range(num_queries):
+        response = dns.message.from_wire(client.recv(512))
+        delays_ms.append((time.time() - send_times[response.id]) * 1000.0)
+    finally:
+      client.close()
+      server.__exit__(None, None, None)
+    delays_ms.sort()
+    self.assertTrue(delays_ms[0] >= delay_ms * 0.95, delays_ms[0])
+    # With blocking delays the last answer would take num_queries * delay_ms.
+    self.assertTrue(delays_ms[-1] < delay_ms * 2, delays_ms[-1])
+    self.assertTrue(delays_ms[len(delays_ms) // 2] < delay_ms * 1.2,
+                    delays_ms[len(delays_ms) // 2])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -48,6 +48,7 @@ import httplib
 import httpzlib
 import json
 import logging
+import multiprocessing
 import optparse
 import os
 import persistentmixin
@@ -55,6 +56,7 @@ import StringIO
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import urlparse
 from collections import defaultdict
@@ -72,6 +74,114 @@ def LogRunTime(fn):
   return wrapped
 
 
+# Formatted HTTP dates by epoch second (see _format_date).
+_formatted_dates = {}
+MAX_FORMATTED_DATES = 4096
+
+
+def _format_date(seconds):
+  """Return the HTTP date of epoch |seconds|, cached per second."""
+  seconds = int(seconds)
+  date_str = _formatted_dates.get(seconds)
+  if date_str is None:
+    if len(_formatted_dates) >= MAX_FORMATTED_DATES:
+      _formatted_dates.clear()
+    date_str = email.utils.formatdate(seconds, usegmt=True)
+    _formatted_dates[seconds] = date_str
+  return date_str
+
+
+# Epoch seconds of HTTP dates by date string (see _parse_date).
+_parsed_dates = {}
+MAX_PARSED_DATES = 4096
+
+
+def _parse_date(date_str):
+  """Return the epoch seconds of HTTP date |date_str| or None, cached."""
+  try:
+    return _parsed_dates[date_str]
+  except KeyError:
+    pass
+  if len(_parsed_dates) >= MAX_PARSED_DATES:
+    _parsed_dates.clear()
+  date_tuple = email.utils.parsedate(date_str)
+  seconds = calendar.timegm(date_tuple) if date_tuple else None
+  _parsed_dates[date_str] = seconds
+  return seconds
+
+
+# Shared responses of conditional requests by status (see
+# _get_conditional_response). They must not be modified.
+_conditional_responses = {}
+
+
+def _get_conditional_response(status):
+  """Return the shared response for a 304 or 412 |status|."""
+  response = _conditional_responses.get(status)
+  if response is None:
+    response = _conditional_responses.setdefault(
+        status, create_response(status))
+  return response
+
+
+# Replay clock (see set_replay_clock).
+_replay_time = None
+_replay_time_shift = 0
+
+
+def set_replay_clock(replay_time=None, time_shift=0):
+  """Set the clock that replayed response dates are relative to.
+
+  Args:
+    replay_time: fixed epoch seconds of the replay (e.g. the recording time
+        from HttpArchive.get_recording_time), or None for the real time.
+    time_shift: seconds added to the replay time.
+  """
+  global _replay_time, _replay_time_shift
+  _replay_time = replay_time
+  _replay_time_shift = time_shift
+
+
+def get_replay_time():
+  """Return the epoch seconds of the replay clock."""
+  if _replay_time is None:
+    return time.time() + _replay_time_shift
+  return _replay_time + _replay_time_shift
+
+
+def get_replay_date():
+  """Return the "Date" header value of the replay clock."""
+  return _format_date(get_replay_time())
+
+
+def split_host_port(host):
+  """Split a request host into its host name and port.
+
+  IPv6 literals are written in brackets (e.g. "[::1]:8080"); the brackets
+  are removed from the host name.
+
+  Args:
+    host: a host string (e.g. "www.example.com" or "www.example.com:8080").
+  Returns:
+    (host name, port string or None)
+  """
+  if host.startswith('['):
+    end = host.find(']')
+    if end != -1:
+      port = host[end + 1:]
+      return host[1:end], port[1:] if port.startswith(':') else None
+  if host.count(':') == 1:
+    hostname, port = host.split(':')
+    return hostname, port
+  return host, None
+
+
+def _generate_cert_for_pool(args):
+  """Call certutils.generate_cert in a worker process."""
+  host = args[2]
+  return host, certutils.generate_cert(*args)
+
+
 class HttpArchiveException(Exception):
   """Base class for all exceptions in httparchive."""
   pass
@@ -90,10 +200,19 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
         in sync with the underlying dict of self. It is used as an optimization
         so that get_requests() doesn't have to linearly search all requests in
         the archive to find potential matches.
+    dns_timings: dict of {hostname: lookup_ms} with the time it took to
+        resolve each archived host (without port) during record.
+    cert_store: a certstore.CertificateStore to share generated host
+        certificates with other archives and runs (or None). It is not
+        pickled.
   """
 
   def __init__(self):
     self.responses_by_host = defaultdict(dict)
+    self.dns_timings = {}
+    self.cert_store = None
+    self._index_lock = threading.Lock()
+    self._reset_indexes()
 
   def __setstate__(self, state):
     """Influence how to unpickle.
@@ -101,10 +220,16 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
     Args:
       state: a dictionary for __dict__
     """
+    if 'dns_timings' not in state:
+      state['dns_timings'] = {}
     self.__dict__.update(state)
     self.responses_by_host = defaultdict(dict)
+    self.cert_store = None
+    self._index_lock = threading.Lock()
+    self._reset_indexes()
     for request in self:
       self.responses_by_host[request.host][request] = self[request]
+      self._index_request(request)
 
   def __getstate__(self):
     """Influence how to pickle.
@@ -114,16 +239,68 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
     """
     state = self.__dict__.copy()
     del state['responses_by_host']
+    state.pop('cert_store', None)
+    state.pop('_index_lock', None)
+    state.pop('_requests_by_key', None)
+    state.pop('_requests_without_accept_encoding', None)
+    state.pop('_accept_encoding_variants', None)
     return state
 
   def __setitem__(self, key, value):
-    super(HttpArchive, self).__setitem__(key, value)
-    if hasattr(self, 'responses_by_host'):
+    if not hasattr(self, '_index_lock'):
+      # Unpickling sets the items before __setstate__ builds the indexes.
+      super(HttpArchive, self).__setitem__(key, value)
+      return
+    with self._index_lock:
+      super(HttpArchive, self).__setitem__(key, value)
       self.responses_by_host[key.host][key] = value
+      self._index_request(key)
 
   def __delitem__(self, key):
-    super(HttpArchive, self).__delitem__(key)
-    del self.responses_by_host[key.host][key]
+    with self._index_lock:
+      # Unindex first, so that lookups never find a deleted request.
+      self._unindex_request(key)
+      super(HttpArchive, self).__delitem__(key)
+      del self.responses_by_host[key.host][key]
+
+  def clear(self):
+    with self._index_lock:
+      super(HttpArchive, self).clear()
+      self.responses_by_host.clear()
+      self._reset_indexes()
+
+  def _reset_indexes(self):
+    """Empty the request indexes used by the find_request methods."""
+    # {repr: archived request}
+    self._requests_by_key = {}
+    # {repr of request without accept-encoding: archived request}, the
+    # first of the matching archived requests in repr order.
+    self._requests_without_accept_encoding = {}
+    # {repr of request without accept-encoding: {repr: archived request}}
+    self._accept_encoding_variants = {}
+
+  def _index_request(self, request):
+    """Add |request| to the indexes. Must hold the lock when shared."""
+    request_key = repr(request)
+    self._requests_by_key[request_key] = request
+    key = repr(request.create_request_without_accept_encoding())
+    self._accept_encoding_variants.setdefault(key, {})[request_key] = request
+    first_request = self._requests_without_accept_encoding.get(key)
+    if first_request is None or request_key < repr(first_request):
+      self._requests_without_accept_encoding[key] = request
+
+  def _unindex_request(self, request):
+    """Remove |request| from the indexes. Must hold the lock."""
+    request_key = repr(request)
+    key = repr(request.create_request_without_accept_encoding())
+    variants = self._accept_encoding_variants[key]
+    del variants[request_key]
+    del self._requests_by_key[request_key]
+    if not variants:
+      del self._accept_encoding_variants[key]
+      del self._requests_without_accept_encoding[key]
+    elif self._requests_without_accept_encoding[key] == request:
+      self._requests_without_accept_encoding[key] = variants[min(variants)]
 
   def get(self, request, default=None):
     """Return the archived response for a given request.
@@ -138,10 +315,39 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
       Instance of ArchivedHttpResponse or default if no matching
       response is found
     """
-    if request in self:
-      return self[request]
+    archived_request = self.find_request(request)
+    if archived_request:
+      return self[archived_request]
     return self.get_conditional_response(request, default)
 
+  def find_request(self, request):
+    """Return the archived request that matches |request| or None.
+
+    A request that only differs in accept-encoding matches as well, since
+    the replay fetch serves archived bodies in an encoding the client
+    accepts (see httpclient).
+    """
+    if request in self:
+      return request
+    return self._requests_without_accept_encoding.get(
+        repr(request.create_request_without_accept_encoding()))
+
+  def find_request_without_conditions(self, request):
+    """Return the archived request that matches |request| or None.
+
+    This is find_request(request.create_request_without_conditions()),
+    without creating and trimming the stripped request: the keys of the
+    archived requests are indexed as they are added and |request| only
+    filters its trimmed headers (see
+    ArchivedHttpRequest.get_key_without_conditions).
+    """
+    archived_request = self._requests_by_key.get(
+        request.get_key_without_conditions())
+    if archived_request is None:
+      archived_request = self._requests_without_accept_encoding.get(
+          request.get_key_without_conditions(without_accept_encoding=True))
+    return archived_request
+
   def get_conditional_response(self, request, default):
     """Get the response based on the conditional HTTP request headers.
 
@@ -152,24 +358,36 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
 
     Returns:
       an ArchivedHttpResponse with a status of 200, 302 (not modified), or
-          412 (precondition failed)
+          412 (precondition failed). 304 and 412 responses are shared, so
+          they must not be modified.
     """
     response = default
     if request.is_conditional():
-      stripped_request = request.create_request_without_conditions()
-      if stripped_request in self:
+      stripped_request = self.find_request_without_conditions(request)
+      if stripped_request:
         response = self[stripped_request]
         if response.status == 200:
           status = self.get_conditional_status(request, response)
           if status != 200:
-            response = create_response(status)
+            response = _get_conditional_response(status)
     return response
 
+  def get_recording_time(self):
+    """Return the epoch seconds of the earliest "Date" response header.
+
+    Returns None if no response has a valid "Date" header.
+    """
+    recording_time = None
+    for response in self.itervalues():
+      date_seconds = response._get_epoch_seconds(response.get_header('date'))
+      if date_seconds and (recording_time is None or
+                           date_seconds < recording_time):
+        recording_time = date_seconds
+    return recording_time
+
   def get_conditional_status(self, request, response):
     status = 200
-    last_modified = email.utils.parsedate(
-        response.update_date(response.get_header('last-modified')))
-    response_etag = response.get_header('etag')
+    response_etag, last_modified = response.get_validators()
     is_get_or_head = request.command.upper() in ('GET', 'HEAD')
 
     match_value = request.headers.get('if-match', None)
@@ -186,10 +404,10 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
         status = 200
       else:
         status = 412
-    if is_get_or_head and last_modified:
+    if is_get_or_head and last_modified is not None:
       for header in ('if-modified-since', 'if-unmodified-since'):
-        date = email.utils.parsedate(request.headers.get(header, None))
-        if date:
+        date = _parse_date(request.headers.get(header, None))
+        if date is not None:
           if ((header == 'if-modified-since' and last_modified > date) or
               (header == 'if-unmodified-since' and last_modified < date)):
             if status != 412:
@@ -280,6 +498,7 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
     stats['HTTP_response_code'] = defaultdict(int)
     stats['content_type'] = defaultdict(int)
     stats['Documents'] = defaultdict(int)
+    stats['content_encoding'] = defaultdict(int)
 
     for request in matching_requests:
       stats['Domains'][request.host] += 1
@@ -290,6 +509,10 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
       str_content_type = str(content_type.split(';')[0]
                             if content_type else None)
       stats['content_type'][str_content_type] += 1
+      content_encoding = self[request].get_header('content-encoding')
+      if content_encoding and not self[request].is_compressed():
+        content_encoding += ' (unsupported)'
+      stats['content_encoding'][str(content_encoding)] += 1
 
       #  Documents are the main URL requested and not a referenced resource.
       if str_content_type == 'text/html' and not 'referer' in request.headers:
@@ -411,6 +634,17 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
       return '\n'.join(difflib.ndiff(closest_request_lines, request_lines))
     return None
 
+  def record_dns_timings(self, lookup_times):
+    """Save the DNS lookup times of the hosts in the archive.
+
+    Args:
+      lookup_times: dict of {hostname: lookup_ms}
+    """
+    for host in self.responses_by_host:
+      hostname = split_host_port(host)[0]
+      if hostname in lookup_times:
+        self.dns_timings[hostname] = lookup_times[hostname]
+
   def set_root_cert(self, cert_path):
     with open(cert_path, 'r') as cert_file:
       cert_str = cert_file.read()
@@ -431,16 +665,78 @@ class HttpArchive(dict, persistentmixin.PersistentMixin):
       raise KeyError('Root cert is not in the archive')
     return self[request].response_data[0]
 
-  def _generate_cert(self, host):
+  def _generate_cert(self, host, server_cert_str):
     """Generate cert with the SNI field from the real server's response."""
     root_ca_cert_str = self._get_root_cert()
-    return certutils.generate_cert(
-        root_ca_cert_str, self._get_server_cert(host), host)
+    return certutils.generate_cert(root_ca_cert_str, server_cert_str, host)
+
+  def pregenerate_certificates(self, num_processes=None):
+    """Generate the certificates of all SSL hosts in a pool of processes.
+
+    Hosts that already have a certificate in the archive or in the
+    cert_store are skipped. The archived server certificates are used for
+    the common names; unlike get_certificate, no live server is contacted.
+
+    Args:
+      num_processes: the size of the process pool (defaults to the number
+          of CPUs).
+    """
+    start_time = time.time()
+    root_ca_cert_str = self._get_root_cert()
+    hosts = set(split_host_port(r.host)[0] for r in self if r.is_ssl)
+    jobs = []
+    for host in sorted(hosts):
+      request = ArchivedHttpRequest('DUMMY_CERT', host, '', None, {})
+      if request in self:
+        continue
+      server_cert_request = ArchivedHttpRequest(
+          'SERVER_CERT', host, '', None, {})
+      server_cert_str = ''
+      if server_cert_request in self:
+        server_cert_str = self[server_cert_request].response_data[0]
+      if self.cert_store:
+        cert_str = self.cert_store.get_cached_certificate(
+            root_ca_cert_str, host, server_cert_str)
+        if cert_str:
+          self[request] = create_response(200, body=cert_str)
+          continue
+      jobs.append((root_ca_cert_str, server_cert_str, host))
+    logging.info('Generating %d of %d host certificates',
+                 len(jobs), len(hosts))
+    if jobs:
+      server_cert_strs = dict((host, server_cert_str)
+                              for _, server_cert_str, host in jobs)
+      pool = multiprocessing.Pool(num_processes)
+      try:
+        for count, (host, cert_str) in enumerate(
+            pool.imap_unordered(_generate_cert_for_pool, jobs), 1):
+          self[ArchivedHttpRequest('DUMMY_CERT', host, '', None, {})] = (
+              create_response(200, body=cert_str))
+          if self.cert_store:
+            self.cert_store.add_certificate(
+                root_ca_cert_str, host, server_cert_strs[host], cert_str)
+          if count % 100 == 0:
+            logging.info('Generated %d/%d host certificates',
+                         count, len(jobs))
+      finally:
+        pool.close()
+        pool.join()
+    logging.info('Host certificates ready in %dms',
+                 (time.time() - start_time) * 1000.0)
 
   def get_certificate(self, host):
     request = ArchivedHttpRequest('DUMMY_CERT', host, '', None, {})
     if request not in self:
-      self[request] = create_response(200, body=self._generate_cert(host))
+      # Look up the server certificate even if the store has the generated
+      # one, so that the archive can be replayed without the store.
+      server_cert_str = self._get_server_cert(host)
+      if self.cert_store:
+        cert_str = self.cert_store.get_certificate(
+            self._get_root_cert(), host, server_cert_str,
+            lambda: self._generate_cert(host, server_cert_str))
+      else:
+        cert_str = self._generate_cert(host, server_cert_str)
+      self[request] = create_response(200, body=cert_str)
     return self[request].response_data[0]
 
 
@@ -660,7 +956,30 @@ class ArchivedHttpRequest(object):
                             if k.lower() not in self.CONDITIONAL_HEADERS)
     return ArchivedHttpRequest(
         self.command, self.host, self.full_path, self.request_body,
-        stripped_headers, self.is_ssl)
+        stripped_headers, self.is_ssl, repr_path=self.repr_path)
+
+  def get_key_without_conditions(self, without_accept_encoding=False):
+    """Return the repr of the request without its conditional headers.
+
+    This equals repr(self.create_request_without_conditions()), and with
+    |without_accept_encoding| the repr of its
+    create_request_without_accept_encoding(), but only the trimmed headers
+    are filtered.
+    """
+    excluded_headers = self.CONDITIONAL_HEADERS
+    if without_accept_encoding:
+      excluded_headers = excluded_headers + ['accept-encoding']
+    trimmed_headers = [(k, v) for k, v in self.trimmed_headers
+                       if k.lower() not in excluded_headers]
+    return repr((self.command, self.host, self.repr_path, self.request_body,
+                 trimmed_headers, self.is_ssl))
+
+  def create_request_without_accept_encoding(self):
+    stripped_headers = dict((k, v) for k, v in self.headers.iteritems()
+                            if k.lower() != 'accept-encoding')
+    return ArchivedHttpRequest(
+        self.command, self.host, self.full_path, self.request_body,
+        stripped_headers, self.is_ssl, repr_path=self.repr_path)
 
 class ArchivedHttpResponse(object):
   """All the data needed to recreate all HTTP response."""
@@ -704,6 +1023,11 @@ class ArchivedHttpResponse(object):
     self.response_data = response_data
     self.delays = delays
     self.fix_delays()
+    # {(date header, date_str): seconds from the date header or None}
+    self._date_offsets = {}
+    # (etag, last-modified offset, last-modified seconds) or None, see
+    # get_validators.
+    self._validators = None
 
   def fix_delays(self):
     """Initialize delays, or check the number of data delays."""
@@ -750,6 +1074,19 @@ class ArchivedHttpResponse(object):
       state['delays'] = None
     self.__dict__.update(state)
     self.fix_delays()
+    self._date_offsets = {}
+    self._validators = None
+
+  def __getstate__(self):
+    """Influence how to pickle.
+
+    Returns:
+      a dict to use for pickling
+    """
+    state = self.__dict__.copy()
+    state.pop('_date_offsets', None)
+    state.pop('_validators', None)
+    return state
 
   def get_header(self, key, default=None):
     for k, v in self.headers:
@@ -758,6 +1095,7 @@ class ArchivedHttpResponse(object):
     return default
 
   def set_header(self, key, value):
+    self._validators = None
     for i, (k, v) in enumerate(self.headers):
       if key == k:
         self.headers[i] = (key, value)
@@ -765,6 +1103,7 @@ class ArchivedHttpResponse(object):
     self.headers.append((key, value))
 
   def remove_header(self, key):
+    self._validators = None
     for i, (k, v) in enumerate(self.headers):
       if key.lower() == k.lower():
         self.headers.pop(i)
@@ -783,6 +1122,25 @@ class ArchivedHttpResponse(object):
       return calendar.timegm(date_tuple)
     return None
 
+  def _get_date_offset(self, date_str):
+    """Return the seconds from the "Date" header to |date_str| or None.
+
+    Dates are only parsed the first time, since responses are sent many
+    times with the same headers.
+    """
+    key = (self.get_header('date'), date_str)
+    try:
+      return self._date_offsets[key]
+    except KeyError:
+      pass
+    date_seconds = self._get_epoch_seconds(key[0])
+    header_seconds = self._get_epoch_seconds(date_str)
+    offset = None
+    if date_seconds and header_seconds:
+      offset = header_seconds - date_seconds
+    self._date_offsets[key] = offset
+    return offset
+
   def update_date(self, date_str, now=None):
     """Return an updated date based on its delta from the "Date" header.
 
@@ -791,21 +1149,51 @@ class ArchivedHttpResponse(object):
 
     Args:
       date_str: a date string (e.g. "Thu, 01 Dec 1994 16:00:00 GMT")
+      now: epoch seconds of the current date (defaults to the replay clock).
     Returns:
       a date string
     """
-    date_seconds = self._get_epoch_seconds(self.get_header('date'))
-    header_seconds = self._get_epoch_seconds(date_str)
-    if date_seconds and header_seconds:
-      updated_seconds = header_seconds + (now or time.time()) - date_seconds
-      return email.utils.formatdate(updated_seconds, usegmt=True)
-    return date_str
+    offset = self._get_date_offset(date_str)
+    if offset is None:
+      return date_str
+    return _format_date(offset + (now or get_replay_time()))
+
+  def get_validators(self, now=None):
+    """Return the etag and last-modified values of conditional requests.
+
+    The headers are only looked up and parsed the first time (and again
+    after set_header or remove_header). Like update_date, last-modified is
+    updated to the replay clock.
+
+    Args:
+      now: epoch seconds of the current date (defaults to the replay clock).
+    Returns:
+      (etag or None, last-modified epoch seconds or None)
+    """
+    if self._validators is None:
+      last_modified = self.get_header('last-modified')
+      self._validators = (self.get_header('etag'),
+                          self._get_date_offset(last_modified),
+                          self._get_epoch_seconds(last_modified))
+    etag, offset, last_modified = self._validators
+    if offset is not None:
+      last_modified = int(offset + (now or get_replay_time()))
+    return etag, last_modified
 
   def is_gzip(self):
     return self.get_header('content-encoding') == 'gzip'
 
+  def get_codec(self):
+    """Return the httpzlib.Codec of the content-encoding or None."""
+    return httpzlib.get_codec(self.get_header('content-encoding'))
+
   def is_compressed(self):
-    return self.get_header('content-encoding') in ('gzip', 'deflate')
+    return self.get_codec() is not None
+
+  def is_encoded(self):
+    """Return True if the content-encoding is not identity."""
+    encoding = self.get_header('content-encoding')
+    return bool(encoding) and encoding.strip().lower() != 'identity'
 
   def is_chunked(self):
     return self.get_header('transfer-encoding') == 'chunked'
@@ -814,6 +1202,8 @@ class ArchivedHttpResponse(object):
     """Return content as a single string.
 
     Uncompresses and concatenates chunks with CHUNK_EDIT_SEPARATOR.
+    Returns None for binary content and for content-encodings without a
+    usable httpzlib codec.
     """
     content_type = self.get_header('content-type')
     if (not content_type or
@@ -821,9 +1211,11 @@ class ArchivedHttpResponse(object):
              content_type == 'application/x-javascript' or
              content_type.startswith('application/json'))):
       return None
-    if self.is_compressed():
-      uncompressed_chunks = httpzlib.uncompress_chunks(
-          self.response_data, self.is_gzip())
+    codec = self.get_codec()
+    if codec:
+      uncompressed_chunks = codec.uncompress_chunks(self.response_data)
+    elif self.is_encoded():
+      return None
     else:
       uncompressed_chunks = self.response_data
     return self.CHUNK_EDIT_SEPARATOR.join(uncompressed_chunks)
@@ -848,12 +1240,19 @@ class ArchivedHttpResponse(object):
   def set_data(self, text):
     """Inverse of get_data_as_text().
 
-    Split on CHUNK_EDIT_SEPARATOR and compress if needed.
+    Split on CHUNK_EDIT_SEPARATOR and compress if needed. If the
+    content-encoding has no usable codec, the text is stored uncompressed
+    and the content-encoding header is removed.
     """
     text_chunks = text.split(self.CHUNK_EDIT_SEPARATOR)
-    if self.is_compressed():
-      self.response_data = httpzlib.compress_chunks(text_chunks, self.is_gzip())
+    codec = self.get_codec()
+    if codec:
+      self.response_data = codec.compress_chunks(
+          text_chunks,
+          target_size=httpzlib.get_target_size(self.response_data))
     else:
+      if self.is_encoded():
+        self.remove_header('content-encoding')
       self.response_data = text_chunks
     if not self.is_chunked():
       content_length = sum(len(c) for c in self.response_data)
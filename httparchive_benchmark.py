@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the cost of the response headers on the replay send path.
+
+Builds the headers of every response the way the HTTP proxy sends them
+(with updated last-modified and expires dates) many times over, and
+compares it to parsing and formatting the dates on every send.
+
+Usage:
+  ./httparchive_benchmark.py --sends 20
+  ./httparchive_benchmark.py archive.wpr
+"""
+
+import email.utils
+import optparse
+import sys
+import time
+
+import httparchive
+
+DATE = 'Wed, 13 Jul 2011 03:58:08 GMT'
+LAST_MODIFIED = 'Tue, 12 Jul 2011 02:47:07 GMT'
+EXPIRES = 'Thu, 14 Jul 2011 03:58:08 GMT'
+
+
+class UncachedArchivedHttpResponse(httparchive.ArchivedHttpResponse):
+  """Parse and format the dates on every call.
+
+  This is how dates were updated before the offsets were cached.
+  """
+
+  def update_date(self, date_str, now=None):
+    date_seconds = self._get_epoch_seconds(self.get_header('date'))
+    header_seconds = self._get_epoch_seconds(date_str)
+    if date_seconds and header_seconds:
+      updated_seconds = header_seconds + (now or time.time()) - date_seconds
+      return email.utils.formatdate(updated_seconds, usegmt=True)
+    return date_str
+
+
+def _GetHeaders(response):
+  """Return the headers that httpproxy sends for |response|."""
+  headers = []
+  for header, value in response.headers:
+    if header in ('last-modified', 'expires'):
+      headers.append((header, response.update_date(value)))
+    elif header not in ('date', 'server'):
+      headers.append((header, value))
+  return headers
+
+
+def RunBenchmark(responses, num_sends):
+  """Return the microseconds per response."""
+  start_time = time.time()
+  for _ in xrange(num_sends):
+    for response in responses:
+      _GetHeaders(response)
+  elapsed = time.time() - start_time
+  return elapsed * 1000000.0 / (num_sends * len(responses))
+
+
+def main():
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] [archive]', description=__doc__)
+  option_parser.add_option('--responses', default=1000,
+      action='store',
+      type='int',
+      help='Number of generated responses (without an archive).')
+  option_parser.add_option('--sends', default=20,
+      action='store',
+      type='int',
+      help='Number of times each response is sent.')
+  options, args = option_parser.parse_args()
+  if len(args) > 1:
+    option_parser.error('Unexpected arguments: %s' % args[1:])
+
+  if args:
+    archive = httparchive.HttpArchive.Load(args[0])
+    headers = [archive[request].headers for request in archive]
+  else:
+    headers = [[('content-type', 'text/html'), ('date', DATE),
+                ('last-modified', LAST_MODIFIED), ('expires', EXPIRES),
+                ('cache-control', 'max-age=%d' % i)]
+               for i in xrange(options.responses)]
+  for name, response_class in (
+      ('uncached', UncachedArchivedHttpResponse),
+      ('cached', httparchive.ArchivedHttpResponse)):
+    responses = [response_class(11, 200, 'OK', h, ['']) for h in headers]
+    first_send = RunBenchmark(responses, 1)
+    steady_state = RunBenchmark(responses, options.sends)
+    print '%s: %.1fus per response (first send %.1fus)' % (
+        name, steady_state, first_send)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -17,7 +17,11 @@ import ast
 import calendar
 import email.utils
 import httparchive
+import httpzlib
 import os
+import pickle
+import sys
+import threading
 import time
 import unittest
 
@@ -65,6 +69,16 @@ class HttpArchiveTest(unittest.TestCase):
     archive = httparchive.HttpArchive()
     self.assertEqual(len(archive), 0)
 
+  def test_get_recording_time(self):
+    self.assertEqual(None, self.archive.get_recording_time())
+    for path, date in (('/a', self.DATE_PRESENT), ('/b', self.DATE_PAST),
+                       ('/c', self.DATE_INVALID)):
+      request = httparchive.ArchivedHttpRequest(
+          'GET', 'www.test.com', path, None, {})
+      self.archive[request] = create_response([('date', date)])
+    self.assertEqual(calendar.timegm(email.utils.parsedate(self.DATE_PAST)),
+                     self.archive.get_recording_time())
+
   def test__TrimHeaders(self):
     request = httparchive.ArchivedHttpRequest
     header1 = {'accept-encoding': 'gzip,deflate'}
@@ -345,6 +359,150 @@ class HttpArchiveTest(unittest.TestCase):
     request = create_request(request_headers)
     self.assertEqual(archive.get(request), response)
 
+  def test_get_with_other_accept_encoding(self):
+    request = create_request({'accept-encoding': 'br'})
+    self.assertTrue(self.archive.get(request) is self.RESPONSE)
+    self.assertEqual(self.REQUEST, self.archive.find_request(request))
+    # An added request with the same accept-encoding is preferred.
+    response = create_response([])
+    self.archive[request] = response
+    self.assertTrue(self.archive.get(request) is response)
+    self.assertEqual(None, self.archive.get(
+        create_request({'accept-encoding': 'br', 'x-other': '1'})))
+    self.assertFalse(
+        '_requests_without_accept_encoding' in self.archive.__getstate__())
+
+  def test_find_request_after_delete_and_clear(self):
+    gzip_request = create_request({'accept-encoding': 'gzip'})
+    self.archive[gzip_request] = self.RESPONSE
+    request = create_request({'accept-encoding': 'br'})
+    # The first matching request in repr order is used.
+    self.assertEqual(gzip_request, self.archive.find_request(request))
+    del self.archive[gzip_request]
+    self.assertEqual(self.REQUEST, self.archive.find_request(request))
+    self.archive[gzip_request] = self.RESPONSE
+    self.assertEqual(gzip_request, self.archive.find_request(request))
+    self.archive.clear()
+    self.assertEqual(None, self.archive.find_request(request))
+    self.assertEqual({}, dict(self.archive.responses_by_host))
+
+  def test_get_conditional_with_other_accept_encoding(self):
+    request = create_request({'accept-encoding': 'br',
+                              'if-none-match': self.ETAG_VALID})
+    self.assertEqual(self.REQUEST,
+                     self.archive.find_request_without_conditions(request))
+    self.assertEqual(httparchive.create_response(304),
+                     self.archive.get(request))
+    # An added request with the same accept-encoding is preferred.
+    other_request = create_request({'accept-encoding': 'br'})
+    self.archive[other_request] = self.RESPONSE
+    self.assertEqual(other_request,
+                     self.archive.find_request_without_conditions(request))
+    self.assertFalse('_requests_by_key' in self.archive.__getstate__())
+
+  def test_find_request_without_conditions_uses_repr_path(self):
+    archived_request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/a?t=1', None, {}, repr_path='/a')
+    self.archive[archived_request] = self.RESPONSE
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/a?t=2',
+        None, {'accept-encoding': 'br', 'if-none-match': self.ETAG_VALID},
+        repr_path='/a')
+    self.assertEqual(repr(request.create_request_without_conditions()),
+                     request.get_key_without_conditions())
+    self.assertEqual(archived_request,
+                     self.archive.find_request_without_conditions(request))
+    self.assertEqual(304, self.archive.get(request).status)
+
+  def test_conditional_lookups_during_writes(self):
+    for i in xrange(200):
+      self.archive[httparchive.ArchivedHttpRequest(
+          'GET', 'www.test.com', '/%d' % i, None, {})] = self.RESPONSE
+    request = create_request({'accept-encoding': 'br',
+                              'if-none-match': self.ETAG_VALID})
+    errors = []
+    statuses = set()
+    is_done = threading.Event()
+
+    def write():
+      try:
+        for i in xrange(2000):
+          cert_request = httparchive.ArchivedHttpRequest(
+              'DUMMY_CERT', 'host%d.com' % (i % 50), '', None, {})
+          self.archive[cert_request] = self.RESPONSE
+          if i % 3 == 0:
+            del self.archive[cert_request]
+      except Exception, e:
+        errors.append(e)
+      finally:
+        is_done.set()
+
+    def look_up():
+      try:
+        while not is_done.is_set():
+          statuses.add(self.archive.get(request).status)
+      except Exception, e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=write)] + [
+        threading.Thread(target=look_up) for _ in range(2)]
+    # Switch threads often to interleave the writes and lookups.
+    check_interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    try:
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    finally:
+      sys.setcheckinterval(check_interval)
+    self.assertEqual([], errors)
+    self.assertEqual(set([304]), statuses)
+
+  def test_conditional_responses_are_shared(self):
+    request = create_request({'if-none-match': self.ETAG_VALID})
+    not_modified_response = self.archive.get(request)
+    self.assertEqual(304, not_modified_response.status)
+    self.assertTrue(self.archive.get(request) is not_modified_response)
+
+  def test_get_key_without_conditions(self):
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.test.com', '/a?b', None,
+        {'accept-encoding': 'gzip,sdch', 'if-none-match': self.ETAG_VALID,
+         'If-Modified-Since': self.DATE_PAST, 'user-agent': 'x', 'x-a': '1'},
+        is_ssl=True, repr_path='/a')
+    stripped_request = request.create_request_without_conditions()
+    self.assertEqual(repr(stripped_request),
+                     request.get_key_without_conditions())
+    self.assertEqual(
+        repr(stripped_request.create_request_without_accept_encoding()),
+        request.get_key_without_conditions(without_accept_encoding=True))
+
+  def test_record_dns_timings(self):
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'www.example.com:8080', '/', None, {})
+    self.archive[request] = self.RESPONSE
+    self.archive.record_dns_timings(
+        {'www.test.com': 12.5, 'www.example.com': 30, 'unused.com': 7})
+    self.assertEqual({'www.test.com': 12.5, 'www.example.com': 30},
+                     self.archive.dns_timings)
+
+  def test_split_host_port(self):
+    self.assertEqual(('www.example.com', None),
+                     httparchive.split_host_port('www.example.com'))
+    self.assertEqual(('www.example.com', '8080'),
+                     httparchive.split_host_port('www.example.com:8080'))
+    self.assertEqual(('::1', None), httparchive.split_host_port('[::1]'))
+    self.assertEqual(('::1', '443'), httparchive.split_host_port('[::1]:443'))
+    self.assertEqual(('::1', None), httparchive.split_host_port('::1'))
+
+  def test_unpickle_archive_without_dns_timings(self):
+    state = self.archive.__getstate__()
+    del state['dns_timings']
+    archive = httparchive.HttpArchive()
+    archive.__setstate__(state)
+    self.assertEqual({}, archive.dns_timings)
+
 
 class ArchivedHttpResponse(unittest.TestCase):
   PAST_DATE_A = 'Tue, 13 Jul 2010 03:47:07 GMT'
@@ -358,6 +516,9 @@ class ArchivedHttpResponse(unittest.TestCase):
   def setUp(self):
     self.response = create_response([('date', self.PAST_DATE_A)])
 
+  def tearDown(self):
+    httparchive.set_replay_clock()
+
   def test_update_date_same_date(self):
     self.assertEqual(
         self.response.update_date(self.PAST_DATE_A, now=self.NOW_SECONDS),
@@ -384,6 +545,76 @@ class ArchivedHttpResponse(unittest.TestCase):
         self.response.update_date(self.PAST_DATE_B, now=self.NOW_SECONDS),
         self.PAST_DATE_B)
 
+  def test_update_date_after_date_header_changes(self):
+    self.assertEqual(
+        self.response.update_date(self.PAST_DATE_C, now=self.NOW_SECONDS),
+        self.NOW_DATE_C)
+    self.response.set_header('date', self.PAST_DATE_C)
+    self.assertEqual(
+        self.response.update_date(self.PAST_DATE_C, now=self.NOW_SECONDS),
+        self.NOW_DATE_A)
+
+  def test_update_date_with_replay_clock(self):
+    httparchive.set_replay_clock(self.NOW_SECONDS)
+    self.assertEqual(self.NOW_DATE_C,
+                     self.response.update_date(self.PAST_DATE_C))
+    self.assertEqual(self.NOW_DATE_A, httparchive.get_replay_date())
+    httparchive.set_replay_clock(self.NOW_SECONDS, time_shift=-3600)
+    self.assertEqual(self.NOW_DATE_A,
+                     self.response.update_date(self.PAST_DATE_C))
+    self.assertEqual(self.NOW_DATE_B, httparchive.get_replay_date())
+
+  def test_replay_clock_shifts_real_time(self):
+    httparchive.set_replay_clock(time_shift=86400)
+    self.assertAlmostEqual(time.time() + 86400, httparchive.get_replay_time(),
+                           delta=60)
+
+  def test_get_validators(self):
+    self.response.set_header('etag', '"abc"')
+    self.response.set_header('last-modified', self.PAST_DATE_B)
+    self.assertEqual(('"abc"', self.NOW_SECONDS - 3600),
+                     self.response.get_validators(now=self.NOW_SECONDS))
+    httparchive.set_replay_clock(self.NOW_SECONDS + 60)
+    self.assertEqual(('"abc"', self.NOW_SECONDS - 3540),
+                     self.response.get_validators())
+    self.response.remove_header('etag')
+    self.response.set_header('date', 'garbage date')
+    self.assertEqual(
+        (None, calendar.timegm(email.utils.parsedate(self.PAST_DATE_B))),
+        self.response.get_validators())
+    self.assertFalse('_validators' in self.response.__getstate__())
+
+  def test_date_offsets_are_not_pickled(self):
+    self.response.update_date(self.PAST_DATE_B, now=self.NOW_SECONDS)
+    self.assertFalse('_date_offsets' in self.response.__getstate__())
+    response = pickle.loads(pickle.dumps(self.response))
+    self.assertEqual(
+        response.update_date(self.PAST_DATE_B, now=self.NOW_SECONDS),
+        self.NOW_DATE_B)
+
+  def test_data_as_text_with_codecs(self):
+    for encoding in httpzlib.get_encodings():
+      response = httparchive.ArchivedHttpResponse(
+          11, 200, 'OK', [('content-type', 'text/html'),
+                          ('content-encoding', encoding)], [])
+      text = 'a' + response.CHUNK_EDIT_SEPARATOR + 'b'
+      response.set_data(text)
+      self.assertTrue(response.is_compressed())
+      self.assertEqual(2, len(response.response_data))
+      self.assertNotEqual(['a', 'b'], response.response_data)
+      self.assertEqual(text, response.get_data_as_text())
+
+  def test_data_as_text_with_unsupported_encoding(self):
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('content-type', 'text/html'),
+                        ('content-encoding', 'x-unknown')], ['\x01\x02'])
+    self.assertFalse(response.is_compressed())
+    self.assertTrue(response.is_encoded())
+    self.assertEqual(None, response.get_data_as_text())
+    response.set_data('text')
+    self.assertEqual(['text'], response.response_data)
+    self.assertEqual(None, response.get_header('content-encoding'))
+
 
 if __name__ == '__main__':
   unittest.main()
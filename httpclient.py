@@ -16,31 +16,254 @@
 """Retrieve web resources over http."""
 
 import copy
+import functools
 import httplib
 import logging
 import random
 import re
 import StringIO
+import threading
+import zlib
 
 import httparchive
+import httpzlib
 import platformsettings
+import prefetcher
 import script_injector
 
 # PIL isn't always available, but we still want to be able to run without
 # the image scrambling functionality in this case.
 try:
-  import Image
+  from PIL import Image
 except ImportError:
-  Image = None
+  try:
+    import Image
+  except ImportError:
+    Image = None
+
+# NumPy makes image scrambling faster, but is not required.
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 TIMER = platformsettings.timer
 
+# Uncompressed bytes at the start of a document that are searched for the
+# insertion point of injected scripts.
+INJECTION_WINDOW_SIZE = 16384
+
 
 class HttpClientException(Exception):
   """Base class for all exceptions in httpclient."""
   pass
 
 
+def _IsHtml(response):
+  content_type = response.get_header('content-type')
+  return bool(content_type and content_type.startswith('text/html'))
+
+
+def _CopyResponse(response):
+  """Return a copy of |response| whose data and headers may be replaced.
+
+  The copy shares the data chunks and delays with |response|. Those are
+  replaced rather than modified in place (see ArchivedHttpResponse.set_data),
+  so only the header list needs its own copy.
+  """
+  response_copy = copy.copy(response)
+  response_copy.headers = list(response.headers)
+  return response_copy
+
+
+def _SetResponseData(response, response_data):
+  """Replace the data of |response| and update its content-length."""
+  response.response_data = response_data
+  if not response.is_chunked():
+    content_length = sum(len(c) for c in response_data)
+    response.set_header('content-length', str(content_length))
+
+
+def _ParseAcceptEncoding(request):
+  """Return [(content-encoding, qvalue), ...] in the order of the header.
+
+  Returns None if |request| has no Accept-Encoding header.
+  """
+  accept_encoding = None
+  for name, value in request.headers.iteritems():
+    if name.lower() == 'accept-encoding':
+      accept_encoding = value
+  if accept_encoding is None:
+    return None
+  accepted_encodings = []
+  for item in accept_encoding.split(','):
+    params = item.split(';')
+    qvalue = 1.0
+    for param in params[1:]:
+      name, _, value = param.partition('=')
+      if name.strip() == 'q':
+        try:
+          qvalue = float(value)
+        except ValueError:
+          pass
+    if params[0].strip():
+      accepted_encodings.append((params[0].strip().lower(), qvalue))
+  return accepted_encodings
+
+
+def _GetQValue(accepted_encodings, encoding):
+  """Return the qvalue of |encoding| (see RFC 7231 5.3.4)."""
+  qvalues = dict(accepted_encodings)
+  if encoding in qvalues:
+    return qvalues[encoding]
+  if '*' in qvalues:
+    return qvalues['*']
+  return 1.0 if encoding == 'identity' else 0.0
+
+
+def _IsEncodingAccepted(request, encoding):
+  """Return True if the Accept-Encoding header of |request| allows |encoding|.
+
+  Args:
+    request: an ArchivedHttpRequest
+    encoding: a content-encoding (e.g. 'gzip')
+  """
+  accepted_encodings = _ParseAcceptEncoding(request)
+  if accepted_encodings is None:
+    return True  # Any encoding is acceptable.
+  return _GetQValue(accepted_encodings, encoding) > 0
+
+
+def _ChooseEncoding(request, response):
+  """Return the content-encoding to serve |response| with to |request|.
+
+  The encoding of |response| is kept if the client accepts it or if it has
+  no httpzlib codec. Otherwise, the accepted httpzlib encoding with the
+  highest qvalue is chosen (ties go to the one listed first), or identity.
+
+  Returns:
+    the content-encoding header value, or None for identity.
+  """
+  encoding = response.get_header('content-encoding')
+  accepted_encodings = _ParseAcceptEncoding(request)
+  if (accepted_encodings is None or
+      (response.is_encoded() and not response.is_compressed()) or
+      _GetQValue(accepted_encodings,
+                 encoding.lower() if encoding else 'identity') > 0):
+    return encoding
+  positions = dict((e, i) for i, (e, _) in enumerate(accepted_encodings))
+  candidates = [
+      (-_GetQValue(accepted_encodings, e), positions.get(e, len(positions)), e)
+      for e in httpzlib.get_encodings()]
+  candidates = [c for c in candidates if c[0] < 0]
+  if candidates:
+    return min(candidates)[2]
+  if _GetQValue(accepted_encodings, 'identity') > 0:
+    return None
+  return encoding  # Nothing is acceptable, so do not transcode.
+
+
+def _TranscodeResponse(response, encoding):
+  """Return a copy of |response| with its body in another content-encoding.
+
+  Each chunk is transcoded separately, so the chunk delays still apply.
+
+  Args:
+    response: an ArchivedHttpResponse with an identity body or one that
+        httpzlib can uncompress.
+    encoding: a content-encoding with an httpzlib codec, or None for
+        identity.
+  Returns:
+    an ArchivedHttpResponse
+  """
+  chunks = response.response_data
+  if response.is_compressed():
+    chunks = response.get_codec().uncompress_chunks(chunks)
+  if encoding:
+    chunks = httpzlib.get_codec(encoding).compress_chunks(
+        chunks, target_size=httpzlib.get_target_size(response.response_data))
+  response = _CopyResponse(response)
+  if encoding:
+    response.set_header('content-encoding', encoding)
+  else:
+    response.remove_header('content-encoding')
+  _SetResponseData(response, chunks)
+  return response
+
+
+def _InjectScriptIntoLeadingChunks(response, inject_script):
+  """Inject |inject_script| by rewriting only the leading chunks.
+
+  Chunks are uncompressed until they hold INJECTION_WINDOW_SIZE bytes or
+  the insertion point, whichever comes later. Gzip data is only
+  recompressed up to the first sync flush that is at least
+  httpzlib.DEFLATE_WINDOW_SIZE bytes past the insertion point. The rest is
+  reused as it is.
+
+  Args:
+    response: an ArchivedHttpResponse. Only identity and gzip encoded
+        bodies are rewritten in part. Other encodings return None.
+    inject_script: JavaScript string (e.g. "Math.random = function(){...}")
+  Returns:
+    the new response data, |response.response_data| if the script is
+    already injected, or None if the whole document must be searched.
+  """
+  response_data = response.response_data
+  is_gzip = response.is_gzip()
+  if response.is_encoded() and not is_gzip:
+    return None
+  if is_gzip:
+    chunks = httpzlib.iter_uncompress_chunks(response_data, True)
+  else:
+    chunks = iter(response_data)
+  uncompressed_chunks = []
+  size = 0
+  for data in chunks:
+    uncompressed_chunks.append(data)
+    size += len(data)
+    if size >= INJECTION_WINDOW_SIZE:
+      break
+  window = ''.join(uncompressed_chunks)
+  if not window or inject_script in window:
+    return response_data
+  offset = script_injector.GetInjectionOffset(window)
+  if offset is None:
+    return None
+
+  index = 0
+  start = 0
+  while start + len(uncompressed_chunks[index]) < offset:
+    start += len(uncompressed_chunks[index])
+    index += 1
+  data = uncompressed_chunks[index]
+  injected_data = '%s<script>%s</script>%s' % (
+      data[:offset - start], inject_script, data[offset - start:])
+  if not is_gzip:
+    return response_data[:index] + [injected_data] + response_data[index + 1:]
+
+  def IsReusableTail(num_chunks):
+    return (size - offset >= httpzlib.DEFLATE_WINDOW_SIZE and
+            response_data[num_chunks - 1].endswith(
+                httpzlib.SYNC_FLUSH_MARKER) and
+            len(response_data[-1]) >= 8)  # Holds the CRC-32 and size.
+
+  num_chunks = len(uncompressed_chunks)
+  while num_chunks < len(response_data) and not IsReusableTail(num_chunks):
+    data = chunks.next()
+    uncompressed_chunks.append(data)
+    size += len(data)
+    num_chunks += 1
+  injected_chunks = list(uncompressed_chunks)
+  injected_chunks[index] = injected_data
+  if num_chunks == len(response_data):
+    return httpzlib.compress_chunks(
+        injected_chunks, True,
+        target_size=httpzlib.get_target_size(response_data))
+  return httpzlib.replace_gzip_prefix(
+      response_data, uncompressed_chunks, injected_chunks,
+      target_size=httpzlib.get_target_size(response_data[:num_chunks]))
+
+
 def _InjectScripts(response, inject_script):
   """Injects |inject_script| immediately after <head> or <html>.
 
@@ -54,21 +277,121 @@ def _InjectScripts(response, inject_script):
   """
   if type(response) == tuple:
     logging.warn('tuple response: %s', response)
-  content_type = response.get_header('content-type')
-  if content_type and content_type.startswith('text/html'):
-    text = response.get_data_as_text()
-    text, already_injected = script_injector.InjectScript(
-        text, 'text/html', inject_script)
-    if not already_injected:
-      response = copy.deepcopy(response)
-      response.set_data(text)
+  if _IsHtml(response):
+    response_data = _InjectScriptIntoLeadingChunks(response, inject_script)
+    if response_data is None:
+      text = response.get_data_as_text()
+      text, already_injected = script_injector.InjectScript(
+          text, 'text/html', inject_script)
+      if not already_injected:
+        response = _CopyResponse(response)
+        response.set_data(text)
+    elif response_data is not response.response_data:
+      response = _CopyResponse(response)
+      _SetResponseData(response, response_data)
   return response
 
 
+class _ResponseVariantCache(object):
+  """Memoize modified variants of archived responses.
+
+  Archived responses are served many times, so each variant (e.g. with
+  injected scripts or in another content-encoding) is only created once.
+
+  Entries are keyed by the identity of the response and keep a reference to
+  it, so that its id cannot be reused while the entry exists. An entry is
+  stale once the response data has been replaced (e.g. by set_data).
+  Unmodified responses are not cached.
+  """
+
+  # Forget all variants when there are more (e.g. after many recordings).
+  MAX_CACHED_RESPONSES = 10000
+
+  def __init__(self, create_variant):
+    """Initialize _ResponseVariantCache.
+
+    Args:
+      create_variant: a function(response, *args) that returns |response|
+          or a modified copy of it.
+    """
+    self.create_variant = create_variant
+    # {(id(response),) + args: (response, response_data, variant)}
+    self._responses = {}
+
+  def __call__(self, response, *args):
+    """Return create_variant(response, *args), cached."""
+    key = (id(response),) + args
+    entry = self._responses.get(key)
+    if (entry and entry[0] is response and
+        entry[1] is response.response_data):
+      return entry[2]
+    variant = self.create_variant(response, *args)
+    if variant is not response:
+      if len(self._responses) >= self.MAX_CACHED_RESPONSES:
+        self._responses.clear()
+      self._responses[key] = (response, response.response_data, variant)
+    return variant
+
+
+def _ShufflePixels(pixel_data, pixel_size, seed):
+  """Return |pixel_data| with its pixels in a random order.
+
+  Args:
+    pixel_data: a string of raw pixels (e.g. from Image.tobytes()).
+    pixel_size: the number of bytes per pixel.
+    seed: the random seed, so that the same image is always shuffled the
+        same way. The order comes from random.Random with or without NumPy.
+  """
+  num_pixels = len(pixel_data) // pixel_size
+  order = range(num_pixels)
+  random.Random(seed).shuffle(order)
+  if numpy:
+    pixels = numpy.frombuffer(pixel_data, dtype=numpy.uint8).reshape(
+        num_pixels, pixel_size)
+    return pixels[numpy.array(order, dtype=numpy.intp)].tobytes()
+  return ''.join([pixel_data[i * pixel_size:(i + 1) * pixel_size]
+                  for i in order])
+
+
+def _SplitData(data, num_chunks):
+  """Split |data| into up to |num_chunks| chunks of about the same size.
+
+  An empty chunk would end a chunked response early, so |data| with fewer
+  than |num_chunks| bytes is split into fewer chunks.
+  """
+  num_chunks = max(1, min(num_chunks, len(data)))
+  chunk_size, remainder = divmod(len(data), num_chunks)
+  chunks = []
+  start = 0
+  for i in xrange(num_chunks):
+    end = start + chunk_size + (1 if i < remainder else 0)
+    chunks.append(data[start:end])
+    start = end
+  return chunks
+
+
+def _SetSplitResponseData(response, data):
+  """Replace the data of |response| with |data| split like the old data.
+
+  The number of chunks is kept, so that the chunk delays still apply. If
+  |data| is too short for that, the delays of the dropped chunks are added
+  to the last chunk.
+  """
+  num_chunks = len(response.response_data)
+  response_data = _SplitData(data, num_chunks)
+  if len(response_data) < num_chunks:
+    data_delays = response.delays['data']
+    last_index = len(response_data) - 1
+    response.delays = dict(response.delays, data=(
+        data_delays[:last_index] + [sum(data_delays[last_index:])]))
+  _SetResponseData(response, response_data)
+
+
 def _ScrambleImages(response):
   """If the |response| is an image, attempt to scramble it.
 
-  Copies |response| if it is modified.
+  Copies |response| if it is modified. The pixels of an image are always
+  shuffled the same way, so scrambled images are the same across runs.
 
   Args:
     response: an ArchivedHttpResponse
@@ -79,27 +402,30 @@ def _ScrambleImages(response):
   assert Image, '--scramble_images requires the PIL module to be installed.'
 
   content_type = response.get_header('content-type')
-  if content_type and content_type.startswith('image/'):
+  if (content_type and content_type.startswith('image/') and
+      not response.is_encoded() and response.response_data):
     try:
-      image_data = response.response_data[0]
-      image_data.decode(encoding='base64')
+      image_data = ''.join(response.response_data)
       im = Image.open(StringIO.StringIO(image_data))
-
-      pixel_data = list(im.getdata())
-      random.shuffle(pixel_data)
-
+      # Old PIL versions only have tostring() and fromstring().
+      pixel_data = (getattr(im, 'tobytes', None) or im.tostring)()
+      num_pixels = im.size[0] * im.size[1]
+      if not num_pixels or len(pixel_data) % num_pixels:
+        return response  # Pixels are not whole bytes (e.g. 1-bit images).
       scrambled_image = im.copy()
-      scrambled_image.putdata(pixel_data)
+      frombytes = (getattr(scrambled_image, 'frombytes', None) or
+                   scrambled_image.fromstring)
+      frombytes(_ShufflePixels(pixel_data, len(pixel_data) // num_pixels,
+                               zlib.crc32(image_data) & 0xffffffff))
 
       output_image_io = StringIO.StringIO()
       scrambled_image.save(output_image_io, im.format)
       output_image_data = output_image_io.getvalue()
-      output_image_data.encode(encoding='base64')
 
-      response = copy.deepcopy(response)
-      response.set_data(output_image_data)
-    except Exception:
-      pass
+      response = _CopyResponse(response)
+      _SetSplitResponseData(response, output_image_data)
+    except Exception, e:
+      logging.debug('Unable to scramble image: %s', e)
 
   return response
 
@@ -111,6 +437,49 @@ class DetailedHTTPResponse(httplib.HTTPResponse):
   that are not part of the public interface.
   """
 
+  def iter_chunks(self, block_size=65536):
+    """Yield the response body content as it arrives.
+
+    Chunked responses yield one item per chunk with the chunk size and CRLFs
+    stripped off. Other responses yield the body in blocks of up to
+    |block_size| bytes. If the response was compressed, the yielded data is
+    still compressed.
+
+    Each delay is the time spent waiting for the chunk to start arriving.
+    Time spent by the caller between items is not included.
+
+    Yields:
+      (data, delay_ms)
+    """
+    try:
+      if not self.chunked:
+        while True:
+          data = self.read(block_size)
+          if not data:
+            break
+          yield data, 0
+        return
+      while True:
+        start = TIMER()
+        line = self.fp.readline()
+        chunk_size = self._read_chunk_size(line)
+        if chunk_size is None:
+          raise httplib.IncompleteRead(line)
+        if chunk_size == 0:
+          break
+        delay_ms = int((TIMER() - start) * 1000)
+        chunk = self._safe_read(chunk_size)
+        self._safe_read(2)  # skip the CRLF at the end of the chunk
+        yield chunk, delay_ms
+
+      # Ignore any trailers.
+      while True:
+        line = self.fp.readline()
+        if not line or line == '\r\n':
+          break
+    finally:
+      self.close()
+
   def read_chunks(self):
     """Return the response body content and timing data.
 
@@ -124,45 +493,25 @@ class DetailedHTTPResponse(httplib.HTTPResponse):
           [chunk_1, chunk_2, ...]          # chunked responses
         delays:
           [0]                              # non-chunked responses
-          [chunk_1_first_byte_delay, ...]  # chunked responses
+          [chunk_1_first_byte_delay, ...]  # chunked responses (ms)
 
       The delay for the first body item should be recorded by the caller.
     """
-    buf = []
     chunks = []
     delays = []
+    for chunk, delay in self.iter_chunks():
+      chunks.append(chunk)
+      delays.append(delay)
     if not self.chunked:
-      chunks.append(self.read())
-      delays.append(0)
-    else:
-      start = TIMER()
-      try:
-        while True:
-          line = self.fp.readline()
-          chunk_size = self._read_chunk_size(line)
-          if chunk_size is None:
-            raise httplib.IncompleteRead(''.join(chunks))
-          if chunk_size == 0:
-            break
-          delays.append(TIMER() - start)
-          chunks.append(self._safe_read(chunk_size))
-          self._safe_read(2)  # skip the CRLF at the end of the chunk
-          start = TIMER()
-
-        # Ignore any trailers.
-        while True:
-          line = self.fp.readline()
-          if not line or line == '\r\n':
-            break
-      finally:
-        self.close()
+      chunks = [''.join(chunks)]
+      delays = [0]
     return chunks, delays
 
   @classmethod
   def _read_chunk_size(cls, line):
     chunk_extensions_pos = line.find(';')
     if chunk_extensions_pos != -1:
-      line = line[:chunk_extention_pos]  # strip chunk-extensions
+      line = line[:chunk_extensions_pos]  # strip chunk-extensions
     try:
       chunk_size = int(line, 16)
     except ValueError:
@@ -185,15 +534,85 @@ class DetailedHTTPSConnection(httplib.HTTPSConnection):
   response_class = DetailedHTTPSResponse
 
 
+class HttpConnectionPool(object):
+  """Thread-safe pool of idle keep-alive connections.
+
+  Connections are keyed by (host, port, is_ssl) of the request. Idle
+  connections are closed once they have been unused for max_idle_seconds.
+  """
+
+  def __init__(self, max_idle_seconds=30, max_idle_per_key=6):
+    """Initialize HttpConnectionPool.
+
+    Args:
+      max_idle_seconds: seconds an idle connection may be kept for reuse.
+      max_idle_per_key: maximum number of idle connections kept per key.
+    """
+    self.max_idle_seconds = max_idle_seconds
+    self.max_idle_per_key = max_idle_per_key
+    self._lock = threading.Lock()
+    self._idle_connections = {}  # {key: [(connection, release_time), ...]}
+
+  def acquire(self, key):
+    """Return an idle connection for |key|, or None if there is none.
+
+    The most recently released connection is preferred. Expired connections
+    found along the way are closed.
+    """
+    connection = None
+    expired = []
+    now = TIMER()
+    with self._lock:
+      idle = self._idle_connections.get(key, [])
+      while idle:
+        candidate, release_time = idle.pop()
+        if now - release_time < self.max_idle_seconds:
+          connection = candidate
+          break
+        expired.append(candidate)
+    for expired_connection in expired:
+      expired_connection.close()
+    return connection
+
+  def release(self, key, connection):
+    """Return |connection| to the pool so a later request may reuse it."""
+    now = TIMER()
+    expired = []
+    with self._lock:
+      for idle in self._idle_connections.itervalues():
+        while idle and now - idle[0][1] >= self.max_idle_seconds:
+          expired.append(idle.pop(0)[0])
+      idle = self._idle_connections.setdefault(key, [])
+      if len(idle) < self.max_idle_per_key:
+        idle.append((connection, now))
+        connection = None
+    if connection:
+      expired.append(connection)
+    for expired_connection in expired:
+      expired_connection.close()
+
+  def close(self):
+    """Close all idle connections."""
+    with self._lock:
+      idle_connections = self._idle_connections
+      self._idle_connections = {}
+    for idle in idle_connections.itervalues():
+      for connection, _ in idle:
+        connection.close()
+
+
 class RealHttpFetch(object):
 
-  def __init__(self, real_dns_lookup):
+  def __init__(self, real_dns_lookup, connection_pool=None):
     """Initialize RealHttpFetch.
 
     Args:
       real_dns_lookup: a function that resolves a host to an IP.
+      connection_pool: a HttpConnectionPool for keep-alive connections.
+          By default, a new pool is created.
     """
     self._real_dns_lookup = real_dns_lookup
+    self._connection_pool = connection_pool or HttpConnectionPool()
 
   @staticmethod
   def _GetHeaderNameValue(header):
@@ -257,10 +676,8 @@ class RealHttpFetch(object):
 
   @staticmethod
   def _get_request_host_port(request):
-    host_parts = request.host.split(':')
-    host = host_parts[0]
-    port = int(host_parts[1]) if len(host_parts) == 2 else None
-    return host, port
+    host, port = httparchive.split_host_port(request.host)
+    return host, int(port) if port else None
 
   def _get_system_proxy(self, is_ssl):
     return platformsettings.get_system_proxy(is_ssl)
@@ -301,21 +718,55 @@ class RealHttpFetch(object):
   def __call__(self, request):
     """Fetch an HTTP request.
 
+    Idle keep-alive connections to the same host, port and scheme are reused.
+    The 'connect' delay is only recorded for connections that are opened for
+    this request; it is 0 for reused connections.
+
     Args:
       request: an ArchivedHttpRequest
     Returns:
       an ArchivedHttpResponse
     """
+    return self._fetch(request, stream=False)
+
+  def stream(self, request):
+    """Fetch an HTTP request without waiting for the response body.
+
+    Like __call__, but if the response body length is known (chunked or with
+    a content-length), return as soon as the headers arrive.
+
+    Args:
+      request: an ArchivedHttpRequest
+    Returns:
+      a StreamingArchivedHttpResponse, an ArchivedHttpResponse, or None.
+    """
+    return self._fetch(request, stream=True)
+
+  def _release_connection(self, pool_key, connection, response,
+                          is_body_read=True):
+    """Return |connection| to the pool if it can be reused."""
+    if response.will_close or not is_body_read:
+      connection.close()
+    else:
+      self._connection_pool.release(pool_key, connection)
+
+  def _fetch(self, request, stream):
     logging.debug('RealHttpFetch: %s %s', request.host, request.full_path)
     request_host, request_port = self._get_request_host_port(request)
+    pool_key = (request_host, request_port, request.is_ssl)
     retries = 3
     while True:
+      connection = self._connection_pool.acquire(pool_key)
+      is_reused = connection is not None
       try:
-        connection = self._get_connection(
-            request_host, request_port, request.is_ssl)
-        connect_start = TIMER()
-        connection.connect()
-        connect_delay = int((TIMER() - connect_start) * 1000)
+        if is_reused:
+          connect_delay = 0
+        else:
+          connection = self._get_connection(
+              request_host, request_port, request.is_ssl)
+          connect_start = TIMER()
+          connection.connect()
+          connect_delay = int((TIMER() - connect_start) * 1000)
         start = TIMER()
         connection.request(
             request.command,
@@ -324,22 +775,43 @@ class RealHttpFetch(object):
             request.headers)
         response = connection.getresponse()
         headers_delay = int((TIMER() - start) * 1000)
-
-        chunks, chunk_delays = response.read_chunks()
+        headers = RealHttpFetch._ToTuples(response.msg.headers)
         delays = {
             'connect': connect_delay,
             'headers': headers_delay,
-            'data': chunk_delays
+            'data': []
             }
+
+        if stream and (response.chunked or response.length is not None):
+          return StreamingArchivedHttpResponse(
+              response.version,
+              response.status,
+              response.reason,
+              headers,
+              delays,
+              response.iter_chunks(),
+              response.chunked,
+              functools.partial(self._release_connection,
+                                pool_key, connection, response))
+
+        chunks, delays['data'] = response.read_chunks()
         archived_http_response = httparchive.ArchivedHttpResponse(
             response.version,
             response.status,
             response.reason,
-            RealHttpFetch._ToTuples(response.msg.headers),
+            headers,
             chunks,
             delays)
+        self._release_connection(pool_key, connection, response)
         return archived_http_response
       except Exception, e:
+        if connection:
+          connection.close()
+        if is_reused:
+          # The server may have closed an idle connection. This does not
+          # count as a retry.
+          logging.debug('Reused connection failed for %s: %s', request, e)
+          continue
         if retries:
           retries -= 1
           logging.warning('Retrying fetch %s: %s', request, e)
@@ -348,11 +820,87 @@ class RealHttpFetch(object):
         return None
 
 
+class StreamingArchivedHttpResponse(httparchive.ArchivedHttpResponse):
+  """An ArchivedHttpResponse whose body is still being read from the server.
+
+  iter_chunks() yields the body as it arrives so that it can be sent to the
+  client while it is recorded. Once the whole body has been read,
+  |on_complete| is called with a regular ArchivedHttpResponse that holds the
+  chunks and their delays.
+  """
+
+  def __init__(self, version, status, reason, headers, delays, body,
+               is_chunked, on_body_read, on_complete=None):
+    """Initialize a StreamingArchivedHttpResponse.
+
+    Args:
+      version, status, reason, headers: see ArchivedHttpResponse.
+      delays: dict of (ms) delays for 'connect' and 'headers'.
+      body: an iterator of (data, delay_ms) (see DetailedHTTPResponse).
+      is_chunked: True if the response uses chunked transfer encoding.
+          Otherwise the body is recorded as a single chunk.
+      on_body_read: a function called with True if the body has been
+          completely read, or False if reading it failed.
+      on_complete: a function called with the recorded ArchivedHttpResponse.
+    """
+    httparchive.ArchivedHttpResponse.__init__(
+        self, version, status, reason, headers, [], dict(delays, data=[]))
+    self._body = body
+    self._is_chunked = is_chunked
+    self._on_body_read = on_body_read
+    self.on_complete = on_complete
+    self.recorded_response = None
+
+  def iter_chunks(self):
+    """Yield the body chunks as they arrive.
+
+    If the caller stops early (e.g. the client went away), the rest of the
+    body is still read so that the response can be recorded.
+    """
+    chunks = []
+    delays = []
+    is_body_read = False
+    try:
+      for chunk, delay in self._body:
+        chunks.append(chunk)
+        delays.append(delay)
+        yield chunk
+      is_body_read = True
+    except GeneratorExit:
+      try:
+        for chunk, delay in self._body:
+          chunks.append(chunk)
+          delays.append(delay)
+        is_body_read = True
+      except Exception, e:
+        logging.warning('Unable to finish reading response body: %s', e)
+    finally:
+      self._on_body_read(is_body_read)
+      if is_body_read:
+        self._record(chunks, delays)
+
+  def _record(self, chunks, delays):
+    if not self._is_chunked:
+      chunks = [''.join(chunks)]
+      delays = [0]
+    self.recorded_response = httparchive.ArchivedHttpResponse(
+        self.version, self.status, self.reason, self.headers, chunks,
+        dict(self.delays, data=delays))
+    if self.on_complete:
+      self.on_complete(self.recorded_response)
+
+  def read_body(self):
+    """Read the whole body and return the recorded ArchivedHttpResponse."""
+    for _ in self.iter_chunks():
+      pass
+    return self.recorded_response
+
+
 class RecordHttpArchiveFetch(object):
   """Make real HTTP fetches and save responses in the given HttpArchive."""
 
   def __init__(self, http_archive, real_dns_lookup, inject_script,
-               cache_misses=None):
+               cache_misses=None, prefetch_subresources=False):
     """Initialize RecordHttpArchiveFetch.
 
     Args:
@@ -360,11 +908,21 @@ class RecordHttpArchiveFetch(object):
       real_dns_lookup: a function that resolves a host to an IP.
       inject_script: script string to inject in all pages
       cache_misses: instance of CacheMissArchive
+      prefetch_subresources: If True, fetch the static subresources of
+        recorded HTML documents before the browser requests them.
     """
     self.http_archive = http_archive
     self.real_http_fetch = RealHttpFetch(real_dns_lookup)
     self.inject_script = inject_script
+    self.inject_scripts = _ResponseVariantCache(
+        functools.partial(_InjectScripts, inject_script=inject_script))
+    self.callback_paths = []
+    self.rewrite_callbacks = _CallbackRewriter()
     self.cache_misses = cache_misses
+    self.prefetcher = None
+    if prefetch_subresources:
+      self.prefetcher = prefetcher.SubresourcePrefetcher(
+          http_archive, self.real_http_fetch)
 
   def __call__(self, request):
     """Fetch the request and return the response.
@@ -381,21 +939,54 @@ class RecordHttpArchiveFetch(object):
     # If request is already in the archive, return the archived response.
     if request in self.http_archive:
       logging.debug('Repeated request found: %s', request)
-      response = self.http_archive[request]
-      modify_response(request, response, self.callback_paths)
+      response = self.rewrite_callbacks(
+          request, self.http_archive[request], self.callback_paths)
     else:
-      response = self.real_http_fetch(request)
+      response = None
+      if self.prefetcher:
+        response = self.prefetcher.pop_response(request)
+      if response is None:
+        response = self.real_http_fetch.stream(request)
       if response is None:
         return None
-      self.http_archive[request] = response
+      if isinstance(response, StreamingArchivedHttpResponse):
+        content_type = response.get_header('content-type')
+        if not content_type or not content_type.startswith('text/html'):
+          # Send the body to the client as it arrives. The response is
+          # recorded once the whole body has been read.
+          logging.debug('Streaming: %s', request)
+          response.on_complete = functools.partial(self._record, request)
+          return response
+        # Documents are buffered since they may be modified before sending.
+        try:
+          response = response.read_body()
+        except Exception, e:
+          logging.critical('Could not fetch %s: %s', request, e)
+          return None
+      self._record(request, response)
     if self.inject_script:
-      response = _InjectScripts(response, self.inject_script)
+      response = self.inject_scripts(response)
     logging.debug('Recorded: %s', request)
     return response
 
+  def _record(self, request, response):
+    """Save the response in the archive."""
+    self.http_archive[request] = response
+    if self.prefetcher:
+      self.prefetcher.prefetch_document(request, response)
+
+  def Close(self):
+    """Stop the subresource prefetches."""
+    if self.prefetcher:
+      self.prefetcher.stop()
+
 
 class ReplayHttpArchiveFetch(object):
-  """Serve responses from the given HttpArchive."""
+  """Serve responses from the given HttpArchive.
+
+  Archived bodies are transcoded to a content-encoding that the client
+  accepts (see _ChooseEncoding). Each variant is created once per response.
+  """
 
   def __init__(self, http_archive, real_dns_lookup, inject_script,
                use_diff_on_unknown_requests=False, cache_misses=None,
@@ -415,6 +1006,12 @@ class ReplayHttpArchiveFetch(object):
     """
     self.http_archive = http_archive
     self.inject_script = inject_script
+    self.inject_scripts = _ResponseVariantCache(
+        functools.partial(_InjectScripts, inject_script=inject_script))
+    self.transcode_responses = _ResponseVariantCache(_TranscodeResponse)
+    self.scrambled_images = _ResponseVariantCache(_ScrambleImages)
+    self.callback_paths = []
+    self.rewrite_callbacks = _CallbackRewriter()
     self.use_diff_on_unknown_requests = use_diff_on_unknown_requests
     self.cache_misses = cache_misses
     self.use_closest_match = use_closest_match
@@ -433,7 +1030,6 @@ class ReplayHttpArchiveFetch(object):
       return self.real_http_fetch(request)
 
     response = self.http_archive.get(request)
-    modify_response(request, response, self.callback_paths)
 
     if self.use_closest_match and not response:
       closest_request = self.http_archive.find_closest_request(
@@ -458,32 +1054,124 @@ class ReplayHttpArchiveFetch(object):
               "('-' for archived request, '+' for current request):\n%s" % diff)
       logging.warning('Could not replay: %s', reason)
     else:
+      response = self.rewrite_callbacks(request, response, self.callback_paths)
       if self.inject_script:
-        response = _InjectScripts(response, self.inject_script)
+        response = self.inject_scripts(response)
       if self.scramble_images:
-        response = _ScrambleImages(response)
+        response = self.scrambled_images(response)
+      encoding = _ChooseEncoding(request, response)
+      if encoding != response.get_header('content-encoding'):
+        response = self.transcode_responses(response, encoding)
+    return response
+
+def _ReplaceGroupInChunks(pattern, chunks, replacement):
+  """Replace group 1 of each match of |pattern| in the joined |chunks|.
+
+  Matches may span chunks. The result has as many chunks, and each chunk
+  boundary stays at the same place in the text; a boundary inside a
+  replaced group moves to the end of the replacement.
+
+  Returns:
+    the new chunks, or |chunks| if nothing matched.
+  """
+  text = ''.join(chunks)
+  spans = [match.span(1) for match in pattern.finditer(text)
+           if match.start(1) != -1]
+  if not spans:
+    return chunks
+  parts = []
+  position = 0
+  for start, end in spans:
+    parts.extend((text[position:start], replacement))
+    position = end
+  parts.append(text[position:])
+  new_text = ''.join(parts)
+
+  new_chunks = []
+  new_start = 0
+  chunk_end = 0
+  delta = 0  # The length change of the replacements before chunk_end.
+  span_index = 0
+  for chunk in chunks:
+    chunk_end += len(chunk)
+    while span_index < len(spans) and spans[span_index][1] <= chunk_end:
+      start, end = spans[span_index]
+      delta += len(replacement) - (end - start)
+      span_index += 1
+    new_end = chunk_end + delta
+    if span_index < len(spans) and spans[span_index][0] < chunk_end:
+      new_end = spans[span_index][0] + delta + len(replacement)
+    new_chunks.append(new_text[new_start:new_end])
+    new_start = new_end
+  return new_chunks
+
+
+def _UncompressChunks(response):
+  return response.get_codec().uncompress_chunks(response.response_data)
+
+
+class _CallbackRewriter(object):
+  """Rewrite the callback names of responses (the modifyResponse rule).
+
+  A rule is a pair of compiled regular expressions (url_re, response_re).
+  For a request URL (host and path) that matches url_re, group 1 of the
+  URL is the requested callback name. It replaces group 1 of every match of
+  response_re in the uncompressed body.
+
+  Archived responses are not modified. The rewritten response is a copy,
+  which is cached per callback name. The uncompressed body is cached per
+  archived response.
+  """
+
+  def __init__(self):
+    self._uncompressed_chunks = _ResponseVariantCache(_UncompressChunks)
+    self._rewritten_responses = _ResponseVariantCache(self._Rewrite)
+
+  def _Rewrite(self, response, response_re, callback_name):
+    if response.is_compressed():
+      chunks = self._uncompressed_chunks(response)
+    elif response.is_encoded():
+      return response
+    else:
+      chunks = response.response_data
+    new_chunks = _ReplaceGroupInChunks(response_re, chunks, callback_name)
+    if new_chunks == chunks:
+      return response
+    if response.is_compressed():
+      new_chunks = response.get_codec().compress_chunks(
+          new_chunks,
+          target_size=httpzlib.get_target_size(response.response_data))
+    response = _CopyResponse(response)
+    if all(new_chunks):
+      _SetResponseData(response, new_chunks)
+    else:
+      # A chunk within a replacement became empty, which would end the
+      # response early.
+      _SetSplitResponseData(response, ''.join(new_chunks))
+    return response
+
+  def __call__(self, request, response, callback_paths):
+    """Return |response| with the callback names of |request|.
+
+    Args:
+      request: an ArchivedHttpRequest
+      response: an ArchivedHttpResponse
+      callback_paths: [(url_re, response_re), ...]
+    Returns:
+      an ArchivedHttpResponse
+    """
+    url = None
+    for url_re, response_re in callback_paths:
+      if url is None:
+        url = '%s%s' % (request.host, request.full_path)
+      match = url_re.match(url)
+      if match:
+        logging.debug('Replacing callback name with %s: %s',
+                      match.group(1), url)
+        response = self._rewritten_responses(
+            response, response_re, match.group(1))
     return response
 
-GROUP_RE = re.compile(r'\(.*\)')
-
-def modify_response(request, response, callback_paths):
-  """Modifies the response's callback id to match the request's callback id."""
-  for callback_path_re, response_re in callback_paths:
-    url = '%s%s' % (request.host, request.full_path)
-    if callback_path_re.match(url):
-      logging.info('doing callback replacement')
-      logging.info(request.full_path)
-
-      new_key = callback_path_re.search(url).group(1)
-      text = response.get_response_as_text()
-      # create an old_key that replaces the group in the regex with the desired
-      # text
-      old_key = GROUP_RE.sub(response_re.search(text).group(1),
-                             response_re.pattern)
-      logging.info("old_key = %s", old_key)
-      new_text = response_re.sub(old_key, text)
-      logging.info('new_text: %s', new_text)
-      response.set_response_from_text(new_text)
 
 class ControllableHttpArchiveFetch(object):
   """Controllable fetch function that can swap between record and replay."""
@@ -491,7 +1179,7 @@ class ControllableHttpArchiveFetch(object):
   def __init__(self, http_archive, real_dns_lookup,
                inject_script, use_diff_on_unknown_requests,
                use_record_mode, rules, cache_misses, use_closest_match,
-               scramble_images):
+               scramble_images, prefetch_subresources=False):
     """Initialize HttpArchiveFetch.
 
     Args:
@@ -505,11 +1193,13 @@ class ControllableHttpArchiveFetch(object):
       cache_misses: Instance of CacheMissArchive.
       use_closest_match: If True, on replay mode, serve the closest match
         in the archive instead of giving a 404.
+      prefetch_subresources: If True, on record mode, fetch the static
+        subresources of HTML documents before the browser requests them.
     """
     self.http_archive = http_archive
     self.record_fetch = RecordHttpArchiveFetch(
         http_archive, real_dns_lookup, inject_script,
-        cache_misses)
+        cache_misses, prefetch_subresources)
     self.replay_fetch = ReplayHttpArchiveFetch(
         http_archive, real_dns_lookup, inject_script,
         use_diff_on_unknown_requests, cache_misses,
@@ -550,6 +1240,10 @@ class ControllableHttpArchiveFetch(object):
     self.fetch = self.replay_fetch
     self.is_record_mode = False
 
+  def Close(self):
+    """Stop the background work of the record fetch."""
+    self.record_fetch.Close()
+
   def __call__(self, *args, **kwargs):
     """Forward calls to Replay/Record fetch functions depending on mode."""
     return self.fetch(*args, **kwargs)
@@ -13,9 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import BaseHTTPServer
+import re
+import SocketServer
+import StringIO
+import threading
 import unittest
 
+import httparchive
 import httpclient
+import httpzlib
 import platformsettings
 
 
@@ -174,5 +181,471 @@ class RealHttpFetchGetConnectionTest(unittest.TestCase):
     self.assertEqual(8443, connection.port)  # SSL proxy port
 
 
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serve small keep-alive responses and count the opened connections."""
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.num_connections += 1
+
+  def do_GET(self):
+    if self.path.startswith('/chunked'):
+      self.send_chunked_response()
+      return
+    body = 'Hello %s' % self.path
+    self.send_response(200)
+    self.send_header('content-length', str(len(body)))
+    if self.path.startswith('/close'):
+      self.send_header('connection', 'close')
+      self.close_connection = 1
+    self.end_headers()
+    self.wfile.write(body)
+
+  def send_chunked_response(self):
+    """Send two chunks; the second one once the server is allowed to."""
+    self.send_response(200)
+    if self.path.endswith('.html'):
+      self.send_header('content-type', 'text/html')
+    self.send_header('transfer-encoding', 'chunked')
+    self.end_headers()
+    self.wfile.write('5\r\nfirst\r\n')
+    self.wfile.flush()
+    self.server.send_second_chunk.wait()
+    self.wfile.write('6\r\nsecond\r\n0\r\n\r\n')
+
+  def log_message(self, format, *args):
+    pass
+
+
+class KeepAliveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Local stand-in for an origin server."""
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(
+        self, ('127.0.0.1', 0), KeepAliveHandler)
+    self.num_connections = 0
+    self.send_second_chunk = threading.Event()
+
+  def handle_error(self, request, client_address):
+    pass  # Clients close idle keep-alive connections at any time.
+
+  def __enter__(self):
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def __exit__(self, unused_exc_type, unused_exc_val, unused_exc_tb):
+    self.shutdown()
+    self.server_close()
+
+
+class RealHttpFetchConnectionPoolTest(unittest.TestCase):
+  """Test that RealHttpFetch reuses keep-alive connections."""
+
+  def setUp(self):
+    self.server = KeepAliveServer().__enter__()
+    self.host = '127.0.0.1:%d' % self.server.server_address[1]
+    self.pool = httpclient.HttpConnectionPool()
+    self.fetch = httpclient.RealHttpFetch(
+        lambda host: '127.0.0.1', connection_pool=self.pool)
+    self.fetch._get_system_proxy = lambda is_ssl: None
+
+  def tearDown(self):
+    self.pool.close()
+    self.server.__exit__(None, None, None)
+
+  def get(self, path):
+    request = httparchive.ArchivedHttpRequest(
+        'GET', self.host, path, None, {})
+    return self.fetch(request)
+
+  def test_reuses_connection(self):
+    for path in ('/a', '/b', '/c'):
+      response = self.get(path)
+      self.assertEqual(200, response.status)
+      self.assertEqual(['Hello %s' % path], response.response_data)
+    self.assertEqual(1, self.server.num_connections)
+
+  def test_records_connect_delay_only_for_new_connections(self):
+    original_timer = httpclient.TIMER
+    ticks = iter(xrange(1000))
+    httpclient.TIMER = lambda: float(ticks.next())
+    try:
+      first = self.get('/a')
+      second = self.get('/b')
+    finally:
+      httpclient.TIMER = original_timer
+    self.assertEqual(1000, first.delays['connect'])
+    self.assertEqual(0, second.delays['connect'])
+
+  def test_connection_close_is_not_reused(self):
+    self.get('/close')
+    self.get('/a')
+    self.assertEqual(2, self.server.num_connections)
+
+  def test_idle_connection_is_evicted(self):
+    self.pool.max_idle_seconds = 0
+    self.get('/a')
+    self.get('/b')
+    self.assertEqual(2, self.server.num_connections)
+
+  def test_connections_are_keyed_by_host(self):
+    self.get('/a')
+    other_host_request = httparchive.ArchivedHttpRequest(
+        'GET', 'localhost:%d' % self.server.server_address[1], '/b', None, {})
+    self.fetch(other_host_request)
+    self.assertEqual(2, self.server.num_connections)
+
+
+class StreamingFetchTest(unittest.TestCase):
+  """Test that recorded responses are passed through as they arrive."""
+
+  def setUp(self):
+    self.server = KeepAliveServer().__enter__()
+    self.host = '127.0.0.1:%d' % self.server.server_address[1]
+    self.archive = httparchive.HttpArchive()
+    self.record_fetch = httpclient.RecordHttpArchiveFetch(
+        self.archive, lambda host: '127.0.0.1', inject_script=None)
+    self.record_fetch.real_http_fetch._get_system_proxy = lambda is_ssl: None
+
+  def tearDown(self):
+    self.server.send_second_chunk.set()
+    self.server.__exit__(None, None, None)
+
+  def create_request(self, path):
+    return httparchive.ArchivedHttpRequest('GET', self.host, path, None, {})
+
+  def test_first_chunk_is_available_before_body_is_complete(self):
+    request = self.create_request('/chunked')
+    response = self.record_fetch(request)
+    self.assertTrue(
+        isinstance(response, httpclient.StreamingArchivedHttpResponse))
+    chunks = response.iter_chunks()
+    self.assertEqual('first', chunks.next())
+    self.assertNotIn(request, self.archive)
+
+    self.server.send_second_chunk.set()
+    self.assertEqual(['second'], list(chunks))
+    recorded = self.archive[request]
+    self.assertEqual(['first', 'second'], recorded.response_data)
+    self.assertEqual(2, len(recorded.delays['data']))
+    self.assertEqual(200, recorded.status)
+
+  def test_response_is_recorded_when_client_stops_reading(self):
+    request = self.create_request('/chunked')
+    chunks = self.record_fetch(request).iter_chunks()
+    chunks.next()
+    self.server.send_second_chunk.set()
+    chunks.close()
+    self.assertEqual(['first', 'second'], self.archive[request].response_data)
+
+  def test_html_is_buffered(self):
+    self.server.send_second_chunk.set()
+    request = self.create_request('/chunked.html')
+    response = self.record_fetch(request)
+    self.assertFalse(
+        isinstance(response, httpclient.StreamingArchivedHttpResponse))
+    self.assertEqual(['first', 'second'], response.response_data)
+    self.assertEqual(response, self.archive[request])
+
+  def test_non_chunked_response_is_recorded_as_one_chunk(self):
+    request = self.create_request('/a')
+    response = self.record_fetch(request)
+    self.assertEqual(['Hello /a'], list(response.iter_chunks()))
+    self.assertEqual(['Hello /a'], self.archive[request].response_data)
+    self.assertEqual([0], self.archive[request].delays['data'])
+
+
+class InjectScriptsTest(unittest.TestCase):
+  """Test that script-injected responses are cached."""
+
+  def setUp(self):
+    self.archive = httparchive.HttpArchive()
+    self.request = httparchive.ArchivedHttpRequest(
+        'GET', 'a.com', '/', None, {})
+    self.archive[self.request] = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK',
+        [('content-type', 'text/html'), ('content-encoding', 'gzip')],
+        httpzlib.compress_chunks(
+            ['<html><head></head><body></body></html>'], True))
+    self.fetch = httpclient.ReplayHttpArchiveFetch(
+        self.archive, None, inject_script='var x;')
+
+  def test_injected_response_is_reused(self):
+    response = self.fetch(self.request)
+    self.assertTrue(response is self.fetch(self.request))
+    self.assertTrue('var x;' in response.get_data_as_text())
+    # The archived response is not modified.
+    archived_response = self.archive[self.request]
+    self.assertFalse('var x;' in archived_response.get_data_as_text())
+    self.assertEqual(None, archived_response.get_header('content-length'))
+    self.assertEqual(str(sum(len(c) for c in response.response_data)),
+                     response.get_header('content-length'))
+
+  def test_replaced_response_data_is_injected_again(self):
+    response = self.fetch(self.request)
+    archived_response = self.archive[self.request]
+    archived_response.set_data('<html><head></head><p>new</p></html>')
+    new_response = self.fetch(self.request)
+    self.assertFalse(response is new_response)
+    self.assertTrue('<p>new</p>' in new_response.get_data_as_text())
+
+  def test_large_gzip_document_reuses_compressed_tail(self):
+    chunks = ['<html><head></head><body>'] + [
+        '<p>%d %s</p>' % (i, 'x' * (i % 97)) * 400 for i in xrange(8)]
+    compressed_chunks = httpzlib.compress_chunks(chunks, True)
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK',
+        [('content-type', 'text/html'), ('content-encoding', 'gzip')],
+        compressed_chunks)
+    injected_response = httpclient._InjectScripts(response, 'var x;')
+    expected_text = ('<html><head><script>var x;</script></head><body>' +
+                     ''.join(chunks[1:]))
+    self.assertEqual(expected_text, ''.join(httpzlib.uncompress_chunks(
+        injected_response.response_data, True)))
+    # Only the chunks within the deflate window of the script are rewritten.
+    self.assertEqual(len(compressed_chunks),
+                     len(injected_response.response_data))
+    self.assertEqual(compressed_chunks[3:-1],
+                     injected_response.response_data[3:-1])
+
+  def test_identity_document_rewrites_first_chunk(self):
+    chunks = ['<!doctype html><html>', '<body>', 'a' * 20000, 'b']
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('content-type', 'text/html')], chunks)
+    injected_response = httpclient._InjectScripts(response, 'var x;')
+    self.assertEqual(
+        ['<!doctype html><html><script>var x;</script>'] + chunks[1:],
+        injected_response.response_data)
+    self.assertEqual(str(len(''.join(chunks)) + 23),
+                     injected_response.get_header('content-length'))
+    self.assertTrue(injected_response is httpclient._InjectScripts(
+        injected_response, 'var x;'))
+
+  def test_other_responses_are_not_copied(self):
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'a.com', '/a.js', None, {})
+    self.archive[request] = httparchive.create_response(200, body='var a;')
+    self.assertTrue(self.archive[request] is self.fetch(request))
+
+  def test_unaccepted_encoding_is_uncompressed(self):
+    # Matches the archived request, which has no accept-encoding.
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'a.com', '/', None, {'accept-encoding': 'identity'})
+    response = self.fetch(request)
+    self.assertEqual(None, response.get_header('content-encoding'))
+    self.assertEqual(
+        ['<html><head><script>var x;</script></head><body></body></html>'],
+        response.response_data)
+    self.assertTrue(response is self.fetch(request))
+    # Clients that accept gzip get a separate variant.
+    self.assertEqual('gzip',
+                     self.fetch(self.request).get_header('content-encoding'))
+
+  def test_unaccepted_encoding_is_transcoded(self):
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'a.com', '/', None, {'accept-encoding': 'gzip;q=0, deflate'})
+    response = self.fetch(request)
+    self.assertEqual('deflate', response.get_header('content-encoding'))
+    self.assertEqual(
+        '<html><head><script>var x;</script></head><body></body></html>',
+        response.get_data_as_text())
+    self.assertEqual(str(len(response.response_data[0])),
+                     response.get_header('content-length'))
+    self.assertTrue(response is self.fetch(request))
+
+  @unittest.skipIf(httpzlib.brotli_import_error, 'brotli is not installed')
+  def test_brotli_document_is_injected(self):
+    codec = httpzlib.get_codec('br')
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK',
+        [('content-type', 'text/html'), ('content-encoding', 'br')],
+        codec.compress_chunks(['<html><head></head>', '<body></body></html>']))
+    injected_response = httpclient._InjectScripts(response, 'var x;')
+    self.assertEqual('br', injected_response.get_header('content-encoding'))
+    self.assertEqual(
+        ['<html><head><script>var x;</script></head>', '<body></body></html>'],
+        codec.uncompress_chunks(injected_response.response_data))
+
+  def test_unsupported_encoding_is_not_injected(self):
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK',
+        [('content-type', 'text/html'), ('content-encoding', 'x-unknown')],
+        ['<html><head></head></html>'])
+    self.assertTrue(response is httpclient._InjectScripts(response, 'var x;'))
+
+  def test_is_encoding_accepted(self):
+    def IsAccepted(accept_encoding, encoding):
+      headers = {}
+      if accept_encoding is not None:
+        headers['accept-encoding'] = accept_encoding
+      request = httparchive.ArchivedHttpRequest(
+          'GET', 'a.com', '/', None, headers)
+      return httpclient._IsEncodingAccepted(request, encoding)
+    self.assertTrue(IsAccepted(None, 'gzip'))
+    self.assertTrue(IsAccepted('gzip, deflate', 'gzip'))
+    self.assertTrue(IsAccepted('*;q=0.5', 'gzip'))
+    self.assertFalse(IsAccepted('', 'gzip'))
+    self.assertFalse(IsAccepted('deflate', 'gzip'))
+    self.assertFalse(IsAccepted('*, gzip;q=0', 'gzip'))
+
+  def test_choose_encoding(self):
+    def ChooseEncoding(accept_encoding, encoding):
+      headers = [('content-type', 'text/html')]
+      if encoding:
+        headers.append(('content-encoding', encoding))
+      response = httparchive.ArchivedHttpResponse(
+          11, 200, 'OK', headers, [])
+      request = httparchive.ArchivedHttpRequest(
+          'GET', 'a.com', '/', None, {'accept-encoding': accept_encoding})
+      return httpclient._ChooseEncoding(request, response)
+    self.assertEqual('gzip', ChooseEncoding('gzip, deflate', 'gzip'))
+    self.assertEqual(None, ChooseEncoding('gzip, deflate', None))
+    self.assertEqual('x-unknown', ChooseEncoding('deflate', 'x-unknown'))
+    self.assertEqual(None, ChooseEncoding('', 'gzip'))
+    self.assertEqual('deflate', ChooseEncoding('deflate, gzip', 'zstd'))
+    self.assertEqual('gzip',
+                     ChooseEncoding('deflate;q=0.5, gzip;q=0.8', 'zstd'))
+    self.assertEqual('gzip', ChooseEncoding('identity;q=0, gzip', None))
+    self.assertEqual('gzip', ChooseEncoding('*;q=0', 'gzip'))
+
+
+class CallbackRewriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.archive = httparchive.HttpArchive()
+    self.archive[self.create_request('cb1')] = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK',
+        [('content-type', 'application/javascript'),
+         ('content-encoding', 'gzip')],
+        httpzlib.compress_chunks(['cb1({"a": 1});', ' cb1({"b": 2});'], True))
+    rules = [['urlMatches', [u'a.com/api\\?callback=(\\w+)'],
+              'modifyResponse', r'(cb\w+)\(']]
+    self.fetch = httpclient.ControllableHttpArchiveFetch(
+        self.archive, None, None, False, False, rules, None, False, False)
+
+  def create_request(self, callback_name):
+    return httparchive.ArchivedHttpRequest(
+        'GET', 'a.com', '/api?callback=%s' % callback_name, None, {})
+
+  def test_callback_name_is_replaced(self):
+    self.fetch.http_archive[self.create_request('cb2')] = (
+        self.archive[self.create_request('cb1')])
+    response = self.fetch(self.create_request('cb2'))
+    self.assertEqual(['cb2({"a": 1});', ' cb2({"b": 2});'],
+                     httpzlib.uncompress_chunks(response.response_data, True))
+    self.assertTrue(response is self.fetch(self.create_request('cb2')))
+    # The archived response is not modified.
+    archived_response = self.archive[self.create_request('cb1')]
+    self.assertEqual(['cb1({"a": 1});', ' cb1({"b": 2});'],
+                     httpzlib.uncompress_chunks(
+                         archived_response.response_data, True))
+    self.assertTrue(
+        archived_response is self.fetch(self.create_request('cb1')))
+
+  def test_callback_name_across_chunks(self):
+    request = self.create_request('callback2')
+    self.archive[request] = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('content-type', 'application/javascript'),
+                        ('content-encoding', 'gzip')],
+        httpzlib.compress_chunks(['x; c', 'b1({});', ' cb1(', '[]);'], True))
+    response = self.fetch(request)
+    self.assertEqual(['x; callback2', '({});', ' callback2(', '[]);'],
+                     httpzlib.uncompress_chunks(response.response_data, True))
+
+  def test_replace_group_in_chunks(self):
+    pattern = re.compile(r'(cb\w+)\(')
+    self.assertEqual(['a', 'bb'], httpclient._ReplaceGroupInChunks(
+        pattern, ['a', 'bb'], 'x'))
+    self.assertEqual(['x', '(1)', ';x(2)'], httpclient._ReplaceGroupInChunks(
+        pattern, ['c', 'b1(1)', ';cb2(2)'], 'x'))
+    self.assertEqual(['long', '', '(1)'], httpclient._ReplaceGroupInChunks(
+        pattern, ['c', 'b1', '(1)'], 'long'))
+
+  def test_identity_body(self):
+    request = httparchive.ArchivedHttpRequest(
+        'GET', 'a.com', '/api?callback=cb3', None, {})
+    self.archive[request] = httparchive.create_response(
+        200, body='cb0([]);')
+    self.assertEqual(['cb3([]);'], self.fetch(request).response_data)
+    self.fetch.SetRecordMode()
+    self.assertEqual(['cb3([]);'], self.fetch(request).response_data)
+    self.assertEqual(['cb0([]);'], self.archive[request].response_data)
+
+
+@unittest.skipIf(httpclient.Image is None, 'PIL is not installed')
+class ScrambleImagesTest(unittest.TestCase):
+
+  def setUp(self):
+    image = httpclient.Image.new('RGB', (20, 10))
+    image.putdata([(i, 2 * i, 50) for i in xrange(200)])
+    image_io = StringIO.StringIO()
+    image.save(image_io, 'PNG')
+    image_data = image_io.getvalue()
+    self.archive = httparchive.HttpArchive()
+    self.request = httparchive.ArchivedHttpRequest(
+        'GET', 'a.com', '/a.png', None, {})
+    self.archive[self.request] = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('content-type', 'image/png')],
+        [image_data[:100], image_data[100:]],
+        {'connect': 0, 'headers': 0, 'data': [0, 0]})
+    self.fetch = httpclient.ReplayHttpArchiveFetch(
+        self.archive, None, inject_script=None, scramble_images=True)
+
+  def get_pixels(self, response):
+    return list(httpclient.Image.open(
+        StringIO.StringIO(''.join(response.response_data))).getdata())
+
+  def test_scrambled_image_is_cached(self):
+    response = self.fetch(self.request)
+    archived_response = self.archive[self.request]
+    self.assertFalse(response is archived_response)
+    self.assertTrue(response is self.fetch(self.request))
+    self.assertEqual(2, len(response.response_data))
+    pixels = self.get_pixels(response)
+    archived_pixels = self.get_pixels(archived_response)
+    self.assertNotEqual(archived_pixels, pixels)
+    self.assertEqual(sorted(archived_pixels), sorted(pixels))
+
+  def test_scrambling_is_deterministic(self):
+    response = self.archive[self.request]
+    pixels = self.get_pixels(httpclient._ScrambleImages(response))
+    self.assertEqual(pixels,
+                     self.get_pixels(httpclient._ScrambleImages(response)))
+    # The pixels are shuffled the same way with and without NumPy.
+    numpy = httpclient.numpy
+    httpclient.numpy = None
+    try:
+      scrambled_response = httpclient._ScrambleImages(response)
+    finally:
+      httpclient.numpy = numpy
+    self.assertEqual(pixels, self.get_pixels(scrambled_response))
+
+  def test_split_data_has_no_empty_chunks(self):
+    self.assertEqual(['abc', 'de', 'fg'], httpclient._SplitData('abcdefg', 3))
+    self.assertEqual(['a', 'b'], httpclient._SplitData('ab', 5))
+    self.assertEqual([''], httpclient._SplitData('', 2))
+
+  def test_set_split_response_data_merges_delays(self):
+    delays = {'connect': 0, 'headers': 0, 'data': [1, 2, 3, 4]}
+    response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('transfer-encoding', 'chunked')],
+        ['a', 'b', 'c', 'd'], delays)
+    httpclient._SetSplitResponseData(response, 'xy')
+    self.assertEqual(['x', 'y'], response.response_data)
+    self.assertEqual([1, 9], response.delays['data'])
+    self.assertEqual([1, 2, 3, 4], delays['data'])
+
+  def test_other_responses_are_not_scrambled(self):
+    for headers, data in (([('content-type', 'text/html')], ['<html>']),
+                          ([('content-type', 'image/png')], ['not a png'])):
+      response = httparchive.ArchivedHttpResponse(
+          11, 200, 'OK', headers, data)
+      self.assertTrue(response is httpclient._ScrambleImages(response))
+
+
 if __name__ == '__main__':
   unittest.main()
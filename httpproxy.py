@@ -68,6 +68,13 @@ class HttpArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   def log_error(self, format, *args): logging.error(format, *args)
   def log_message(self, format, *args): logging.info(format, *args)
 
+  def date_time_string(self, timestamp=None):
+    """Override BaseHTTPRequestHandler method to use the replay clock."""
+    if timestamp is None:
+      return httparchive.get_replay_date()
+    return BaseHTTPServer.BaseHTTPRequestHandler.date_time_string(
+        self, timestamp)
+
   def read_request_body(self):
     request_body = None
     length = int(self.headers.get('content-length', 0)) or None
@@ -90,6 +97,32 @@ class HttpArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     query = '?%s' % parsed.query if parsed.query else ''
     fragment = '#%s' % parsed.fragment if parsed.fragment else ''
     full_path = '%s%s%s%s' % (parsed.path, params, query, fragment)
+
+    repr_path, exclude_headers, error_status = self.apply_server_rules(
+        host, full_path)
+    if error_status:
+      self.send_error(error_status)
+      return None
+
+    return httparchive.ArchivedHttpRequest(
+        self.command,
+        host,
+        full_path,
+        self.read_request_body(),
+        self.get_header_dict(),
+        self.server.is_ssl,
+        repr_path,
+        exclude_headers)
+
+  def apply_server_rules(self, host, full_path):
+    """Apply the server rules to a request for |host| and |full_path|.
+
+    Returns:
+      (repr_path, exclude_headers, error_status) where repr_path is the path
+      to match archived requests with, exclude_headers are the headers to
+      leave out of the match, and error_status is the status to send instead
+      of a response (or None).
+    """
     repr_path = full_path
 
     # remove all designated groups from the matched URL.
@@ -110,26 +143,18 @@ class HttpArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                       else 'replay'), full_path, repr_path)
 
     exclude_headers = []
+    url_path = urlparse.urlparse(full_path).path
     for path, undesirable_key in self.server.undesirable_headers.items():
-      if re.match(r'%s' % path, parsed.path):
+      if re.match(r'%s' % path, url_path):
         exclude_headers.append(undesirable_key)
 
     for path, status in self.server.error_paths:
       if path.match('%s%s' % (host, full_path)):
         logging.debug('Send %d for %s%s', status, host, full_path)
         logging.debug(path.pattern)
-        self.send_error(status)
-        return None
+        return repr_path, exclude_headers, status
 
-    return httparchive.ArchivedHttpRequest(
-        self.command,
-        host,
-        full_path,
-        self.read_request_body(),
-        self.get_header_dict(),
-        self.server.is_ssl,
-        repr_path,
-        exclude_headers)
+    return repr_path, exclude_headers, None
 
   def send_archived_http_response(self, response):
     try:
@@ -143,10 +168,11 @@ class HttpArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.protocol_version = 'HTTP/1.0'
 
       # If we don't have chunked encoding and there is no content length,
-      # we need to manually compute the content-length.
+      # we need to manually compute the content-length. The response is not
+      # modified, since it can be shared by other requests.
+      content_length = None
       if not is_chunked and not has_content_length:
         content_length = sum(len(c) for c in response.response_data)
-        response.headers.append(('content-length', str(content_length)))
 
       is_replay = not self.server.http_archive_fetch.is_record_mode
       if is_replay and self.server.traffic_shaping_delay_ms:
@@ -166,17 +192,33 @@ class HttpArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
           self.send_header(header, response.update_date(value))
         elif header not in ('date', 'server'):
           self.send_header(header, value)
+      if content_length is not None:
+        self.send_header('content-length', str(content_length))
       self.end_headers()
 
-      for chunk, delay in zip(response.response_data, delays):
-        if delay:
-          self.wfile.flush()
-          time.sleep(delay / 1000.0)
-        if is_chunked:
-          # Write chunk length (hex) and data (e.g. "A\r\nTESSELATED\r\n").
-          self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
-        else:
-          self.wfile.write(chunk)
+      # Responses being recorded may be streamed from the server as they
+      # arrive (see httpclient.StreamingArchivedHttpResponse).
+      is_streaming = hasattr(response, 'iter_chunks')
+      if is_streaming:
+        streamed_chunks = response.iter_chunks()
+        chunks = ((chunk, 0) for chunk in streamed_chunks)
+      else:
+        chunks = zip(response.response_data, delays)
+      try:
+        for chunk, delay in chunks:
+          if delay:
+            self.wfile.flush()
+            time.sleep(delay / 1000.0)
+          if is_chunked:
+            # Write chunk length (hex) and data (e.g. "A\r\nTESSELATED\r\n").
+            self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+          else:
+            self.wfile.write(chunk)
+          if is_streaming:
+            self.wfile.flush()
+      finally:
+        if is_streaming:
+          streamed_chunks.close()
       if is_chunked:
         self.wfile.write('0\r\n\r\n')  # write final, zero-length chunk.
       self.wfile.flush()
@@ -274,7 +316,7 @@ class HttpProxyServer(SocketServer.ThreadingMixIn,
     """Start HTTP server.
 
     Args:
-      host: a host string (name or IP) for the web proxy.
+      host: a host string (name, IPv4 or IPv6 address) for the web proxy.
       port: a port string (e.g. '80') for the web proxy.
       use_delays: if True, add response data delays during replay.
       is_ssl: True iff proxy is using SSL.
@@ -283,6 +325,8 @@ class HttpProxyServer(SocketServer.ThreadingMixIn,
            Bandwidths measured in [K|M]{bit/s|Byte/s}. '0' means unlimited.
       delay_ms: Propagation delay in milliseconds. '0' means no delay.
     """
+    if ':' in host:
+      self.address_family = socket.AF_INET6
     try:
       BaseHTTPServer.HTTPServer.__init__(self, (host, port), self.HANDLER)
     except Exception, e:
@@ -356,13 +400,26 @@ class HttpProxyServer(SocketServer.ThreadingMixIn,
 class HttpsProxyServer(HttpProxyServer):
   """SSL server that generates certs for each host."""
 
+  # Protocols to negotiate with ALPN (None to skip ALPN).
+  ALPN_PROTOCOLS = None
+
   def __init__(self, http_archive_fetch, custom_handlers,
-               https_root_ca_cert_path, **kwargs):
+               https_root_ca_cert_path, protocol='HTTPS', **kwargs):
     self.ca_cert_path = https_root_ca_cert_path
-    self.HANDLER = sslproxy.wrap_handler(HttpArchiveHandler)
+    self.HANDLER = sslproxy.wrap_handler(self.HANDLER)
     HttpProxyServer.__init__(self, http_archive_fetch, custom_handlers,
-                             is_ssl=True, protocol='HTTPS', **kwargs)
+                             is_ssl=True, protocol=protocol, **kwargs)
     self.http_archive_fetch.http_archive.set_root_cert(https_root_ca_cert_path)
+    self.ssl_context_cache = sslproxy.SslContextCache(
+        https_root_ca_cert_path,
+        self.http_archive_fetch.http_archive.get_certificate,
+        self.ALPN_PROTOCOLS)
+
+  def cleanup(self):
+    HttpProxyServer.cleanup(self)
+    handshake_count, resumed_count = self.ssl_context_cache.get_stats()
+    logging.info('%s handshakes: %d (%d resumed sessions)', self.protocol,
+                 handshake_count, resumed_count)
 
 
 class SingleCertHttpsProxyServer(HttpProxyServer):
@@ -13,11 +13,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Apply gzip/deflate to separate chunks of data."""
+"""Apply content-encodings to separate chunks of data.
+
+Each content-encoding has a Codec in a registry (see get_codec). gzip and
+deflate are always available. br and zstd are available if the brotli or
+zstandard packages are installed. Other codecs, such as pure-Python ones,
+may be added with register_codec().
+
+Data is recompressed with compression level 6 by default. The level and
+strategy, and whether recompressed gzip data should be as large as the
+original data, are set with set_compression_options().
+"""
 
 import struct
 import zlib
 
+brotli_import_error = None
+try:
+  import brotli
+except ImportError, e:
+  brotli_import_error = e
+
+zstd_import_error = None
+try:
+  import zstandard
+except ImportError, e:
+  zstd_import_error = e
+
 GZIP_HEADER = (
     '\037\213'             # magic header
     '\010'                 # compression method
@@ -25,30 +47,136 @@ GZIP_HEADER = (
     '\000\000\000\000'     # packed time (use zero)
     '\002'
     '\377')
+GZIP_FLAGS_INDEX = 3
+GZIP_FCOMMENT = 0x10
 
+DEFAULT_LEVEL = 6
+STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman_only': zlib.Z_HUFFMAN_ONLY,
+    # Python 2 does not define these, but zlib supports them since 1.2.
+    'rle': getattr(zlib, 'Z_RLE', 3),
+    'fixed': getattr(zlib, 'Z_FIXED', 4),
+    }
 
-def compress_chunks(uncompressed_chunks, use_gzip):
-  """Compress a list of data with gzip or deflate.
+_compression_level = DEFAULT_LEVEL
+_compression_strategy = zlib.Z_DEFAULT_STRATEGY
+_match_original_size = False
+
+# Compressors end a Z_SYNC_FLUSH with an empty stored block. The next block
+# starts on a byte boundary.
+SYNC_FLUSH_MARKER = '\000\000\377\377'
+
+# Compressed data may refer back this many bytes of uncompressed data.
+DEFLATE_WINDOW_SIZE = 32768
+
+CRC32_POLYNOMIAL = 0xedb88320L
+
+
+def _gf2_multiply(a, b):
+  """Multiply polynomials |a| and |b| modulo the CRC-32 polynomial.
+
+  The polynomials use the reflected bit order of CRC-32 (x^0 is the most
+  significant bit).
+  """
+  product = 0
+  bit = 1 << 31
+  while a:
+    if a & bit:
+      product ^= b
+      a ^= bit
+    bit >>= 1
+    b = (b >> 1) ^ CRC32_POLYNOMIAL if b & 1 else b >> 1
+  return product
+
+
+def _get_x2n_table():
+  """Return [x^(2^n) modulo the CRC-32 polynomial for n in 0..31]."""
+  table = [1 << 30]  # x^1
+  for _ in xrange(31):
+    table.append(_gf2_multiply(table[-1], table[-1]))
+  return table
+
+_X2N_TABLE = _get_x2n_table()
 
-  The returned chunks may be used with HTTP chunked encoding.
+
+def crc32_combine(crc1, crc2, len2):
+  """Return the CRC-32 of A + B given crc32(A), crc32(B) and len(B).
+
+  Same as zlib's crc32_combine(), which Python does not expose.
+  """
+  crc1 &= 0xffffffffL
+  if not crc1:
+    return crc2 & 0xffffffffL
+  # Multiply crc1 by x^(8 * len2).
+  shift = 1 << 31  # x^0
+  n = 3
+  while len2:
+    if len2 & 1:
+      shift = _gf2_multiply(_X2N_TABLE[n & 31], shift)
+    len2 >>= 1
+    n += 1
+  return _gf2_multiply(shift, crc1) ^ (crc2 & 0xffffffffL)
+
+
+def set_compression_options(level=DEFAULT_LEVEL, strategy='default',
+                            match_original_size=False):
+  """Set how compress_chunks() recompresses data by default.
 
   Args:
-    uncompressed_chunks: a list of strings
-       (e.g. ["this is the first chunk", "and the second"])
-    use_gzip: if True, compress with gzip. Otherwise, use deflate.
+    level: a zlib compression level from 0 (none) and 1 (fastest) to 9
+       (smallest), or -1 for the default level of each codec. Codecs with
+       more levels, such as br, lower levels above their maximum to it.
+    strategy: a key of STRATEGIES.
+    match_original_size: if True, data that replaces compressed data is
+       compressed to the size of the original data where possible (see
+       compress_chunks).
+  """
+  global _compression_level, _compression_strategy, _match_original_size
+  if strategy not in STRATEGIES:
+    raise ValueError('Unknown compression strategy: %s (expected one of %s)' %
+                     (strategy, ', '.join(sorted(STRATEGIES))))
+  _compression_level = level
+  _compression_strategy = STRATEGIES[strategy]
+  _match_original_size = match_original_size
 
-  Returns:
-    [compressed_chunk_1, compressed_chunk_2, ...]
+
+def get_target_size(compressed_chunks):
+  """Return the size to recompress |compressed_chunks| to, or None.
+
+  The size is only matched with set_compression_options(
+  match_original_size=True).
   """
+  if _match_original_size:
+    return sum(len(c) for c in compressed_chunks)
+  return None
+
+
+def _pad_gzip_header(compressed_chunks, num_bytes):
+  """Grow gzip data by |num_bytes| (> 0) with a header comment."""
+  header = compressed_chunks[0][:len(GZIP_HEADER)]
+  flags = ord(header[GZIP_FLAGS_INDEX]) | GZIP_FCOMMENT
+  header = (header[:GZIP_FLAGS_INDEX] + chr(flags) +
+            header[GZIP_FLAGS_INDEX + 1:])
+  comment = ' ' * (num_bytes - 1) + '\000'
+  return ([header + comment + compressed_chunks[0][len(GZIP_HEADER):]] +
+          compressed_chunks[1:])
+
+
+def _compress_zlib_chunks(uncompressed_chunks, use_gzip, finish, level,
+                          strategy):
+  """Compress with gzip or deflate (see Codec.compress_chunks)."""
   if use_gzip:
     size = 0
     crc = zlib.crc32("") & 0xffffffffL
     compressor = zlib.compressobj(
-        6, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+        level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, strategy)
   else:
-    compressor = zlib.compressobj()
+    compressor = zlib.compressobj(
+        level, zlib.DEFLATED, zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, strategy)
   compressed_chunks = []
-  last_index = len(uncompressed_chunks) - 1
+  last_index = len(uncompressed_chunks) - (1 if finish else 0)
   for index, data in enumerate(uncompressed_chunks):
     chunk = ''
     if use_gzip:
@@ -69,6 +197,246 @@ def compress_chunks(uncompressed_chunks, use_gzip):
   return compressed_chunks
 
 
+def _is_zlib_header(data):
+  """Return True if |data| starts with a zlib header (RFC 1950)."""
+  return (len(data) >= 2 and ord(data[0]) & 0x0f == zlib.DEFLATED and
+          (ord(data[0]) << 8 | ord(data[1])) % 31 == 0)
+
+
+class Codec(object):
+  """Compress and uncompress lists of chunks with one content-encoding.
+
+  Subclasses implement _compress_chunks() and iter_uncompress_chunks().
+  Codecs that need an optional module set import_error if it is missing.
+  """
+
+  encoding = None
+  default_level = 6  # Used for level -1.
+  max_level = 9
+  import_error = None
+
+  def _compress_chunks(self, uncompressed_chunks, finish, level, strategy):
+    raise NotImplementedError
+
+  def _pad(self, compressed_chunks, num_bytes):
+    """Return |compressed_chunks| grown by |num_bytes|, if the format can."""
+    return compressed_chunks
+
+  def compress_chunks(self, uncompressed_chunks, finish=True, level=None,
+                      strategy=None, target_size=None):
+    """Compress a list of data.
+
+    The returned chunks may be used with HTTP chunked encoding. Each chunk
+    ends with a flush, so that it can be uncompressed as it arrives.
+
+    Args:
+      uncompressed_chunks: a list of strings
+         (e.g. ["this is the first chunk", "and the second"])
+      finish: if False, end the last chunk with a flush instead of the end
+         of the stream, so that more compressed data may follow.
+      level: the compression level (see set_compression_options). -1 is
+         the default_level of the codec, and levels above max_level are
+         lowered to it.
+      strategy: the zlib compression strategy (a value of STRATEGIES).
+         Ignored by codecs other than gzip and deflate.
+      target_size: if set, raise the level (from at least 1) until the data
+         is no larger than this many bytes. Smaller data is padded up to it
+         where the format allows (gzip only), so byte counts and transfer
+         times under traffic shaping stay the same as for the original data.
+
+    Returns:
+      [compressed_chunk_1, compressed_chunk_2, ...]
+    """
+    if level is None:
+      level = _compression_level
+    if level == -1:
+      level = self.default_level
+    level = max(0, min(level, self.max_level))
+    if target_size is not None:
+      # Level 0 stores the data, so it is never the smallest.
+      level = max(level, 1)
+    if strategy is None:
+      strategy = _compression_strategy
+    while True:
+      compressed_chunks = self._compress_chunks(
+          uncompressed_chunks, finish, level, strategy)
+      if target_size is None:
+        return compressed_chunks
+      size = sum(len(c) for c in compressed_chunks)
+      if size > target_size and level < self.max_level:
+        level += 1
+        continue
+      if size < target_size:
+        compressed_chunks = self._pad(compressed_chunks, target_size - size)
+      return compressed_chunks
+
+  def iter_uncompress_chunks(self, compressed_chunks):
+    """Yield the uncompressed chunks one at a time.
+
+    Stopping early skips the work for the remaining chunks.
+    """
+    raise NotImplementedError
+
+  def uncompress_chunks(self, compressed_chunks):
+    """Return [uncompressed_chunk_1, uncompressed_chunk_2, ...]."""
+    return list(self.iter_uncompress_chunks(compressed_chunks))
+
+
+class GzipCodec(Codec):
+  encoding = 'gzip'
+
+  def _compress_chunks(self, uncompressed_chunks, finish, level, strategy):
+    return _compress_zlib_chunks(
+        uncompressed_chunks, True, finish, level, strategy)
+
+  def _pad(self, compressed_chunks, num_bytes):
+    return _pad_gzip_header(compressed_chunks, num_bytes)
+
+  def iter_uncompress_chunks(self, compressed_chunks):
+    decompress = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    for c in compressed_chunks:
+      yield decompress(c)
+
+
+class DeflateCodec(Codec):
+  """The zlib format (RFC 7230 4.2.2).
+
+  Some servers send raw deflate data instead, so that is uncompressed too.
+  """
+
+  encoding = 'deflate'
+
+  def _compress_chunks(self, uncompressed_chunks, finish, level, strategy):
+    return _compress_zlib_chunks(
+        uncompressed_chunks, False, finish, level, strategy)
+
+  def iter_uncompress_chunks(self, compressed_chunks):
+    decompress = None
+    for c in compressed_chunks:
+      if decompress is None and c:
+        wbits = zlib.MAX_WBITS if _is_zlib_header(c) else -zlib.MAX_WBITS
+        decompress = zlib.decompressobj(wbits).decompress
+      yield decompress(c) if decompress else ''
+
+
+class BrotliCodec(Codec):
+  """Brotli (RFC 7932). Levels are brotli qualities.
+
+  Requires the brotli package (https://pypi.python.org/pypi/Brotli).
+  """
+
+  encoding = 'br'
+  default_level = 11
+  max_level = 11
+  import_error = brotli_import_error
+
+  def _compress_chunks(self, uncompressed_chunks, finish, level, strategy):
+    compressor = brotli.Compressor(quality=level)
+    compressed_chunks = []
+    last_index = len(uncompressed_chunks) - (1 if finish else 0)
+    for index, data in enumerate(uncompressed_chunks):
+      chunk = compressor.process(data)
+      if index < last_index:
+        chunk += compressor.flush()
+      else:
+        chunk += compressor.finish()
+      compressed_chunks.append(chunk)
+    return compressed_chunks
+
+  def iter_uncompress_chunks(self, compressed_chunks):
+    decompressor = brotli.Decompressor()
+    for c in compressed_chunks:
+      yield decompressor.process(c)
+
+
+class ZstdCodec(Codec):
+  """Zstandard (RFC 8878).
+
+  Requires the zstandard package (https://pypi.python.org/pypi/zstandard).
+  """
+
+  encoding = 'zstd'
+  default_level = 3
+  max_level = 19
+  import_error = zstd_import_error
+
+  def _compress_chunks(self, uncompressed_chunks, finish, level, strategy):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    compressed_chunks = []
+    last_index = len(uncompressed_chunks) - (1 if finish else 0)
+    for index, data in enumerate(uncompressed_chunks):
+      chunk = compressor.compress(data)
+      if index < last_index:
+        chunk += compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+      else:
+        chunk += compressor.flush()
+      compressed_chunks.append(chunk)
+    return compressed_chunks
+
+  def iter_uncompress_chunks(self, compressed_chunks):
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    for c in compressed_chunks:
+      yield decompressor.decompress(c)
+
+
+_CODECS = {}  # {content-encoding: Codec}
+
+
+def register_codec(codec):
+  """Use |codec| for its content-encoding, replacing any previous codec."""
+  _CODECS[codec.encoding] = codec
+
+
+def get_codec(encoding):
+  """Return the Codec for the content-encoding |encoding| or None.
+
+  None is returned for unknown encodings and for codecs whose optional
+  module is missing.
+  """
+  codec = _CODECS.get(encoding and encoding.strip().lower())
+  if codec and not codec.import_error:
+    return codec
+  return None
+
+
+def get_encodings():
+  """Return the content-encodings that can be compressed and uncompressed."""
+  return sorted(e for e in _CODECS if get_codec(e))
+
+
+_GZIP_CODEC = GzipCodec()
+_DEFLATE_CODEC = DeflateCodec()
+for _codec in (_GZIP_CODEC, _DEFLATE_CODEC, BrotliCodec(), ZstdCodec()):
+  register_codec(_codec)
+
+
+def compress_chunks(uncompressed_chunks, use_gzip, finish=True, level=None,
+                    strategy=None, target_size=None):
+  """Compress a list of data with gzip or deflate.
+
+  Args:
+    uncompressed_chunks: a list of strings
+       (e.g. ["this is the first chunk", "and the second"])
+    use_gzip: if True, compress with gzip. Otherwise, use deflate.
+    finish, level, strategy, target_size: see Codec.compress_chunks.
+
+  Returns:
+    [compressed_chunk_1, compressed_chunk_2, ...]
+  """
+  codec = _GZIP_CODEC if use_gzip else _DEFLATE_CODEC
+  return codec.compress_chunks(uncompressed_chunks, finish, level, strategy,
+                               target_size)
+
+
+def iter_uncompress_chunks(compressed_chunks, use_gzip):
+  """Yield the uncompressed chunks one at a time (see uncompress_chunks).
+
+  Stopping early skips the work for the remaining chunks.
+  """
+  codec = _GZIP_CODEC if use_gzip else _DEFLATE_CODEC
+  return codec.iter_uncompress_chunks(compressed_chunks)
+
+
 def uncompress_chunks(compressed_chunks, use_gzip):
   """Uncompress a list of data compressed with gzip or deflate.
 
@@ -79,8 +447,50 @@ def uncompress_chunks(compressed_chunks, use_gzip):
   Returns:
     [uncompressed_chunk_1, uncompressed_chunk_2, ...]
   """
-  if use_gzip:
-    decompress = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
-  else:
-    decompress = zlib.decompressobj(-zlib.MAX_WBITS).decompress
-  return [decompress(c) for c in compressed_chunks]
+  return list(iter_uncompress_chunks(compressed_chunks, use_gzip))
+
+
+def replace_gzip_prefix(compressed_chunks, uncompressed_prefix,
+                        new_uncompressed_prefix, target_size=None):
+  """Replace the first chunks of gzip data without recompressing the rest.
+
+  The replacement chunks are compressed and followed by the remaining
+  compressed chunks as they are. Only the CRC-32 and size at the end of the
+  data are updated.
+
+  Args:
+    compressed_chunks: a list of gzip compressed data.
+    uncompressed_prefix: the first N chunks of |compressed_chunks|,
+       uncompressed. Chunk N must end with a sync flush and must not be the
+       last chunk.
+    new_uncompressed_prefix: N strings to replace |uncompressed_prefix|.
+       The last DEFLATE_WINDOW_SIZE bytes must be unchanged, since the
+       remaining compressed data may refer back to them.
+    target_size: if set, compress the new chunks to this many bytes
+       (see compress_chunks).
+
+  Returns:
+    [compressed_chunk_1, compressed_chunk_2, ...]
+  """
+  num_chunks = len(uncompressed_prefix)
+  assert len(new_uncompressed_prefix) == num_chunks
+  assert compressed_chunks[num_chunks - 1].endswith(SYNC_FLUSH_MARKER)
+  old_crc = new_crc = zlib.crc32('')
+  for data in uncompressed_prefix:
+    old_crc = zlib.crc32(data, old_crc)
+  for data in new_uncompressed_prefix:
+    new_crc = zlib.crc32(data, new_crc)
+  old_prefix_size = sum(len(data) for data in uncompressed_prefix)
+  new_prefix_size = sum(len(data) for data in new_uncompressed_prefix)
+
+  last_chunk = compressed_chunks[-1]
+  crc, size = struct.unpack('<LL', last_chunk[-8:])
+  # The CRC-32 is linear, so only the difference of the prefix CRCs has to
+  # be shifted past the remaining data.
+  suffix_size = (size - old_prefix_size) & 0xffffffffL
+  crc ^= crc32_combine(old_crc ^ new_crc, 0, suffix_size)
+  size = (size + new_prefix_size - old_prefix_size) & 0xffffffffL
+  return (compress_chunks(new_uncompressed_prefix, True, finish=False,
+                          target_size=target_size) +
+          list(compressed_chunks[num_chunks:-1]) +
+          [last_chunk[:-8] + struct.pack('<LL', crc, size)])
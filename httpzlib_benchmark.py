@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the recompressed sizes and times of the bodies in an archive.
+
+Every compressed response of the archive (any content-encoding with an
+httpzlib codec) is uncompressed and compressed again with each compression
+level and strategy, and once more with its original size as the target.
+Strategies only apply to gzip and deflate. The totals are compared to the
+recorded compressed sizes.
+
+Usage:
+  ./httpzlib_benchmark.py archive.wpr
+  ./httpzlib_benchmark.py --levels 1,6,9 --strategies default archive.wpr
+"""
+
+import optparse
+import sys
+import time
+
+import httparchive
+import httpzlib
+
+
+def _GetCompressedBodies(archive):
+  """Return [(compressed_chunks, uncompressed_chunks, codec), ...]."""
+  bodies = []
+  for request in archive:
+    response = archive[request]
+    codec = response.get_codec()
+    if not codec:
+      continue
+    try:
+      uncompressed_chunks = codec.uncompress_chunks(response.response_data)
+    except Exception:  # Each codec module has its own errors.
+      continue
+    bodies.append((response.response_data, uncompressed_chunks, codec))
+  return bodies
+
+
+def _Measure(bodies, **kwargs):
+  """Return (total compressed size, total seconds) with |kwargs| options."""
+  size = 0
+  start_time = time.time()
+  for compressed_chunks, uncompressed_chunks, codec in bodies:
+    if kwargs.get('target_size'):
+      kwargs['target_size'] = sum(len(c) for c in compressed_chunks)
+    size += sum(len(c) for c in codec.compress_chunks(
+        uncompressed_chunks, **kwargs))
+  return size, time.time() - start_time
+
+
+def main():
+  option_parser = optparse.OptionParser(
+      usage='%prog [options] archive', description=__doc__)
+  option_parser.add_option('--levels', default='1,6,9',
+      action='store',
+      type='string',
+      help='Comma-separated compression levels to measure.')
+  option_parser.add_option('--strategies',
+      default=','.join(sorted(httpzlib.STRATEGIES)),
+      action='store',
+      type='string',
+      help='Comma-separated compression strategies to measure.')
+  options, args = option_parser.parse_args()
+  if len(args) != 1:
+    option_parser.error('Must specify an archive')
+
+  bodies = _GetCompressedBodies(httparchive.HttpArchive.Load(args[0]))
+  original_size = sum(sum(len(c) for c in compressed_chunks)
+                      for compressed_chunks, _, _ in bodies)
+  uncompressed_size = sum(sum(len(c) for c in uncompressed_chunks)
+                          for _, uncompressed_chunks, _ in bodies)
+  print '%d compressed responses: %d bytes (%d uncompressed)' % (
+      len(bodies), original_size, uncompressed_size)
+  for encoding in httpzlib.get_encodings():
+    count = len([b for b in bodies if b[2].encoding == encoding])
+    if count:
+      print '  %s: %d responses' % (encoding, count)
+  if not bodies:
+    return 0
+  for strategy in options.strategies.split(','):
+    for level in [int(l) for l in options.levels.split(',')]:
+      size, elapsed = _Measure(bodies, level=level,
+                               strategy=httpzlib.STRATEGIES[strategy])
+      print 'level %d %s: %d bytes (%+.1f%%) in %.1fms' % (
+          level, strategy, size, 100.0 * (size - original_size) / original_size,
+          elapsed * 1000.0)
+  size, elapsed = _Measure(bodies, target_size=True)
+  print 'original size target: %d bytes (%+.1f%%) in %.1fms' % (
+      size, 100.0 * (size - original_size) / original_size, elapsed * 1000.0)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import unittest
+import zlib
+
+import httpzlib
+
+
+def _gunzip(compressed_chunks):
+  """Uncompress gzip data and check its CRC-32 and size."""
+  decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  data = decompressor.decompress(''.join(compressed_chunks))
+  data += decompressor.flush()
+  assert not decompressor.unused_data
+  return data
+
+
+def _random_text(size, seed):
+  words = ['alpha', 'beta', 'gamma', 'delta', '<p>', '</p>', '\n']
+  rand = random.Random(seed)
+  return ' '.join(rand.choice(words) for _ in xrange(size // 5))[:size]
+
+
+class HttpZlibTest(unittest.TestCase):
+
+  def tearDown(self):
+    httpzlib.set_compression_options()
+
+  def test_crc32_combine(self):
+    for a, b in (('', 'abc'), ('abc', ''), ('hello ', 'world'),
+                 (_random_text(1000, 1), _random_text(70000, 2))):
+      self.assertEqual(
+          zlib.crc32(a + b) & 0xffffffffL,
+          httpzlib.crc32_combine(zlib.crc32(a), zlib.crc32(b), len(b)))
+
+  def test_compress_chunks_round_trip(self):
+    chunks = ['first', 'second', '', 'third']
+    for use_gzip in (True, False):
+      compressed_chunks = httpzlib.compress_chunks(chunks, use_gzip)
+      self.assertEqual(4, len(compressed_chunks))
+    self.assertEqual(''.join(chunks), _gunzip(
+        httpzlib.compress_chunks(chunks, True)))
+    self.assertEqual(chunks, httpzlib.uncompress_chunks(
+        httpzlib.compress_chunks(chunks, True), True))
+
+  def test_unfinished_chunks_end_with_sync_flush(self):
+    compressed_chunks = httpzlib.compress_chunks(['a', 'b'], True, finish=False)
+    for chunk in compressed_chunks:
+      self.assertTrue(chunk.endswith(httpzlib.SYNC_FLUSH_MARKER))
+    self.assertEqual(['a', 'b'], httpzlib.uncompress_chunks(
+        compressed_chunks, True))
+
+  def test_replace_gzip_prefix(self):
+    chunks = [_random_text(20000, i) for i in xrange(6)]
+    compressed_chunks = httpzlib.compress_chunks(chunks, True)
+    new_prefix = ['<script>x</script>' + chunks[0]] + chunks[1:3]
+    new_chunks = httpzlib.replace_gzip_prefix(
+        compressed_chunks, chunks[:3], new_prefix)
+    self.assertEqual(''.join(new_prefix + chunks[3:]), _gunzip(new_chunks))
+    self.assertEqual(6, len(new_chunks))
+    self.assertEqual(compressed_chunks[3:5], new_chunks[3:5])
+
+  def test_compression_options(self):
+    chunks = [_random_text(20000, 1)]
+    sizes = {}
+    for level, strategy in ((1, 'default'), (9, 'default'),
+                            (6, 'huffman_only')):
+      httpzlib.set_compression_options(level, strategy)
+      compressed_chunks = httpzlib.compress_chunks(chunks, True)
+      self.assertEqual(chunks[0], _gunzip(compressed_chunks))
+      sizes[(level, strategy)] = len(compressed_chunks[0])
+    self.assertTrue(sizes[(9, 'default')] < sizes[(1, 'default')])
+    self.assertTrue(sizes[(1, 'default')] < sizes[(6, 'huffman_only')])
+    self.assertRaises(ValueError, httpzlib.set_compression_options,
+                      strategy='unknown')
+
+  def test_target_size(self):
+    chunks = [_random_text(20000, i) for i in xrange(3)]
+    httpzlib.set_compression_options(level=1)
+    compressed_chunks = httpzlib.compress_chunks(chunks, True)
+    self.assertEqual(None, httpzlib.get_target_size(compressed_chunks))
+    httpzlib.set_compression_options(match_original_size=True)
+    target_size = httpzlib.get_target_size(compressed_chunks)
+    new_chunks = ['<script>x</script>' + chunks[0]] + chunks[1:]
+    recompressed_chunks = httpzlib.compress_chunks(
+        new_chunks, True, target_size=target_size)
+    # Level 6 is smaller than level 1, so the gzip data is padded.
+    self.assertEqual(target_size, len(''.join(recompressed_chunks)))
+    self.assertEqual(''.join(new_chunks), _gunzip(recompressed_chunks))
+    self.assertEqual(new_chunks, httpzlib.uncompress_chunks(
+        recompressed_chunks, True))
+    # Deflate data is not padded.
+    recompressed_chunks = httpzlib.compress_chunks(
+        new_chunks, False, target_size=target_size)
+    self.assertTrue(len(''.join(recompressed_chunks)) < target_size)
+    self.assertEqual(''.join(new_chunks),
+                     zlib.decompress(''.join(recompressed_chunks)))
+
+  def test_target_size_search_skips_level_0(self):
+    class LevelsCodec(httpzlib.GzipCodec):
+      def __init__(self):
+        self.levels = []
+
+      def _compress_chunks(self, uncompressed_chunks, finish, level,
+                           strategy):
+        self.levels.append(level)
+        return httpzlib.GzipCodec._compress_chunks(
+            self, uncompressed_chunks, finish, level, strategy)
+
+    codec = LevelsCodec()
+    chunks = [_random_text(20000, 0)]
+    target_size = len(''.join(codec.compress_chunks(chunks, level=3)))
+    codec.levels = []
+    codec.compress_chunks(chunks, level=0, target_size=target_size)
+    self.assertEqual(1, codec.levels[0])
+    self.assertTrue(len(codec.levels) <= 3)
+
+  def test_codecs(self):
+    chunks = [_random_text(20000, i) for i in xrange(3)]
+    for encoding in httpzlib.get_encodings():
+      codec = httpzlib.get_codec(encoding)
+      self.assertEqual(encoding, codec.encoding)
+      compressed_chunks = codec.compress_chunks(chunks)
+      self.assertEqual(3, len(compressed_chunks))
+      self.assertEqual(chunks, codec.uncompress_chunks(compressed_chunks))
+      # Each chunk can be uncompressed as it arrives.
+      uncompressed_chunks = codec.iter_uncompress_chunks(
+          codec.compress_chunks(['a', 'b'], finish=False))
+      self.assertEqual('a', uncompressed_chunks.next())
+      self.assertEqual('b', uncompressed_chunks.next())
+      for level in (-1, 0, 100):
+        self.assertEqual(chunks, codec.uncompress_chunks(
+            codec.compress_chunks(chunks, level=level)))
+    self.assertTrue(httpzlib.get_codec('GZIP') is httpzlib.get_codec('gzip'))
+    self.assertEqual(None, httpzlib.get_codec('identity'))
+    self.assertEqual(None, httpzlib.get_codec(None))
+
+  @unittest.skipIf(httpzlib.brotli_import_error, 'brotli is not installed')
+  def test_brotli_codec(self):
+    codec = httpzlib.get_codec('br')
+    self.assertEqual('abc', httpzlib.brotli.decompress(
+        ''.join(codec.compress_chunks(['a', 'b', 'c']))))
+
+  @unittest.skipIf(httpzlib.zstd_import_error, 'zstandard is not installed')
+  def test_zstd_codec(self):
+    codec = httpzlib.get_codec('zstd')
+    self.assertEqual(['abc'], codec.uncompress_chunks(
+        [httpzlib.zstandard.ZstdCompressor().compress('abc')]))
+
+  def test_deflate_accepts_zlib_and_raw_data(self):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    raw_data = compressor.compress('raw') + compressor.flush()
+    self.assertEqual(['raw'], httpzlib.uncompress_chunks([raw_data], False))
+    self.assertEqual(['', 'zlib'], httpzlib.uncompress_chunks(
+        ['', zlib.compress('zlib')], False))
+    self.assertEqual('a' * 1000, zlib.decompress(''.join(
+        httpzlib.compress_chunks(['a' * 1000], False))))
+
+  def test_register_codec(self):
+    class ReverseCodec(httpzlib.Codec):
+      encoding = 'x-reverse'
+
+      def _compress_chunks(self, uncompressed_chunks, finish, level,
+                           strategy):
+        return [c[::-1] for c in uncompressed_chunks]
+
+      def iter_uncompress_chunks(self, compressed_chunks):
+        return (c[::-1] for c in compressed_chunks)
+
+    class MissingModuleCodec(ReverseCodec):
+      encoding = 'x-missing'
+      import_error = ImportError('No module named missing')
+
+    try:
+      httpzlib.register_codec(ReverseCodec())
+      httpzlib.register_codec(MissingModuleCodec())
+      codec = httpzlib.get_codec('x-reverse')
+      self.assertEqual(['cba'], codec.compress_chunks(['abc']))
+      self.assertEqual(None, httpzlib.get_codec('x-missing'))
+      self.assertFalse('x-missing' in httpzlib.get_encodings())
+    finally:
+      del httpzlib._CODECS['x-reverse']
+      del httpzlib._CODECS['x-missing']
+
+
+if __name__ == '__main__':
+  unittest.main()
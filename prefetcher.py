@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prefetch static subresources of HTML documents while recording.
+
+When a document is recorded, the URLs of its scripts, stylesheets and images
+are fetched concurrently by a bounded pool of worker threads. The prefetched
+responses are held aside and only added to the archive once the browser
+actually requests them, so unused speculative fetches never end up in the
+archive.
+"""
+
+import collections
+import logging
+import Queue
+import re
+import threading
+import time
+import urlparse
+
+import httparchive
+
+TAG_RE = re.compile(r'<(script|img|link)\b([^>]*)>', re.IGNORECASE)
+ATTRIBUTE_RE = re.compile(
+    r'\b(src|href|rel)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))',
+    re.IGNORECASE)
+TAG_URL_ATTRIBUTES = {'script': 'src', 'img': 'src', 'link': 'href'}
+PREFETCH_LINK_RELS = ('stylesheet', 'icon', 'shortcut icon')
+
+# Request headers that must not be copied from the document request.
+DROPPED_HEADERS = (
+    ['accept', 'content-length', 'content-type', 'range'] +
+    httparchive.ArchivedHttpRequest.CONDITIONAL_HEADERS)
+# The accept header of subresource requests. The document's accept header
+# asks for HTML, unlike the requests that browsers make for subresources.
+SUBRESOURCE_ACCEPT = '*/*'
+
+
+def GetSubresourceUrls(document_url, html):
+  """Return the absolute URLs of the static subresources in |html|.
+
+  Args:
+    document_url: the URL of the document (e.g. 'http://example.com/a/').
+    html: the document source.
+  Returns:
+    [url, ...] in document order without duplicates.
+  """
+  urls = []
+  seen = set()
+  for match in TAG_RE.finditer(html):
+    tag = match.group(1).lower()
+    attributes = {}
+    for attribute in ATTRIBUTE_RE.finditer(match.group(2)):
+      value = attribute.group(2) or attribute.group(3) or attribute.group(4)
+      attributes.setdefault(attribute.group(1).lower(), value)
+    if tag == 'link' and (
+        attributes.get('rel', '').lower() not in PREFETCH_LINK_RELS):
+      continue
+    url = attributes.get(TAG_URL_ATTRIBUTES[tag])
+    if not url:
+      continue
+    url = urlparse.urljoin(document_url, url.strip())
+    url = urlparse.urldefrag(url)[0]
+    if urlparse.urlparse(url).scheme in ('http', 'https') and url not in seen:
+      seen.add(url)
+      urls.append(url)
+  return urls
+
+
+class _PendingFetch(object):
+  """A prefetch that is queued, in flight, or done."""
+
+  def __init__(self, request):
+    self.request = request
+    self.response = None
+    self.done = threading.Event()
+
+
+class SubresourcePrefetcher(object):
+  """Fetch subresources of recorded documents ahead of the browser."""
+
+  def __init__(self, http_archive, real_http_fetch, num_workers=8,
+               max_pending=256, max_wait_s=10):
+    """Initialize SubresourcePrefetcher.
+
+    Args:
+      http_archive: an instance of a HttpArchive
+      real_http_fetch: a function that fetches an ArchivedHttpRequest
+          and returns an ArchivedHttpResponse (or None).
+      num_workers: the number of worker threads.
+      max_pending: the maximum number of prefetched responses which have not
+          been requested yet. When full, the oldest completed prefetches are
+          dropped; if none are completed, new URLs are not prefetched.
+      max_wait_s: the number of seconds to wait for an in-flight prefetch
+          before giving up on it.
+    """
+    self.http_archive = http_archive
+    self.real_http_fetch = real_http_fetch
+    self.max_pending = max_pending
+    self.max_wait_s = max_wait_s
+    self._lock = threading.Lock()
+    self._pending = collections.OrderedDict()  # {key: _PendingFetch}
+    self._is_stopped = False
+    self._queue = Queue.Queue()
+    self._workers = []
+    for _ in xrange(num_workers):
+      worker = threading.Thread(target=self._work)
+      worker.daemon = True
+      worker.start()
+      self._workers.append(worker)
+
+  @staticmethod
+  def _get_key(is_ssl, host, full_path):
+    return (is_ssl, host, full_path)
+
+  def _work(self):
+    while True:
+      pending = self._queue.get()
+      if pending is None:
+        return
+      try:
+        pending.response = self.real_http_fetch(pending.request)
+      except Exception, e:
+        logging.warning('Prefetch failed %s: %s', pending.request, e)
+      finally:
+        pending.done.set()
+
+  def _make_room(self):
+    """Drop the oldest completed prefetches until there is room for one more.
+
+    Must be called with the lock held.
+
+    Returns:
+      True if there is room.
+    """
+    if len(self._pending) < self.max_pending:
+      return True
+    for key, pending in self._pending.items():
+      if pending.done.is_set():
+        logging.debug('Dropping unused prefetch: %s', pending.request)
+        del self._pending[key]
+        return True
+    return False
+
+  def _create_request(self, document_request, url):
+    """Return an ArchivedHttpRequest for a subresource of a document."""
+    parsed = urlparse.urlparse(url)
+    full_path = urlparse.urlunparse(('', '') + parsed[2:])
+    headers = dict((k, v) for k, v in document_request.headers.iteritems()
+                   if k.lower() not in DROPPED_HEADERS)
+    if parsed.netloc != document_request.host:
+      headers.pop('cookie', None)
+    headers['host'] = parsed.netloc
+    headers['accept'] = SUBRESOURCE_ACCEPT
+    headers['referer'] = '%s://%s%s' % (
+        'https' if document_request.is_ssl else 'http',
+        document_request.host, document_request.full_path)
+    return httparchive.ArchivedHttpRequest(
+        'GET', parsed.netloc, full_path or '/', None, headers,
+        is_ssl=parsed.scheme == 'https')
+
+  def prefetch_document(self, request, response):
+    """Queue the subresources of |response| if it is an HTML document.
+
+    Args:
+      request: the ArchivedHttpRequest of the document.
+      response: the ArchivedHttpResponse of the document.
+    """
+    content_type = response.get_header('content-type')
+    if not content_type or not content_type.startswith('text/html'):
+      return
+    html = response.get_data_as_text()
+    if not html:
+      return
+    html = html.replace(response.CHUNK_EDIT_SEPARATOR, '')
+    document_url = '%s://%s%s' % ('https' if request.is_ssl else 'http',
+                                  request.host, request.full_path)
+    for url in GetSubresourceUrls(document_url, html):
+      subrequest = self._create_request(request, url)
+      if self.http_archive.get_requests(
+          'GET', subrequest.host, subrequest.full_path, subrequest.is_ssl):
+        continue  # Already recorded.
+      key = self._get_key(subrequest.is_ssl, subrequest.host,
+                          subrequest.full_path)
+      with self._lock:
+        if self._is_stopped:
+          return
+        if key in self._pending:
+          continue
+        if not self._make_room():
+          logging.debug('Prefetch limit reached; skipping %s', url)
+          return
+        pending = _PendingFetch(subrequest)
+        self._pending[key] = pending
+      self._queue.put(pending)
+
+  def pop_response(self, request):
+    """Return the prefetched response for |request|, or None.
+
+    If the prefetch is still in flight, wait up to max_wait_s for it to
+    finish. On timeout, None is returned so the caller fetches directly
+    instead of blocking on a hung upstream. The response is handed over
+    only once.
+
+    Args:
+      request: an ArchivedHttpRequest from the browser.
+    Returns:
+      an ArchivedHttpResponse or None
+    """
+    if (request.command != 'GET' or request.request_body or
+        'range' in request.headers):
+      return None
+    key = self._get_key(request.is_ssl, request.host, request.full_path)
+    with self._lock:
+      pending = self._pending.pop(key, None)
+    if not pending:
+      return None
+    if not pending.done.wait(self.max_wait_s):
+      logging.debug('Prefetch timed out; fetching directly: %s', request)
+      return None
+    if pending.response:
+      logging.debug('Using prefetched response: %s', request)
+    return pending.response
+
+  def stop(self, timeout=5):
+    """Forget the unused prefetches and stop the worker threads.
+
+    Queued prefetches are skipped. Fetches that are in flight get up to
+    |timeout| seconds in total to finish; the worker threads are daemons, so
+    they do not keep the process alive after that.
+    """
+    with self._lock:
+      self._is_stopped = True
+      self._pending.clear()
+    while True:
+      try:
+        self._queue.get_nowait()
+      except Queue.Empty:
+        break
+    for _ in self._workers:
+      self._queue.put(None)
+    deadline = time.time() + timeout
+    for worker in self._workers:
+      worker.join(max(0, deadline - time.time()))
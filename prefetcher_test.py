@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+import httparchive
+import prefetcher
+
+
+DOCUMENT = """<html><head>
+<link rel="stylesheet" href="/style.css">
+<link rel="canonical" href="http://www.example.com/">
+<script src='app.js'></script>
+<script>var inline = 1;</script>
+</head><body>
+<img src=http://images.example.com/logo.png alt="logo">
+<img src="data:image/png;base64,AAAA">
+<img src="/style.css">
+</body></html>"""
+
+
+def create_request(path, host='www.example.com', headers=None):
+  return httparchive.ArchivedHttpRequest(
+      'GET', host, path, None, headers or {'host': host})
+
+
+def create_html_response(body):
+  return httparchive.ArchivedHttpResponse(
+      11, 200, 'OK', [('content-type', 'text/html')], [body])
+
+
+class FakeFetch(object):
+  """Return a simple response for every request and remember the requests."""
+
+  def __init__(self):
+    self.requests = []
+    self.lock = threading.Lock()
+    self.release = threading.Event()
+    self.release.set()
+
+  def __call__(self, request):
+    self.release.wait()
+    with self.lock:
+      self.requests.append(request)
+    return httparchive.create_response(200, body=request.full_path)
+
+
+class GetSubresourceUrlsTest(unittest.TestCase):
+
+  def test_finds_static_subresources(self):
+    self.assertEqual(
+        ['http://www.example.com/style.css',
+         'http://www.example.com/dir/app.js',
+         'http://images.example.com/logo.png'],
+        prefetcher.GetSubresourceUrls('http://www.example.com/dir/', DOCUMENT))
+
+  def test_ignores_other_schemes(self):
+    html = '<script src="javascript:void(0)"></script><img src="ftp://a/b">'
+    self.assertEqual([], prefetcher.GetSubresourceUrls('http://a.com/', html))
+
+
+class SubresourcePrefetcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.archive = httparchive.HttpArchive()
+    self.fetch = FakeFetch()
+
+  def test_prefetched_response_is_served_once(self):
+    p = prefetcher.SubresourcePrefetcher(self.archive, self.fetch)
+    p.prefetch_document(create_request('/'), create_html_response(DOCUMENT))
+    response = p.pop_response(create_request('/app.js'))
+    self.assertEqual(['/app.js'], response.response_data)
+    self.assertEqual(None, p.pop_response(create_request('/app.js')))
+
+  def test_subrequest_uses_document_headers(self):
+    p = prefetcher.SubresourcePrefetcher(self.archive, self.fetch)
+    headers = {'host': 'www.example.com', 'accept-encoding': 'gzip',
+               'accept': 'text/html', 'cookie': 'a=b', 'if-none-match': 'xyz'}
+    p.prefetch_document(create_request('/', headers=headers),
+                        create_html_response(DOCUMENT))
+    p.pop_response(create_request('/style.css'))
+    p.pop_response(create_request('/logo.png', host='images.example.com'))
+    requests = dict((r.host, r) for r in self.fetch.requests)
+    same_host_headers = requests['www.example.com'].headers
+    self.assertEqual('gzip', same_host_headers['accept-encoding'])
+    self.assertEqual('a=b', same_host_headers['cookie'])
+    self.assertEqual('*/*', same_host_headers['accept'])
+    self.assertNotIn('if-none-match', same_host_headers)
+    self.assertNotIn('cookie', requests['images.example.com'].headers)
+
+  def test_skips_recorded_subresources(self):
+    self.archive[create_request('/style.css')] = (
+        httparchive.create_response(200))
+    p = prefetcher.SubresourcePrefetcher(self.archive, self.fetch)
+    p.prefetch_document(create_request('/'), create_html_response(DOCUMENT))
+    self.assertEqual(None, p.pop_response(create_request('/style.css')))
+
+  def test_ignores_non_html(self):
+    p = prefetcher.SubresourcePrefetcher(self.archive, self.fetch)
+    response = httparchive.create_response(200, body=DOCUMENT)
+    p.prefetch_document(create_request('/'), response)
+    self.assertEqual(None, p.pop_response(create_request('/app.js')))
+
+  def test_max_pending_limits_fetches(self):
+    self.fetch.release.clear()  # Keep all fetches in flight.
+    p = prefetcher.SubresourcePrefetcher(self.archive, self.fetch,
+                                         max_pending=2)
+    p.prefetch_document(create_request('/'), create_html_response(DOCUMENT))
+    self.fetch.release.set()
+    self.assertNotEqual(None, p.pop_response(create_request('/style.css')))
+    self.assertNotEqual(None, p.pop_response(create_request('/app.js')))
+    self.assertEqual(
+        None, p.pop_response(create_request('/logo.png',
+                                            host='images.example.com')))
+
+  def test_max_pending_drops_oldest_completed(self):
+    p = prefetcher.SubresourcePrefetcher(self.archive, self.fetch,
+                                         max_pending=1)
+    p.prefetch_document(create_request('/a'),
+                        create_html_response('<img src="/1.png">'))
+    p._pending.values()[0].done.wait()
+    p.prefetch_document(create_request('/b'),
+                        create_html_response('<img src="/2.png">'))
+    self.assertEqual(None, p.pop_response(create_request('/1.png')))
+    self.assertNotEqual(None, p.pop_response(create_request('/2.png')))
+
+  def test_pop_response_gives_up_on_hung_fetch(self):
+    self.fetch.release.clear()
+    p = prefetcher.SubresourcePrefetcher(self.archive, self.fetch,
+                                         max_wait_s=0.1)
+    p.prefetch_document(create_request('/'),
+                        create_html_response('<img src="/1.png">'))
+    self.assertEqual(None, p.pop_response(create_request('/1.png')))
+    self.fetch.release.set()
+    p.stop()
+
+  def test_stop_joins_workers(self):
+    p = prefetcher.SubresourcePrefetcher(self.archive, self.fetch,
+                                         num_workers=2)
+    p.stop()
+    self.assertFalse(any(worker.is_alive() for worker in p._workers))
+    p.prefetch_document(create_request('/'), create_html_response(DOCUMENT))
+    self.assertEqual(None, p.pop_response(create_request('/app.js')))
+    self.assertEqual([], self.fetch.requests)
+
+
+if __name__ == '__main__':
+  unittest.main()
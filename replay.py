@@ -39,6 +39,8 @@ Network simulation examples:
   $ sudo ./replay.py --packet_loss_rate=0.01 archive.wpr
 """
 
+import calendar
+import email.utils
 import json
 import logging
 import optparse
@@ -48,13 +50,16 @@ import sys
 import traceback
 
 import cachemissarchive
+import certstore
 import customhandlers
 import dnsproxy
 import httparchive
 import httpclient
 import httpproxy
+import httpzlib
 import net_configs
 import platformsettings
+import replayhttp2server
 import replayspdyserver
 import script_injector
 import servermanager
@@ -102,18 +107,34 @@ def AddDnsProxy(server_manager, options, host, port, real_dns_lookup,
     dns_filters.append(private_filter)
     server_manager.AppendRecordCallback(private_filter.InitializeArchiveHosts)
     server_manager.AppendReplayCallback(private_filter.InitializeArchiveHosts)
+  if options.use_dns_delay:
+    recorded_delay_filter = dnsproxy.RecordedDelayFilter(
+        options.record, http_archive, options.dns_delay_scale)
+    dns_filters.append(recorded_delay_filter)
+    server_manager.AppendRecordCallback(recorded_delay_filter.SetRecordMode)
+    server_manager.AppendReplayCallback(recorded_delay_filter.SetReplayMode)
   if options.shaping_dns:
     delay_filter = dnsproxy.DelayFilter(options.record, **options.shaping_dns)
     dns_filters.append(delay_filter)
     server_manager.AppendRecordCallback(delay_filter.SetRecordMode)
     server_manager.AppendReplayCallback(delay_filter.SetReplayMode)
   server_manager.Append(dnsproxy.DnsProxyServer, host, port,
-                        dns_lookup=dnsproxy.ReplayDnsLookup(host, dns_filters))
+                        dns_lookup=dnsproxy.ReplayDnsLookup(host, dns_filters),
+                        ipv6_host=options.ipv6_host)
 
 
 def AddWebProxy(server_manager, options, host, real_dns_lookup, http_archive,
                 cache_misses):
+  """Add the web proxy servers.
+
+  Returns:
+    the ControllableHttpArchiveFetch to close once the servers have stopped
+    (None with --spdy).
+  """
   inject_script = script_injector.GetInjectScript(options.inject_scripts)
+  if options.replay_time or options.replay_time_shift:
+    inject_script = script_injector.SetTimeSeed(
+        inject_script, httparchive.get_replay_time())
   custom_handlers = customhandlers.CustomHandlers(options, http_archive)
   if options.spdy:
     assert not options.record, 'spdy cannot be used with --record.'
@@ -128,6 +149,7 @@ def AddWebProxy(server_manager, options, host, real_dns_lookup, http_archive,
         replayspdyserver.ReplaySpdyServer, archive_fetch,
         custom_handlers, host=host, port=options.port,
         certfile=options.https_root_ca_cert_path)
+    return None
   else:
     custom_handlers.add_server_manager_handler(server_manager)
     json_rules = []
@@ -151,36 +173,59 @@ def AddWebProxy(server_manager, options, host, real_dns_lookup, http_archive,
         inject_script,
         options.diff_unknown_requests, options.record, json_rules,
         cache_misses=cache_misses, use_closest_match=options.use_closest_match,
-        scramble_images=options.scramble_images)
+        scramble_images=options.scramble_images,
+        prefetch_subresources=options.prefetch_subresources)
     server_manager.AppendRecordCallback(archive_fetch.SetRecordMode)
     server_manager.AppendReplayCallback(archive_fetch.SetReplayMode)
-    server_manager.Append(
-        httpproxy.HttpProxyServer,
-        archive_fetch, custom_handlers, host=host, port=options.port,
-        rules=json_rules, use_delays=options.use_server_delay,
-        **options.shaping_http)
-    if options.ssl:
-      if options.should_generate_certs:
-        server_manager.Append(
-            httpproxy.HttpsProxyServer, archive_fetch, custom_handlers,
-            options.https_root_ca_cert_path, host=host,
-            port=options.ssl_port, rules=json_rules,
-            use_delays=options.use_server_delay,
-            **options.shaping_http)
-      else:
+    if options.http2:
+      http_server_class = replayhttp2server.Http2ProxyServer
+      https_server_class = replayhttp2server.Https2ProxyServer
+    else:
+      http_server_class = httpproxy.HttpProxyServer
+      https_server_class = httpproxy.HttpsProxyServer
+    proxy_hosts = [host]
+    if options.ipv6_host:
+      proxy_hosts.append(options.ipv6_host)
+    for proxy_host in proxy_hosts:
+      server_manager.Append(
+          http_server_class,
+          archive_fetch, custom_handlers, host=proxy_host, port=options.port,
+          rules=json_rules, use_delays=options.use_server_delay,
+          **options.shaping_http)
+      if options.ssl:
+        if options.should_generate_certs:
+          server_manager.Append(
+              https_server_class, archive_fetch, custom_handlers,
+              options.https_root_ca_cert_path, host=proxy_host,
+              port=options.ssl_port, rules=json_rules,
+              use_delays=options.use_server_delay,
+              **options.shaping_http)
+        else:
+          server_manager.Append(
+              httpproxy.SingleCertHttpsProxyServer, archive_fetch,
+              custom_handlers, options.https_root_ca_cert_path, host=proxy_host,
+              port=options.ssl_port, rules=json_rules,
+              use_delays=options.use_server_delay,
+              **options.shaping_http)
+      if options.http_to_https_port:
         server_manager.Append(
-            httpproxy.SingleCertHttpsProxyServer, archive_fetch,
-            custom_handlers, options.https_root_ca_cert_path, host=host,
-            port=options.ssl_port, rules=json_rules,
+            httpproxy.HttpToHttpsProxyServer,
+            archive_fetch, custom_handlers,
+            host=proxy_host, port=options.http_to_https_port, rules=json_rules,
             use_delays=options.use_server_delay,
             **options.shaping_http)
-    if options.http_to_https_port:
-      server_manager.Append(
-          httpproxy.HttpToHttpsProxyServer,
-          archive_fetch, custom_handlers,
-          host=host, port=options.http_to_https_port, rules=json_rules,
-          use_delays=options.use_server_delay,
-          **options.shaping_http)
+    return archive_fetch
+
+
+def SetReplayClock(options, http_archive):
+  """Set the clock that the dates of replayed responses are relative to."""
+  replay_time = options.replay_time
+  if replay_time == 'recorded':
+    replay_time = http_archive.get_recording_time()
+    if replay_time is None:
+      logging.warning('The archive has no response dates; '
+                      'using the real time for --replay_time.')
+  httparchive.set_replay_clock(replay_time, options.replay_time_shift)
 
 
 def AddTrafficShaper(server_manager, options, host):
@@ -204,10 +249,13 @@ class OptionsWrapper(object):
       ['down', 'up', 'delay_ms', 'packet_loss_rate', 'init_cwnd', 'net'])
   _CONFLICTING_OPTIONS = (
       ('record', ('down', 'up', 'delay_ms', 'packet_loss_rate', 'net',
-                  'spdy', 'use_server_delay')),
+                  'spdy', 'use_server_delay', 'replay_time',
+                  'replay_time_shift')),
       ('append', ('down', 'up', 'delay_ms', 'packet_loss_rate', 'net',
-                  'spdy', 'use_server_delay')),  # same as --record
+                  'spdy', 'use_server_delay', 'replay_time',
+                  'replay_time_shift')),  # same as --record
       ('net', ('down', 'up', 'delay_ms')),
+      ('http2', ('spdy',)),
       ('server', ('server_mode',)),
   )
 
@@ -219,6 +267,9 @@ class OptionsWrapper(object):
         if getattr(options, name) != value])
     self._CheckConflicts()
     self._CheckValidIp('host')
+    self._CheckValidIpv6('ipv6_host')
+    self._CheckReplayTime()
+    self._CheckCompressionOptions()
     self._MassageValues()
 
   def _CheckConflicts(self):
@@ -239,6 +290,37 @@ class OptionsWrapper(object):
       except:
         self._parser.error('Option --%s must be a valid IPv4 address.' % name)
 
+  def _CheckValidIpv6(self, name):
+    """Give an error if option |name| is not a valid IPv6 address."""
+    value = getattr(self._options, name)
+    if value:
+      try:
+        socket.inet_pton(socket.AF_INET6, value)
+      except (socket.error, ValueError):
+        self._parser.error('Option --%s must be a valid IPv6 address.' % name)
+
+  def _CheckReplayTime(self):
+    """Give an error if --replay_time is not valid; convert dates to seconds.
+
+    The value "recorded" is kept, since it depends on the archive.
+    """
+    value = self._options.replay_time
+    if value and value != 'recorded':
+      date_tuple = email.utils.parsedate(value)
+      if date_tuple:
+        self._options.replay_time = calendar.timegm(date_tuple)
+      else:
+        try:
+          self._options.replay_time = float(value)
+        except ValueError:
+          self._parser.error('Option --replay_time must be "recorded", '
+                             'an HTTP date, or epoch seconds.')
+
+  def _CheckCompressionOptions(self):
+    """Give an error if the zlib level is not valid."""
+    if not -1 <= self._options.compression_level <= 9:
+      self._parser.error('Option --compression_level must be from -1 to 9.')
+
   def _ShapingKeywordArgs(self, shaping_key):
     """Return the shaping keyword args for |shaping_key|.
 
@@ -318,8 +400,12 @@ def replay(options, replay_filename):
   if options.admin_check and options.IsRootRequired():
     platformsettings.rerun_as_administrator()
   configure_logging(options.log_level, options.log_file)
+  httpzlib.set_compression_options(options.compression_level,
+                                   options.compression_strategy,
+                                   options.match_compressed_size)
   server_manager = servermanager.ServerManager(options.record)
   cache_misses = None
+  archive_fetch = None
   if options.cache_miss_file:
     if os.path.exists(options.cache_miss_file):
       logging.warning('Cache Miss Archive file %s already exists; '
@@ -347,6 +433,15 @@ def replay(options, replay_filename):
       http_archive = httparchive.HttpArchive.Load(replay_filename)
       logging.info('Loaded %d responses from %s',
                    len(http_archive), replay_filename)
+      SetReplayClock(options, http_archive)
+    if options.dns_prefetch:
+      real_dns_lookup.Prefetch(
+          httparchive.split_host_port(request.host)[0]
+          for request in http_archive
+          if request.host)
+    if options.cert_cache_dir:
+      http_archive.cert_store = certstore.CertificateStore(
+          options.cert_cache_dir)
     server_manager.AppendRecordCallback(real_dns_lookup.ClearCache)
     server_manager.AppendRecordCallback(http_archive.clear)
 
@@ -366,12 +461,16 @@ def replay(options, replay_filename):
     if options.ssl and options.https_root_ca_cert_path is None:
       options.https_root_ca_cert_path = os.path.join(os.path.dirname(__file__),
                                                      'wpr_cert.pem')
+    if (options.ssl and options.should_generate_certs and
+        options.pregenerate_certs):
+      http_archive.set_root_cert(options.https_root_ca_cert_path)
+      http_archive.pregenerate_certificates()
     http_proxy_address = options.host
     if not http_proxy_address:
       http_proxy_address = platformsettings.get_httpproxy_ip_address(
           options.server_mode)
-    AddWebProxy(server_manager, options, http_proxy_address, real_dns_lookup,
-                http_archive, cache_misses)
+    archive_fetch = AddWebProxy(server_manager, options, http_proxy_address,
+                                real_dns_lookup, http_archive, cache_misses)
     AddTrafficShaper(server_manager, options, ipfw_dns_host)
 
   exit_status = 0
@@ -388,8 +487,14 @@ def replay(options, replay_filename):
   except:
     logging.critical(traceback.format_exc())
     exit_status = 2
+  if archive_fetch:
+    archive_fetch.Close()
 
+  if not options.server:
+    logging.info('DNS cache stats: %s', real_dns_lookup.GetStats())
   if options.record:
+    if not options.server:
+      http_archive.record_dns_timings(real_dns_lookup.GetLookupTimes())
     http_archive.Persist(replay_filename)
     logging.info('Saved %d responses to %s', len(http_archive), replay_filename)
   if cache_misses:
@@ -417,6 +522,12 @@ def GetOptionParser():
   option_parser.add_option('--spdy', default=False,
       action='store_true',
       help='Replay via SPDY. (Can be combined with --no-ssl).')
+  option_parser.add_option('--http2', default=False,
+      action='store_true',
+      help='Serve HTTP/2 as well as HTTP/1.1: h2 is negotiated with ALPN '
+           'on the SSL port and h2c is used by clients that start with the '
+           'HTTP/2 preface. Requires the h2 package. Unlike --spdy, this '
+           'works with --record, the server delays and the shaping options.')
   option_parser.add_option('-r', '--record', default=False,
       action='store_true',
       help='Download real responses and record them to replay_file')
@@ -511,6 +622,22 @@ def GetOptionParser():
       dest='use_server_delay',
       help='During replay, simulate server delay by delaying response time to'
            'requests.')
+  harness_group.add_option('--use_dns_delay', default=False,
+      action='store_true',
+      help='During replay, delay DNS answers by the lookup times saved '
+           'during record. Hosts without a saved time get a time drawn from '
+           'the saved ones.')
+  harness_group.add_option('--dns_delay_scale', default=1.0,
+      action='store',
+      type='float',
+      help='Multiply the DNS delays of --use_dns_delay by this factor.')
+  harness_group.add_option('--prefetch_subresources', default=False,
+      action='store_true',
+      help='During record, fetch the scripts, stylesheets and images of '
+           'HTML documents concurrently before the browser requests them.')
+  harness_group.add_option('--dns_prefetch', default=False,
+      action='store_true',
+      help='Resolve the hosts in the archive before starting the servers.')
   harness_group.add_option('-I', '--screenshot_dir', default=None,
       action='store',
       type='string',
@@ -532,6 +659,11 @@ def GetOptionParser():
       type='str',
       help='The IP address to bind all servers to. Defaults to 0.0.0.0 or '
            '127.0.0.1, depending on --server_mode and platform.')
+  harness_group.add_option('--ipv6_host', default=None,
+      action='store',
+      type='str',
+      help='An IPv6 address on which the web proxies also listen. The DNS '
+           'proxy answers AAAA queries for replayed hosts with it.')
   harness_group.add_option('-o', '--port', default=80,
       action='store',
       type='int',
@@ -563,6 +695,15 @@ def GetOptionParser():
   harness_group.add_option('--should_generate_certs', default=False,
       action='store_true',
       help='Use OpenSSL to generate certificate files for requested hosts.')
+  harness_group.add_option('--pregenerate_certs', default=False,
+      action='store_true',
+      help='Generate the certificates of all SSL hosts in the archive '
+           'before starting the servers (with --should_generate_certs).')
+  harness_group.add_option('--cert_cache_dir', default=None,
+      action='store',
+      type='string',
+      help='Directory for generated host certificates that are shared '
+           'across archives and runs (with --should_generate_certs).')
   harness_group.add_option('--no-admin-check', default=True,
       action='store_false',
       dest='admin_check',
@@ -571,6 +712,34 @@ def GetOptionParser():
       action='store_true',
       dest='scramble_images',
       help='Scramble image responses.')
+  harness_group.add_option('--compression_level',
+      default=httpzlib.DEFAULT_LEVEL,
+      action='store',
+      type='int',
+      help='zlib level (0-9, or -1 for the zlib default) for recompressing '
+           'modified responses.')
+  harness_group.add_option('--compression_strategy', default='default',
+      action='store',
+      type='choice',
+      choices=sorted(httpzlib.STRATEGIES),
+      help='zlib strategy for recompressing modified responses.')
+  harness_group.add_option('--match_compressed_size', default=False,
+      action='store_true',
+      help='Recompress modified responses to the size of the recorded '
+           'responses where possible, so that byte counts and transfer times '
+           'under traffic shaping do not change.')
+  harness_group.add_option('--replay_time', default=None,
+      action='store',
+      type='string',
+      help='Fixed time that the dates of replayed responses and Date() of '
+           'deterministic.js are relative to: "recorded" for the time the '
+           'archive was recorded, an HTTP date, or epoch seconds. By '
+           'default, the real time is used.')
+  harness_group.add_option('--replay_time_shift', default=0,
+      action='store',
+      type='int',
+      help='Seconds added to the replay time (e.g. 86400 with '
+           '--replay_time=recorded to replay one day after recording).')
   return option_parser
 
 
@@ -84,6 +84,45 @@ class OptionsWrapperTest(unittest.TestCase):
     self.assertEqual({}, options.shaping_http)
     self.assertEqual({}, options.shaping_dummynet)
 
+  def testReplayTimeAsDateOrSeconds(self):
+    parser = replay.GetOptionParser()
+    options, args = parser.parse_args(
+        ['--replay_time=Wed, 20 Jul 2011 04:58:08 GMT'])
+    options = replay.OptionsWrapper(options, parser)
+    self.assertEqual(1311137888, options.replay_time)
+    options, args = parser.parse_args(['--replay_time=1311137888.5'])
+    options = replay.OptionsWrapper(options, parser)
+    self.assertEqual(1311137888.5, options.replay_time)
+    options, args = parser.parse_args(['--replay_time=recorded'])
+    options = replay.OptionsWrapper(options, parser)
+    self.assertEqual('recorded', options.replay_time)
+
+  def testInvalidReplayTime(self):
+    parser = replay.GetOptionParser()
+    options, args = parser.parse_args(['--replay_time=yesterday'])
+    self.assertRaises(SystemExit, replay.OptionsWrapper, options, parser)
+    options, args = parser.parse_args(['--record', '--replay_time_shift=60'])
+    self.assertRaises(SystemExit, replay.OptionsWrapper, options, parser)
+
+  def testIpv6Host(self):
+    parser = replay.GetOptionParser()
+    options, args = parser.parse_args(['--ipv6_host=::1'])
+    options = replay.OptionsWrapper(options, parser)
+    self.assertEqual('::1', options.ipv6_host)
+    for host in ('127.0.0.1', '[::1]', 'localhost'):
+      options, args = parser.parse_args(['--ipv6_host=%s' % host])
+      self.assertRaises(SystemExit, replay.OptionsWrapper, options, parser)
+
+  def testCompressionOptions(self):
+    parser = replay.GetOptionParser()
+    options, args = parser.parse_args(
+        ['--compression_level=-1', '--compression_strategy=filtered'])
+    options = replay.OptionsWrapper(options, parser)
+    self.assertEqual(-1, options.compression_level)
+    for level in ('-2', '10'):
+      options, args = parser.parse_args(['--compression_level=%s' % level])
+      self.assertRaises(SystemExit, replay.OptionsWrapper, options, parser)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serve archived responses over HTTP/2.
+
+The servers accept HTTP/2 and HTTP/1.1 on the same port:
+  - Http2ProxyServer speaks h2c to clients that start with the HTTP/2
+    connection preface ("prior knowledge").
+  - Https2ProxyServer negotiates h2 with ALPN.
+Other clients are handled by httpproxy.HttpArchiveHandler.
+
+Each stream is answered on its own thread from the same http_archive_fetch
+and custom_handlers as the HTTP/1.1 servers, so streams of a connection are
+served concurrently with their own server delays. Frames are written to the
+connection one at a time, so bandwidth shaping applies to the connection as
+a whole.
+
+Requires the h2 package (https://pypi.python.org/pypi/h2).
+"""
+
+import logging
+import socket
+import threading
+import time
+
+import certutils
+import httparchive
+import httpproxy
+import proxyshaper
+
+h2_import_error = None
+try:
+  import h2.config
+  import h2.connection
+  import h2.events
+  import h2.exceptions
+except ImportError, e:
+  h2_import_error = e
+
+CONNECTION_PREFACE = 'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+# How long to wait for the rest of a preface that arrives in pieces.
+PREFACE_TIMEOUT_S = 5
+PREFACE_POLL_INTERVAL_S = 0.01
+READ_SIZE = 65536
+
+# Connection-specific headers are not allowed in HTTP/2 (RFC 7540 8.1.2.2).
+CONNECTION_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding',
+    'upgrade'])
+
+_CONNECTION_ERRORS = (socket.error,)
+if certutils.Error:
+  _CONNECTION_ERRORS += (certutils.Error,)
+
+
+class _SocketFile(object):
+  """A file-like view of a socket that returns data as it arrives."""
+
+  def __init__(self, connection):
+    self._connection = connection
+
+  def read(self, size):
+    return self._connection.recv(size)
+
+  def write(self, data):
+    self._connection.sendall(data)
+
+  def flush(self):
+    pass
+
+
+class Http2ArchiveHandler(httpproxy.HttpArchiveHandler):
+  """Serve HTTP/2 connections and hand anything else to HTTP/1.1."""
+
+  def handle(self):
+    """Override BaseHTTPRequestHandler method."""
+    if self.is_http2():
+      self.handle_http2()
+    else:
+      httpproxy.HttpArchiveHandler.handle(self)
+
+  def is_http2(self):
+    if self.server.is_ssl:
+      try:
+        return self.connection.get_alpn_proto_negotiated() == 'h2'
+      except _CONNECTION_ERRORS:
+        return False  # The handshake failed.
+    # The preface may arrive in several segments. Peek until it is complete
+    # or the data stops matching it; the data stays queued for the handler.
+    deadline = time.time() + PREFACE_TIMEOUT_S
+    while True:
+      try:
+        data = self.connection.recv(len(CONNECTION_PREFACE), socket.MSG_PEEK)
+      except socket.error:
+        return False
+      if data == CONNECTION_PREFACE:
+        return True
+      if (not data or not CONNECTION_PREFACE.startswith(data) or
+          time.time() > deadline):
+        return False
+      time.sleep(PREFACE_POLL_INTERVAL_S)
+
+  def handle_http2(self):
+    """Read frames until the connection closes.
+
+    Requests are dispatched to a thread per stream once they are complete.
+    """
+    # Reads must return whatever has arrived, so use the socket directly
+    # instead of the buffered rfile/wfile.
+    self.h2_rfile = self.h2_wfile = _SocketFile(self.connection)
+    if self.server.traffic_shaping_up_bps:
+      self.h2_rfile = proxyshaper.RateLimitedFile(
+          self.server.get_active_connection_count, self.h2_rfile,
+          self.server.traffic_shaping_up_bps)
+    if self.server.traffic_shaping_down_bps:
+      self.h2_wfile = proxyshaper.RateLimitedFile(
+          self.server.get_active_connection_count, self.h2_wfile,
+          self.server.traffic_shaping_down_bps)
+    # The condition is notified when the flow control windows change or a
+    # stream is reset.
+    self.h2_lock = threading.Condition()
+    self.h2_connection = h2.connection.H2Connection(
+        config=h2.config.H2Configuration(client_side=False,
+                                         header_encoding=None))
+    self.is_h2_closed = False
+    self.pending_requests = {}  # {stream_id: (headers, [body chunks])}
+    self.reset_stream_ids = set()
+    self.num_active_streams = 0
+    stream_threads = []
+    try:
+      with self.h2_lock:
+        self.h2_connection.initiate_connection()
+        self.send_pending_data()
+      while not self.is_h2_closed:
+        data = self.h2_rfile.read(READ_SIZE)
+        if not data:
+          break
+        with self.h2_lock:
+          events = self.h2_connection.receive_data(data)
+          for event in events:
+            stream_thread = self.handle_event(event)
+            if stream_thread:
+              stream_threads.append(stream_thread)
+          self.send_pending_data()
+    except h2.exceptions.ProtocolError, e:
+      logging.error('HTTP/2 protocol error: %s', e)
+      with self.h2_lock:
+        self.send_pending_data()  # Send the GOAWAY frame.
+    except _CONNECTION_ERRORS, e:
+      logging.debug('HTTP/2 connection error: %s', e)
+    finally:
+      with self.h2_lock:
+        self.is_h2_closed = True
+        self.h2_lock.notify_all()
+      for stream_thread in stream_threads:
+        stream_thread.join()
+      self.close_connection = 1
+
+  def handle_event(self, event):
+    """Handle a h2 event. Must hold |h2_lock|.
+
+    Returns:
+      the thread that serves the stream if the event completes a request
+      or None.
+    """
+    if isinstance(event, h2.events.RequestReceived):
+      self.pending_requests[event.stream_id] = (event.headers, [])
+    elif isinstance(event, h2.events.DataReceived):
+      if event.stream_id in self.pending_requests:
+        self.pending_requests[event.stream_id][1].append(event.data)
+      self.h2_connection.acknowledge_received_data(
+          event.flow_controlled_length, event.stream_id)
+    elif isinstance(event, h2.events.StreamEnded):
+      headers, body_chunks = self.pending_requests.pop(
+          event.stream_id, (None, None))
+      if headers is not None:
+        stream_thread = threading.Thread(
+            target=self.handle_stream,
+            args=(event.stream_id, headers, ''.join(body_chunks) or None))
+        stream_thread.daemon = True
+        stream_thread.start()
+        return stream_thread
+    elif isinstance(event, h2.events.StreamReset):
+      self.pending_requests.pop(event.stream_id, None)
+      self.reset_stream_ids.add(event.stream_id)
+      self.h2_lock.notify_all()
+    elif isinstance(event, (h2.events.WindowUpdated,
+                            h2.events.RemoteSettingsChanged)):
+      self.h2_lock.notify_all()
+    elif isinstance(event, h2.events.ConnectionTerminated):
+      self.is_h2_closed = True
+      self.h2_lock.notify_all()
+    return None
+
+  def send_pending_data(self):
+    """Write the frames queued by the h2 connection. Must hold |h2_lock|.
+
+    Frames are written while holding the lock, so they reach the client in
+    the order the connection queued them.
+    """
+    data = self.h2_connection.data_to_send()
+    if data and not self.is_h2_closed:
+      try:
+        self.h2_wfile.write(data)
+      except _CONNECTION_ERRORS:
+        self.is_h2_closed = True
+        self.h2_lock.notify_all()
+        raise
+
+  def update_active_streams(self, delta):
+    with self.h2_lock:
+      self.num_active_streams += delta
+      if self.num_active_streams == (1 if delta > 0 else 0):
+        self.server.update_active_connection_count(delta)
+
+  def handle_stream(self, stream_id, headers, request_body):
+    start_time = time.time()
+    self.server.num_active_requests += 1
+    self.update_active_streams(1)
+    request = None
+    try:
+      request, error_status = self.get_archived_http2_request(
+          headers, request_body)
+      if request is None:
+        response = httparchive.create_response(error_status)
+      else:
+        response = self.server.custom_handlers.handle(request)
+        if not response:
+          response = self.server.http_archive_fetch(request)
+        if not response:
+          response = httparchive.create_response(404)
+      self.send_archived_http2_response(
+          stream_id, response, is_head=request and request.command == 'HEAD')
+    except (h2.exceptions.StreamClosedError, _StreamResetError):
+      logging.debug('Stream closed before the response was sent: %s', request)
+    except _CONNECTION_ERRORS, e:
+      logging.debug('HTTP/2 connection error: %s', e)
+    except Exception, e:
+      logging.error('Error sending response for %s: %s', request, e)
+    finally:
+      request_time_ms = (time.time() - start_time) * 1000.0
+      if request:
+        self.has_handled_request = True
+        logging.debug('Served: %s (%dms)', request, request_time_ms)
+      self.update_active_streams(-1)
+      self.server.total_request_time += request_time_ms
+      self.server.num_active_requests -= 1
+
+  def get_archived_http2_request(self, headers, request_body):
+    """Return (request, error status) for the headers of a stream.
+
+    The request is None if an error status should be sent instead, either
+    for a malformed request or by a server rule (see apply_server_rules).
+    """
+    pseudo_headers = {}
+    header_dict = {}
+    for name, value in headers:
+      if name.startswith(':'):
+        pseudo_headers[name] = value
+      elif name in header_dict:
+        # Cookies may be split across headers (RFC 7540 8.1.2.5).
+        separator = '; ' if name == 'cookie' else ', '
+        header_dict[name] = header_dict[name] + separator + value
+      else:
+        header_dict[name] = value
+    host = pseudo_headers.get(':authority') or header_dict.get('host')
+    if not host or ':method' not in pseudo_headers:
+      logging.error('Request without authority or method: %s', headers)
+      return None, 400
+    header_dict['host'] = host
+    full_path = pseudo_headers.get(':path', '/')
+    repr_path, exclude_headers, error_status = self.apply_server_rules(
+        host, full_path)
+    if error_status:
+      return None, error_status
+    return httparchive.ArchivedHttpRequest(
+        pseudo_headers[':method'],
+        host,
+        full_path,
+        request_body,
+        header_dict,
+        self.server.is_ssl,
+        repr_path,
+        exclude_headers), None
+
+  def get_response_headers(self, response):
+    """Return the HTTP/2 headers of |response|.
+
+    The response is not modified, so it can be shared by other requests.
+    """
+    headers = [(':status', str(response.status))]
+    for header, value in response.headers:
+      header = header.lower()
+      if header in ('last-modified', 'expires'):
+        headers.append((header, response.update_date(value)))
+      elif header not in CONNECTION_HEADERS and header not in (
+          'date', 'server', 'status', 'version'):
+        headers.append((header, value))
+    headers.append(('server', response.get_header('server', 'WebPageReplay')))
+    headers.append(('date', self.date_time_string()))
+    is_streaming = hasattr(response, 'iter_chunks')
+    if (not is_streaming and not response.is_chunked() and
+        response.get_header('content-length') is None):
+      content_length = sum(len(c) for c in response.response_data)
+      headers.append(('content-length', str(content_length)))
+    return headers
+
+  def send_archived_http2_response(self, stream_id, response, is_head=False):
+    is_replay = not self.server.http_archive_fetch.is_record_mode
+    if is_replay and self.server.traffic_shaping_delay_ms:
+      time.sleep(self.server.traffic_shaping_delay_ms / 1000.0)
+    if is_replay and self.server.use_delays:
+      logging.debug('Using delays (ms): %s', response.delays)
+      time.sleep(response.delays['headers'] / 1000.0)
+      delays = response.delays['data']
+    else:
+      delays = [0] * len(response.response_data)
+    headers = self.get_response_headers(response)
+    with self.h2_lock:
+      self.check_stream(stream_id)
+      self.h2_connection.send_headers(stream_id, headers, end_stream=is_head)
+      self.send_pending_data()
+    if is_head:
+      return
+
+    # Responses being recorded may be streamed from the server as they
+    # arrive (see httpclient.StreamingArchivedHttpResponse).
+    is_streaming = hasattr(response, 'iter_chunks')
+    if is_streaming:
+      streamed_chunks = response.iter_chunks()
+      chunks = ((chunk, 0) for chunk in streamed_chunks)
+    else:
+      chunks = zip(response.response_data, delays)
+    try:
+      for chunk, delay in chunks:
+        if delay:
+          time.sleep(delay / 1000.0)
+        self.send_data(stream_id, chunk)
+    finally:
+      if is_streaming:
+        streamed_chunks.close()
+    with self.h2_lock:
+      self.check_stream(stream_id)
+      self.h2_connection.end_stream(stream_id)
+      self.send_pending_data()
+
+  def check_stream(self, stream_id):
+    """Raise _StreamResetError if the stream can no longer be written."""
+    if self.is_h2_closed or stream_id in self.reset_stream_ids:
+      raise _StreamResetError(stream_id)
+
+  def send_data(self, stream_id, data):
+    """Send |data| as the flow control windows allow."""
+    while data:
+      with self.h2_lock:
+        while True:
+          self.check_stream(stream_id)
+          size = min(len(data),
+                     self.h2_connection.local_flow_control_window(stream_id),
+                     self.h2_connection.max_outbound_frame_size)
+          if size > 0:
+            break
+          self.h2_lock.wait()
+        self.h2_connection.send_data(stream_id, data[:size])
+        self.send_pending_data()
+      data = data[size:]
+
+
+class _StreamResetError(Exception):
+  """Raised when the client reset a stream or closed the connection."""
+  pass
+
+
+class Http2ServerMixin(object):
+  """Track the connections that have active HTTP/2 streams.
+
+  Bandwidth shaping divides the bandwidth between connections. (The streams
+  of a connection already share it.)
+  """
+
+  def init_http2(self):
+    if h2_import_error:
+      raise h2_import_error
+    self.num_active_connections = 0
+    self._active_connection_lock = threading.Lock()
+
+  def update_active_connection_count(self, delta):
+    with self._active_connection_lock:
+      self.num_active_connections += delta
+
+  def get_active_connection_count(self):
+    # Count the connection being read from before its first stream starts.
+    return max(1, self.num_active_connections)
+
+
+class Http2ProxyServer(Http2ServerMixin, httpproxy.HttpProxyServer):
+  """HTTP server that speaks h2c to clients with prior knowledge."""
+
+  HANDLER = Http2ArchiveHandler
+
+  def __init__(self, http_archive_fetch, custom_handlers, **kwargs):
+    self.init_http2()
+    httpproxy.HttpProxyServer.__init__(
+        self, http_archive_fetch, custom_handlers, protocol='HTTP2', **kwargs)
+
+
+class Https2ProxyServer(Http2ServerMixin, httpproxy.HttpsProxyServer):
+  """SSL server that generates certs for each host and negotiates h2."""
+
+  HANDLER = Http2ArchiveHandler
+  ALPN_PROTOCOLS = ['h2', 'http/1.1']
+
+  def __init__(self, http_archive_fetch, custom_handlers,
+               https_root_ca_cert_path, **kwargs):
+    self.init_http2()
+    httpproxy.HttpsProxyServer.__init__(
+        self, http_archive_fetch, custom_handlers, https_root_ca_cert_path,
+        protocol='HTTPS2', **kwargs)
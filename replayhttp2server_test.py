@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+import certutils
+import httparchive
+import replayhttp2server
+
+if not replayhttp2server.h2_import_error:
+  import h2.config
+  import h2.connection
+  import h2.events
+
+
+class FakeFetch(object):
+
+  def __init__(self, responses, http_archive=None):
+    self.responses = responses  # {path: ArchivedHttpResponse}
+    self.http_archive = http_archive
+    self.is_record_mode = False
+    self.requests = []
+
+  def __call__(self, request):
+    self.requests.append(request)
+    return self.responses.get(request.full_path)
+
+
+class MatchedPathFetch(FakeFetch):
+  """Respond with the path that requests are matched by."""
+
+  def __call__(self, request):
+    self.requests.append(request)
+    return httparchive.create_response(200, body=request.repr_path)
+
+
+class FakeCustomHandlers(object):
+
+  def handle(self, request):
+    if request.full_path == '/custom':
+      return httparchive.create_response(200, body='custom')
+    return None
+
+
+class FakeArchive(object):
+
+  def __init__(self, root_ca_cert_str):
+    self.root_ca_cert_str = root_ca_cert_str
+
+  def set_root_cert(self, cert_path):
+    pass
+
+  def get_certificate(self, host):
+    return certutils.generate_cert(self.root_ca_cert_str, '', host)
+
+
+class Http2Client(object):
+
+  def __init__(self, connection):
+    self.connection = connection
+    self.h2_connection = h2.connection.H2Connection(
+        config=h2.config.H2Configuration(client_side=True,
+                                         header_encoding=None))
+    self.h2_connection.initiate_connection()
+    self.flush()
+
+  def flush(self):
+    self.connection.sendall(self.h2_connection.data_to_send())
+
+  def request(self, path, method='GET', body=None):
+    stream_id = self.h2_connection.get_next_available_stream_id()
+    self.h2_connection.send_headers(stream_id, [
+        (':method', method), (':scheme', 'http'), (':authority', 'a.com'),
+        (':path', path)], end_stream=body is None)
+    if body is not None:
+      self.h2_connection.send_data(stream_id, body, end_stream=True)
+    self.flush()
+    return stream_id
+
+  def get_responses(self, num_responses):
+    """Return [(stream_id, headers, body), ...] in the order they ended."""
+    headers = {}
+    bodies = {}
+    responses = []
+    while len(responses) < num_responses:
+      data = self.connection.recv(65536)
+      if not data:
+        break
+      for event in self.h2_connection.receive_data(data):
+        if isinstance(event, h2.events.ResponseReceived):
+          headers[event.stream_id] = dict(event.headers)
+        elif isinstance(event, h2.events.DataReceived):
+          bodies[event.stream_id] = bodies.get(event.stream_id, '') + event.data
+          self.h2_connection.acknowledge_received_data(
+              event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+          responses.append((event.stream_id, headers[event.stream_id],
+                            bodies.get(event.stream_id, '')))
+      self.flush()
+    return responses
+
+
+class SplitPrefaceConnection(object):
+  """Send the start of the connection preface in a separate segment."""
+
+  def __init__(self, connection):
+    self.connection = connection
+    self.is_preface_sent = False
+
+  def sendall(self, data):
+    if not self.is_preface_sent:
+      self.is_preface_sent = True
+      self.connection.sendall(data[:5])
+      time.sleep(0.1)
+      data = data[5:]
+    self.connection.sendall(data)
+
+  def recv(self, size):
+    return self.connection.recv(size)
+
+
+@unittest.skipIf(replayhttp2server.h2_import_error, 'h2 is not installed')
+class Http2ProxyServerTest(unittest.TestCase):
+
+  def setUp(self):
+    slow_response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('content-type', 'text/plain')], ['slow'],
+        {'connect': 0, 'headers': 300, 'data': [0]})
+    chunked_response = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('transfer-encoding', 'chunked')],
+        ['a' * 70000, 'b' * 10], {'connect': 0, 'headers': 0, 'data': [0, 50]})
+    self.fetch = FakeFetch({
+        '/slow': slow_response,
+        '/fast': httparchive.create_response(200, body='fast'),
+        '/chunked': chunked_response,
+        '/post': httparchive.create_response(201),
+        })
+    self.server = replayhttp2server.Http2ProxyServer(
+        self.fetch, FakeCustomHandlers(), host='127.0.0.1', port=0, rules=[],
+        use_delays=True)
+    self.server.__enter__()
+    self.connection = socket.create_connection(self.server.server_address)
+
+  def tearDown(self):
+    self.connection.close()
+    self.server.__exit__(None, None, None)
+    self.server.server_close()
+
+  def test_concurrent_streams_have_own_delays(self):
+    client = Http2Client(self.connection)
+    slow_stream_id = client.request('/slow')
+    fast_stream_id = client.request('/fast')
+    responses = client.get_responses(2)
+    self.assertEqual([fast_stream_id, slow_stream_id],
+                     [stream_id for stream_id, _, _ in responses])
+    self.assertEqual(['fast', 'slow'], [body for _, _, body in responses])
+    self.assertEqual('200', responses[1][1][':status'])
+    self.assertEqual('4', responses[1][1]['content-length'])
+    self.assertEqual('text/plain', responses[1][1]['content-type'])
+
+  def test_chunked_response_uses_flow_control(self):
+    client = Http2Client(self.connection)
+    client.request('/chunked')
+    [(_, headers, body)] = client.get_responses(1)
+    self.assertEqual('a' * 70000 + 'b' * 10, body)
+    self.assertFalse('transfer-encoding' in headers)
+    self.assertFalse('content-length' in headers)
+    # The archived response was not modified.
+    self.assertEqual([('transfer-encoding', 'chunked')],
+                     self.fetch.responses['/chunked'].headers)
+
+  def test_custom_handlers_and_missing_responses(self):
+    client = Http2Client(self.connection)
+    client.request('/custom')
+    client.request('/missing')
+    responses = sorted(client.get_responses(2))
+    self.assertEqual(('200', 'custom'),
+                     (responses[0][1][':status'], responses[0][2]))
+    self.assertEqual('404', responses[1][1][':status'])
+
+  def test_request_body(self):
+    client = Http2Client(self.connection)
+    client.request('/post', method='POST', body='x=1')
+    [(_, headers, _)] = client.get_responses(1)
+    self.assertEqual('201', headers[':status'])
+    request = self.fetch.requests[0]
+    self.assertEqual(('POST', 'a.com', 'x=1'),
+                     (request.command, request.host, request.request_body))
+
+  def test_dates_use_replay_clock(self):
+    self.fetch.responses['/dated'] = httparchive.ArchivedHttpResponse(
+        11, 200, 'OK', [('date', 'Wed, 13 Jul 2011 03:58:08 GMT'),
+                        ('expires', 'Thu, 14 Jul 2011 03:58:08 GMT')], [''])
+    httparchive.set_replay_clock(1311137888)  # Wed, 20 Jul 2011 04:58:08
+    try:
+      client = Http2Client(self.connection)
+      client.request('/dated')
+      [(_, headers, _)] = client.get_responses(1)
+    finally:
+      httparchive.set_replay_clock()
+    self.assertEqual('Wed, 20 Jul 2011 04:58:08 GMT', headers['date'])
+    self.assertEqual('Thu, 21 Jul 2011 04:58:08 GMT', headers['expires'])
+
+  def test_server_rules_match_http1(self):
+    rules = [
+        ['urlMatches', [u'a.com/fast(\\?t=\\d+)'], 'removeGroupsFromURL'],
+        ['urlMatches', [u'a.com/blocked'], 'sendStatus', 403]]
+    fetch = MatchedPathFetch({})
+    server = replayhttp2server.Http2ProxyServer(
+        fetch, FakeCustomHandlers(), host='127.0.0.1', port=0, rules=rules)
+    server.__enter__()
+    connection = socket.create_connection(server.server_address)
+    try:
+      client = Http2Client(connection)
+      fast_stream_id = client.request('/fast?t=123')
+      blocked_stream_id = client.request('/blocked')
+      responses = dict((stream_id, (headers[':status'], body))
+                       for stream_id, headers, body in client.get_responses(2))
+      http_connection = httplib.HTTPConnection(*server.server_address)
+      http_connection.request('GET', '/fast?t=123', headers={'Host': 'a.com'})
+      http1_body = http_connection.getresponse().read()
+      http_connection.close()
+    finally:
+      connection.close()
+      server.__exit__(None, None, None)
+      server.server_close()
+    self.assertEqual(('200', http1_body), responses[fast_stream_id])
+    self.assertNotEqual('/fast?t=123', http1_body)
+    self.assertEqual('403', responses[blocked_stream_id][0])
+    self.assertEqual(['/fast?t=123', '/fast?t=123'],
+                     [r.full_path for r in fetch.requests])
+
+  def test_split_preface(self):
+    client = Http2Client(SplitPrefaceConnection(self.connection))
+    client.request('/fast')
+    responses = client.get_responses(1)
+    self.assertEqual(['fast'], [body for _, _, body in responses])
+
+  def test_http1_fallback(self):
+    http_connection = httplib.HTTPConnection(*self.server.server_address)
+    http_connection.request('GET', '/fast', headers={'Host': 'a.com'})
+    response = http_connection.getresponse()
+    self.assertEqual((200, 'fast'), (response.status, response.read()))
+    http_connection.close()
+
+
+@unittest.skipIf(replayhttp2server.h2_import_error, 'h2 is not installed')
+class Https2ProxyServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp(prefix='replayhttp2server_')
+    ca_cert_path = os.path.join(self.temp_dir, 'ca.pem')
+    ca_cert_str, key_str = certutils.generate_dummy_ca_cert()
+    certutils.write_dummy_ca_cert(ca_cert_str, key_str, ca_cert_path)
+    fetch = FakeFetch({'/': httparchive.create_response(200, body='secure')},
+                      FakeArchive(key_str + ca_cert_str))
+    self.server = replayhttp2server.Https2ProxyServer(
+        fetch, FakeCustomHandlers(), ca_cert_path, host='127.0.0.1', port=0,
+        rules=[])
+    self.server.__enter__()
+
+  def tearDown(self):
+    self.server.__exit__(None, None, None)
+    self.server.server_close()
+    shutil.rmtree(self.temp_dir)
+
+  def connect(self, protocols):
+    context = certutils.get_ssl_context()
+    context.set_alpn_protos(protocols)
+    connection = certutils.get_ssl_connection(
+        context, socket.create_connection(self.server.server_address))
+    connection.set_tlsext_host_name('a.com')
+    connection.set_connect_state()
+    connection.do_handshake()
+    return connection
+
+  def test_alpn_h2(self):
+    connection = self.connect(['h2', 'http/1.1'])
+    try:
+      self.assertEqual('h2', connection.get_alpn_proto_negotiated())
+      client = Http2Client(connection)
+      client.request('/')
+      [(_, headers, body)] = client.get_responses(1)
+      self.assertEqual(('200', 'secure'), (headers[':status'], body))
+    finally:
+      connection.close()
+
+  def test_alpn_http1(self):
+    connection = self.connect(['http/1.1'])
+    try:
+      self.assertEqual('http/1.1', connection.get_alpn_proto_negotiated())
+      connection.sendall('GET / HTTP/1.1\r\nHost: a.com\r\n\r\n')
+      response = ''
+      while not response.endswith('secure'):
+        data = connection.recv(65536)
+        if not data:
+          break
+        response += data
+      self.assertTrue(response.startswith('HTTP/1.1 200'))
+    finally:
+      connection.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
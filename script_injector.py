@@ -26,6 +26,8 @@ HTML_RE = re.compile(r'^.{,256}?(<!--.*-->)?.{,256}?<html.*?>',
                      re.IGNORECASE | re.DOTALL)
 HEAD_RE = re.compile(r'^.{,256}?(<!--.*-->)?.{,256}?<head.*?>',
                      re.IGNORECASE | re.DOTALL)
+# The start time of Date() in deterministic.js.
+TIME_SEED_RE = re.compile(r'(var time_seed = )\d+;')
 
 
 def GetInjectScript(scripts):
@@ -59,6 +61,33 @@ def GetInjectScript(scripts):
   return MinifyScript(''.join(lines))
 
 
+def SetTimeSeed(script, seconds):
+  """Return |script| with the Date() start time of deterministic.js set.
+
+  Args:
+    script: an inject script (see GetInjectScript).
+    seconds: epoch seconds of the new start time.
+  Returns:
+    the updated script (unchanged if it does not include deterministic.js).
+  """
+  return TIME_SEED_RE.sub(r'\g<1>%d;' % int(seconds * 1000), script)
+
+
+def GetInjectionOffset(content):
+  """Return the offset right after <head>, <html> or <!doctype html>.
+
+  The tags are only searched for near the beginning of |content|.
+
+  Returns:
+    an offset in |content| or None if none of the tags is found.
+  """
+  for tag_re in (HEAD_RE, HTML_RE, DOCTYPE_RE):
+    match = tag_re.match(content)
+    if match:
+      return match.end()
+  return None
+
+
 def InjectScript(content, content_type, script_to_inject):
   """Inject |script_to_inject| into |content| if |content_type| is 'text/html'.
 
@@ -74,16 +103,11 @@ def InjectScript(content, content_type, script_to_inject):
   if content_type and content_type == 'text/html':
     already_injected = not content or script_to_inject in content
     if not already_injected:
-      def InsertScriptAfter(matchobj):
-        return '%s<script>%s</script>' % (matchobj.group(0), script_to_inject)
-
-      content, is_injected = HEAD_RE.subn(InsertScriptAfter, content, 1)
-      if not is_injected:
-        content, is_injected = HTML_RE.subn(InsertScriptAfter, content, 1)
-      if not is_injected:
-        content, is_injected = DOCTYPE_RE.subn(InsertScriptAfter, content, 1)
-      if not is_injected:
-        content = '<script>%s</script>%s' % (script_to_inject, content)
+      offset = GetInjectionOffset(content)
+      if offset is None:
+        offset = 0
         logging.warning('Inject at the very beginning, because no tag of '
                         '<head>, <html> or <!doctype html> is found.')
+      content = '%s<script>%s</script>%s' % (
+          content[:offset], script_to_inject, content[offset:])
   return content, already_injected
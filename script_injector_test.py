@@ -99,6 +99,14 @@ class ScriptInjectorTest(unittest.TestCase):
     self._assert_successful_injection_with_comment(
         LONG_COMMENT, LONG_COMMENT, LONG_COMMENT)
 
+  def test_set_time_seed(self):
+    script = script_injector.GetInjectScript('deterministic.js')
+    self.assertTrue('var time_seed = 1204251968254;' in script)
+    script = script_injector.SetTimeSeed(script, 1311134288.5)
+    self.assertTrue('var time_seed = 1311134288500;' in script)
+    self.assertEqual(SCRIPT_TO_INJECT,
+                     script_injector.SetTimeSeed(SCRIPT_TO_INJECT, 0))
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -1,36 +1,114 @@
 """Extends BaseHTTPRequestHandler with SSL certificate generation."""
 import logging
 import socket
+import threading
 
 import certutils
 
 
+# Identifies sessions created by the replay server; resumed sessions
+# must come from a context with the same id.
+SESSION_ID_CONTEXT = 'web-page-replay'
+SESSION_TIMEOUT_SECONDS = 60 * 60
+
+
+class SslContextCache(object):
+  """Per-host SSL contexts with the certificate and private key parsed once.
+
+  A repeat handshake for a host only has to select its context.
+
+  Sessions can be resumed by session id and by session ticket. OpenSSL keeps
+  the session cache and the ticket key on the context a connection starts
+  with, even after the SNI callback switches to a per-host context, so all
+  hosts share the cache and ticket key of |initial_context|.
+  """
+
+  def __init__(self, ca_cert_path, get_certificate, alpn_protocols=None):
+    """Initialize SslContextCache.
+
+    Args:
+      ca_cert_path: path of the root CA (with its private key).
+      get_certificate: a function that returns the PEM formatted
+          certificate string for a host.
+      alpn_protocols: protocols to negotiate with ALPN in order of
+          preference (e.g. ['h2', 'http/1.1']), or None to skip ALPN.
+    """
+    with open(ca_cert_path, 'r') as ca_cert_file:
+      self._key = certutils.load_privatekey(ca_cert_file.read())
+    self._get_certificate = get_certificate
+    self._alpn_protocols = alpn_protocols
+    self._lock = threading.Lock()
+    self._contexts = {}  # {host: SSL.Context}
+    self.handshake_count = 0
+    self.resumed_handshake_count = 0
+    # Connections start with this context and switch to a per-host context
+    # once the SNI callback has seen the host name.
+    self.initial_context = self._create_context()
+    self.initial_context.set_session_cache_mode(certutils.SESS_CACHE_SERVER)
+    self.initial_context.set_timeout(SESSION_TIMEOUT_SECONDS)
+    self.initial_context.set_tlsext_servername_callback(
+        self._handle_servername)
+
+  def _create_context(self):
+    context = certutils.get_ssl_context()
+    context.set_session_id(SESSION_ID_CONTEXT)
+    if self._alpn_protocols:
+      context.set_alpn_select_callback(self._select_alpn_protocol)
+    return context
+
+  def _select_alpn_protocol(self, connection, client_protocols):
+    """An ALPN callback that picks our most preferred protocol."""
+    for protocol in self._alpn_protocols:
+      if protocol in client_protocols:
+        return protocol
+    return certutils.NO_OVERLAPPING_PROTOCOLS
+
+  def get_context(self, host):
+    """Return the SSL context with the certificate for |host|."""
+    context = self._contexts.get(host)
+    if context is None:
+      cert = certutils.load_cert(self._get_certificate(host))
+      context = self._create_context()
+      context.use_certificate(cert)
+      context.use_privatekey(self._key)
+      with self._lock:
+        context = self._contexts.setdefault(host, context)
+    return context
+
+  def record_handshake(self, connection):
+    """Count a completed handshake and whether it resumed a session."""
+    is_resumed = certutils.is_session_reused(connection)
+    with self._lock:
+      self.handshake_count += 1
+      if is_resumed:
+        self.resumed_handshake_count += 1
+
+  def get_stats(self):
+    """Return (handshake count, resumed handshake count)."""
+    with self._lock:
+      return self.handshake_count, self.resumed_handshake_count
+
+  def _handle_servername(self, connection):
+    """A SNI callback that happens during do_handshake()."""
+    try:
+      host = connection.get_servername()
+      if host:
+        connection.set_context(self.get_context(host))
+      # else: fail with 'no shared cipher'
+    except Exception, e:
+      # Do not leak any exceptions or else openssl crashes.
+      logging.error('Exception in SNI handler %s', e)
+
+
 class SslHandshakeHandler:
-  """Handles Server Name Indication (SNI) using dummy certs."""
+  """Handles Server Name Indication (SNI) using dummy certs.
+
+  The server must have a |ssl_context_cache| attribute (an SslContextCache).
+  """
 
   def setup(self):
     """Sets up connection providing the certificate to the client."""
-    # One of: One of SSLv2_METHOD, SSLv3_METHOD, SSLv23_METHOD, or TLSv1_METHOD
-    context = certutils.get_ssl_context()
-    def handle_servername(connection):
-      """A SNI callback that happens during do_handshake()."""
-      try:
-        host = connection.get_servername()
-        if host:
-          cert_str = (
-              self.server.http_archive_fetch.http_archive.get_certificate(host))
-          new_context = certutils.get_ssl_context()
-          cert = certutils.load_cert(cert_str)
-          new_context.use_certificate(cert)
-          new_context.use_privatekey_file(self.server.ca_cert_path)
-          connection.set_context(new_context)
-          return new_context
-        # else: fail with 'no shared cipher'
-      except Exception, e:
-        # Do not leak any exceptions or else openssl crashes.
-        logging.error('Exception in SNI handler %s', e)
-
-    context.set_tlsext_servername_callback(handle_servername)
+    context = self.server.ssl_context_cache.initial_context
     self.connection = certutils.get_ssl_connection(context, self.connection)
     self.connection.set_accept_state()
     try:
@@ -48,6 +126,7 @@ class SslHandshakeHandler:
         return ''
       logging.error('SSL handshake error')
       raise
+    self.server.ssl_context_cache.record_handshake(self.connection)
 
     # Re-wrap the read/write streams with our new connection.
     self.rfile = socket._fileobject(self.connection, 'rb', self.rbufsize,
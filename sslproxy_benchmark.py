@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the TLS handshakes per second of the SNI handshake handler.
+
+Starts a local server with sslproxy.SslHandshakeHandler and runs handshakes
+against a fixed set of host names from several client threads. Host
+certificates are generated before the measurement, so the numbers reflect
+the handshake and context selection costs only. Each certificate key type
+is measured separately.
+
+Usage:
+  ./sslproxy_benchmark.py --handshakes 2000 --hosts 20
+  ./sslproxy_benchmark.py --key_types ecdsa-p256
+"""
+
+import BaseHTTPServer
+import optparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import certutils
+import sslproxy
+
+
+class UncachedSslContextCache(sslproxy.SslContextCache):
+  """Build a new context and read the key file on every handshake.
+
+  This is how handshakes were handled before contexts were cached.
+  """
+
+  def __init__(self, ca_cert_path, get_certificate):
+    sslproxy.SslContextCache.__init__(self, ca_cert_path, get_certificate)
+    self._ca_cert_path = ca_cert_path
+
+  def get_context(self, host):
+    context = certutils.get_ssl_context()
+    context.use_certificate(certutils.load_cert(self._get_certificate(host)))
+    context.use_privatekey_file(self._ca_cert_path)
+    return context
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def handle(self):
+    """Do nothing after the handshake."""
+    pass
+
+
+class Server(BaseHTTPServer.HTTPServer):
+
+  def __init__(self, ssl_context_cache):
+    self.ssl_context_cache = ssl_context_cache
+    BaseHTTPServer.HTTPServer.__init__(
+        self, ('127.0.0.1', 0), sslproxy.wrap_handler(Handler))
+
+  def handle_error(self, request, client_address):
+    pass
+
+
+def _RunClient(port, hosts, num_handshakes, errors, resume=False):
+  context = certutils.get_ssl_context()
+  session = None
+  for i in xrange(num_handshakes):
+    sock = socket.create_connection(('127.0.0.1', port))
+    connection = certutils.get_ssl_connection(context, sock)
+    connection.set_tlsext_host_name(hosts[i % len(hosts)])
+    if session:
+      connection.set_session(session)
+    connection.set_connect_state()
+    try:
+      connection.do_handshake()
+      if resume:
+        session = connection.get_session()
+      connection.shutdown()
+    except certutils.Error:
+      errors.append(1)
+    finally:
+      connection.close()
+
+
+def RunBenchmark(ssl_context_cache, hosts, num_clients, num_handshakes,
+                 resume=False):
+  """Return the handshakes per second.
+
+  If |resume| is True, clients resume the session of their previous
+  handshake.
+  """
+  server = Server(ssl_context_cache)
+  server_thread = threading.Thread(target=server.serve_forever)
+  server_thread.daemon = True
+  server_thread.start()
+  errors = []
+  try:
+    # Warm up, so that every host has been seen once.
+    _RunClient(server.server_port, hosts, len(hosts), errors)
+    threads = [threading.Thread(
+        target=_RunClient,
+        args=(server.server_port, hosts, num_handshakes // num_clients,
+              errors, resume)) for _ in xrange(num_clients)]
+    start_time = time.time()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    elapsed = time.time() - start_time
+  finally:
+    server.shutdown()
+    server.server_close()
+  if errors:
+    print 'handshake errors: %d' % len(errors)
+  return (num_handshakes // num_clients) * num_clients / elapsed
+
+
+def main():
+  option_parser = optparse.OptionParser(
+      usage='%prog [options]', description=__doc__)
+  option_parser.add_option('--clients', default=4,
+      action='store',
+      type='int',
+      help='Number of concurrent clients.')
+  option_parser.add_option('--handshakes', default=2000,
+      action='store',
+      type='int',
+      help='Total number of handshakes per measurement.')
+  option_parser.add_option('--hosts', default=20,
+      action='store',
+      type='int',
+      help='Number of distinct SNI host names.')
+  option_parser.add_option('--key_types', default=','.join(certutils.KEY_TYPES),
+      action='store',
+      type='string',
+      help='Comma-separated certificate key types to measure.')
+  options, args = option_parser.parse_args()
+  if args:
+    option_parser.error('Unexpected arguments: %s' % args)
+
+  hosts = ['host%d.example.com' % i for i in xrange(options.hosts)]
+  temp_dir = tempfile.mkdtemp(prefix='sslproxy_benchmark_')
+  try:
+    for key_type in options.key_types.split(','):
+      ca_cert_path = os.path.join(temp_dir, '%s.pem' % key_type)
+      ca_cert_str, key_str = certutils.generate_dummy_ca_cert(
+          key_type=key_type)
+      certutils.write_dummy_ca_cert(ca_cert_str, key_str, ca_cert_path)
+      start_time = time.time()
+      certs = dict((host, certutils.generate_cert(key_str + ca_cert_str, '',
+                                                  host)) for host in hosts)
+      print '%s: %.2fms per generated certificate' % (
+          key_type, (time.time() - start_time) * 1000.0 / len(hosts))
+      for name, cache_class, resume in (
+          ('uncached', UncachedSslContextCache, False),
+          ('cached', sslproxy.SslContextCache, False),
+          ('cached+resumed', sslproxy.SslContextCache, True)):
+        cache = cache_class(ca_cert_path, certs.get)
+        rate = RunBenchmark(cache, hosts, options.clients, options.handshakes,
+                            resume)
+        handshake_count, resumed_count = cache.get_stats()
+        print '%s %s: %.0f handshakes/sec (%d of %d resumed)' % (
+            key_type, name, rate, resumed_count, handshake_count)
+  finally:
+    shutil.rmtree(temp_dir)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
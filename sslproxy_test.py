@@ -16,8 +16,9 @@ import sslproxy
 class Client(object):
 
   def __init__(self, ca_cert_path, verify_cb, port, host_name='foo.com',
-               host='localhost'):
+               host='localhost', session=None):
     self.host_name = host_name
+    self.session = session
     self.verify_cb = verify_cb
     self.ca_cert_path = ca_cert_path
     self.port = port
@@ -35,9 +36,12 @@ class Client(object):
     self.connection = certutils.get_ssl_connection(context, s)
     self.connection.connect((self.host, self.port))
     self.connection.set_tlsext_host_name(self.host_name)
+    if self.session:
+      self.connection.set_session(self.session)
 
     try:
       self.connection.send('\r\n\r\n')
+      self.session = self.connection.get_session()
     finally:
       self.connection.shutdown()
       self.connection.close()
@@ -89,6 +93,8 @@ class Server(BaseHTTPServer.HTTPServer):
     with open(ca_cert_path, 'r') as ca_file:
       ca_cert_str = ca_file.read()
     self.http_archive_fetch = DummyFetch(ca_cert_str)
+    self.ssl_context_cache = sslproxy.SslContextCache(
+        ca_cert_path, self.http_archive_fetch.http_archive.get_certificate)
     if use_error_handler:
       self.HANDLER = WrappedErrorHandler
     else:
@@ -166,6 +172,22 @@ class TestClient(unittest.TestCase):
                  'random.host')
       c.run_request()
 
+  def test_session_resumption(self):
+    with Server(self.ca_cert_path) as server:
+      c = Client(self.cert_path, self.verify_cb, server.server_port, 'foo.com')
+      c.run_request()
+      # Resume on the same host and on another host of the same server.
+      c.run_request()
+      c.host_name = 'bar.com'
+      c.run_request()
+      # The server counts a handshake after the client has finished it.
+      stats = server.ssl_context_cache.get_stats()
+      deadline = time.time() + 5
+      while stats[0] < 3 and time.time() < deadline:
+        time.sleep(0.01)
+        stats = server.ssl_context_cache.get_stats()
+      self.assertEqual((3, 2), stats)
+
   def test_wrong_cert(self):
     with Server(self.ca_cert_path, True) as server:
       c = Client(self.wrong_cert_path, self.verify_cb, server.server_port,